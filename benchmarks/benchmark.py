@@ -0,0 +1,367 @@
+"""
+Throughput & latency benchmark of xman running against a local stub upstream.
+Run it from the repository root: python -m benchmarks.benchmark --help
+"""
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, asdict
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Dict, Tuple
+
+from nuclear import CliBuilder, parameter
+from nuclear.sublog import log, logerr, wrap_context
+from nuclear.types.boolean import boolean
+
+from xman.cache import open_tape, default_request_hash
+from xman.entry import CacheEntry
+from xman.request import HttpRequest
+from xman.response import HttpResponse
+
+MODES = ['passthrough', 'record', 'replay']
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# replayed entries are matched by method & path only, regardless of headers sent by benchmark clients
+EXTENSIONS_SOURCE = '''
+def cache_request_traits(request):
+    return request.method, request.path
+'''
+TAPE_BATCH_SIZE = 10000
+
+
+@dataclass
+class Scenario(object):
+    mode: str
+    body_size: int
+    tape_size: int = 0
+
+    @property
+    def name(self) -> str:
+        if self.mode == 'replay':
+            return f'{self.mode} body={self.body_size} tape={self.tape_size}'
+        return f'{self.mode} body={self.body_size}'
+
+
+@dataclass
+class Result(object):
+    scenario: str
+    mode: str
+    body_size: int
+    tape_size: int
+    requests: int
+    errors: int
+    duration: float
+    requests_per_second: float
+    latency_p50_ms: float
+    latency_p99_ms: float
+    latency_max_ms: float
+    startup_seconds: float
+    rss_kb: Optional[int]
+    peak_rss_kb: Optional[int]
+
+
+def run_benchmarks(modes: str, body_sizes: str, tape_sizes: str, tape_format: str, max_tape_bytes: int,
+                   clients: int, requests_per_client: int, engine: str, server_mode: str, workers: int,
+                   keep_alive: bool, output: str, compare: Optional[str]):
+    with logerr():
+        scenarios = build_scenarios(parse_list(modes, str), parse_list(body_sizes, int),
+                                    parse_list(tape_sizes, int), max_tape_bytes)
+        xman_args = ['--engine', engine, '--server-mode', server_mode, '--workers', str(workers),
+                     '--keep-alive', str(keep_alive).lower()]
+        results = []
+        with tempfile.TemporaryDirectory(prefix='xman-bench-') as work_dir:
+            extensions_file = os.path.join(work_dir, 'bench_extensions.py')
+            with open(extensions_file, 'w') as f:
+                f.write(EXTENSIONS_SOURCE)
+            for scenario in scenarios:
+                with wrap_context('running scenario', scenario=scenario.name):
+                    result = run_scenario(scenario, work_dir, extensions_file, tape_format, xman_args,
+                                          clients, requests_per_client)
+                    log.info('Scenario finished', scenario=scenario.name, rps=round(result.requests_per_second),
+                             p50_ms=result.latency_p50_ms, p99_ms=result.latency_p99_ms, errors=result.errors,
+                             startup_s=result.startup_seconds, rss_kb=result.rss_kb)
+                    results.append(result)
+
+        report = {
+            'environment': environment_info(),
+            'parameters': {
+                'clients': clients,
+                'requests_per_client': requests_per_client,
+                'engine': engine,
+                'server_mode': server_mode,
+                'workers': workers,
+                'keep_alive': keep_alive,
+                'tape_format': tape_format,
+            },
+            'results': [asdict(result) for result in results],
+        }
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        log.info('Results saved', output=output)
+        if compare:
+            compare_results(compare, report)
+
+
+def build_scenarios(modes: List[str], body_sizes: List[int], tape_sizes: List[int],
+                    max_tape_bytes: int) -> List[Scenario]:
+    scenarios = []
+    for mode in modes:
+        if mode not in MODES:
+            raise ValueError(f'unknown mode: {mode}, expected one of {MODES}')
+        for body_size in body_sizes:
+            if mode != 'replay':
+                scenarios.append(Scenario(mode, body_size))
+                continue
+            for tape_size in tape_sizes:
+                if tape_size * body_size > max_tape_bytes:
+                    log.warn('Skipping too large tape', tape_size=tape_size, body_size=body_size,
+                             max_tape_bytes=max_tape_bytes)
+                    continue
+                scenarios.append(Scenario(mode, body_size, tape_size))
+    return scenarios
+
+
+def run_scenario(scenario: Scenario, work_dir: str, extensions_file: str, tape_format: str,
+                 xman_args: List[str], clients: int, requests_per_client: int) -> Result:
+    upstream_port = free_port()
+    upstream = multiprocessing.Process(target=serve_upstream, args=(upstream_port, scenario.body_size), daemon=True)
+    upstream.start()
+    wait_for_port(upstream_port, timeout=10)
+
+    tape_file = os.path.join(work_dir, f'tape_{scenario.mode}_{scenario.body_size}_{scenario.tape_size}.{tape_format}')
+    if scenario.mode == 'replay':
+        with wrap_context('generating tape'):
+            start = time.perf_counter()
+            generate_tape(tape_file, scenario.tape_size, scenario.body_size)
+            log.info('Tape generated', entries=scenario.tape_size, size=os.path.getsize(tape_file),
+                     seconds=round(time.perf_counter() - start, 3))
+
+    listen_port = free_port()
+    command = [sys.executable, '-m', 'xman', f'http://127.0.0.1:{upstream_port}',
+               '--listen-port', str(listen_port), '--listen-ssl', 'false', '--config', extensions_file,
+               '--record', str(scenario.mode == 'record').lower(), '--record-file', tape_file,
+               '--replay', str(scenario.mode == 'replay').lower()] + xman_args
+    start = time.perf_counter()
+    xman = subprocess.Popen(command, cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(listen_port, timeout=600, process=xman)
+        startup_seconds = time.perf_counter() - start
+
+        paths = client_paths(scenario, clients, requests_per_client)
+        with multiprocessing.Pool(clients) as pool:
+            outcomes = pool.starmap(run_client, [(listen_port, client_paths) for client_paths in paths])
+        rss_kb, peak_rss_kb = process_memory(xman.pid)
+    finally:
+        xman.terminate()
+        xman.wait(timeout=600)
+        upstream.terminate()
+        upstream.join()
+        if os.path.exists(tape_file):
+            os.remove(tape_file)
+
+    latencies = sorted(latency for client_latencies, _, _, _ in outcomes for latency in client_latencies)
+    errors = sum(client_errors for _, client_errors, _, _ in outcomes)
+    duration = max(end for _, _, _, end in outcomes) - min(begin for _, _, begin, _ in outcomes)
+    return Result(
+        scenario=scenario.name,
+        mode=scenario.mode,
+        body_size=scenario.body_size,
+        tape_size=scenario.tape_size,
+        requests=len(latencies),
+        errors=errors,
+        duration=round(duration, 3),
+        requests_per_second=round(len(latencies) / duration, 1),
+        latency_p50_ms=percentile_ms(latencies, 50),
+        latency_p99_ms=percentile_ms(latencies, 99),
+        latency_max_ms=percentile_ms(latencies, 100),
+        startup_seconds=round(startup_seconds, 3),
+        rss_kb=rss_kb,
+        peak_rss_kb=peak_rss_kb,
+    )
+
+
+def client_paths(scenario: Scenario, clients: int, requests_per_client: int) -> List[List[str]]:
+    """Paths requested by every client: unique ones when recording, random recorded ones when replaying"""
+    rand = random.Random(0)
+    if scenario.mode == 'replay':
+        return [[f'/item/{rand.randrange(scenario.tape_size)}' for _ in range(requests_per_client)]
+                for _ in range(clients)]
+    if scenario.mode == 'record':
+        return [[f'/record/{client}/{i}' for i in range(requests_per_client)] for client in range(clients)]
+    return [['/passthrough'] * requests_per_client for _ in range(clients)]
+
+
+def run_client(port: int, paths: List[str]) -> Tuple[List[float], int, float, float]:
+    """Send requests one after another, return their latencies, number of failed ones and time span"""
+    connection = HTTPConnection('127.0.0.1', port, timeout=60)
+    latencies = []
+    errors = 0
+    begin = time.perf_counter()
+    for path in paths:
+        start = time.perf_counter()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+            if response.getheader('Connection', '').lower() == 'close':
+                connection.close()
+        except (OSError, ConnectionError):
+            errors += 1
+            connection.close()
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+    return latencies, errors, begin, time.perf_counter()
+
+
+def serve_upstream(port: int, body_size: int):
+    """Stub upstream returning body of a fixed size to every request"""
+    body = b'x' * body_size
+
+    class UpstreamHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), UpstreamHandler)
+    httpd.daemon_threads = True
+    httpd.serve_forever()
+
+
+def generate_tape(tape_file: str, tape_size: int, body_size: int):
+    tape = open_tape(tape_file, default_request_hash, None)
+    tape.prepare_recording()
+    body = b'x' * body_size
+    for batch_start in range(0, tape_size, TAPE_BATCH_SIZE):
+        entries = []
+        for i in range(batch_start, min(batch_start + TAPE_BATCH_SIZE, tape_size)):
+            request = HttpRequest(requestline=f'GET /item/{i} HTTP/1.1', method='GET', path=f'/item/{i}',
+                                  headers={}, content=b'', client_addr='127.0.0.1', client_port=0,
+                                  timestamp=time.time())
+            response = HttpResponse(status_code=200, content=body, headers={
+                'Content-Type': 'application/octet-stream',
+                'Content-Length': str(body_size),
+            })
+            entries.append((default_request_hash(request), CacheEntry(request, response)))
+        tape.append(entries)
+    tape.compact()
+
+
+def wait_for_port(port: int, timeout: float, process: Optional[subprocess.Popen] = None):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'process exited with code {process.returncode} before listening')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.01)
+    raise TimeoutError(f'port {port} is not listening after {timeout}s')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def process_memory(pid: int) -> Tuple[Optional[int], Optional[int]]:
+    """Current and peak resident memory of a process in kB (Linux only)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None, None
+    return int(status['VmRSS'].split()[0]), int(status['VmHWM'].split()[0])
+
+
+def percentile_ms(sorted_values: List[float], percent: float) -> float:
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, max(0, int(round(percent / 100 * len(sorted_values))) - 1))
+    return round(sorted_values[index] * 1000, 3)
+
+
+def environment_info() -> Dict[str, Optional[str]]:
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                           stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'revision': revision,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': str(os.cpu_count()),
+    }
+
+
+def compare_results(baseline_file: str, report: dict):
+    """Log relative change of throughput and latency against results of a previous run"""
+    with open(baseline_file) as f:
+        baseline = {result['scenario']: result for result in json.load(f)['results']}
+    for result in report['results']:
+        old = baseline.get(result['scenario'])
+        if old is None:
+            continue
+        log.info('Compared to baseline', scenario=result['scenario'],
+                 rps=relative_change(old['requests_per_second'], result['requests_per_second']),
+                 p50=relative_change(old['latency_p50_ms'], result['latency_p50_ms']),
+                 p99=relative_change(old['latency_p99_ms'], result['latency_p99_ms']),
+                 startup=relative_change(old['startup_seconds'], result['startup_seconds']),
+                 rss=relative_change(old['rss_kb'], result['rss_kb']))
+
+
+def relative_change(old: Optional[float], new: Optional[float]) -> str:
+    if not old or new is None:
+        return '-'
+    return f'{(new - old) / old * 100:+.1f}%'
+
+
+def parse_list(value: str, item_type: type) -> list:
+    return [item_type(item.strip()) for item in value.split(',') if item.strip()]
+
+
+def main():
+    CliBuilder('xman-benchmark', run=run_benchmarks,
+               help='Measure throughput & latency of xman in pass-through, record and replay modes').has(
+        parameter('modes', help=f'comma-separated modes to benchmark: {", ".join(MODES)}',
+                  default=','.join(MODES)),
+        parameter('body_sizes', help='comma-separated sizes of response bodies in bytes', default='100,10000,1000000'),
+        parameter('tape_sizes', help='comma-separated numbers of entries in replayed tapes', default='1000,100000'),
+        parameter('tape_format', help='format of replayed tapes', choices=['json', 'xtape'], strict_choices=True,
+                  default='json'),
+        parameter('max_tape_bytes', help='skip replay scenarios with larger total size of bodies on tape',
+                  type=int, default=256 * 1024 * 1024),
+        parameter('clients', help='number of concurrent clients', type=int, default=8),
+        parameter('requests_per_client', help='number of requests sent by every client', type=int, default=500),
+        parameter('engine', help='xman proxy engine', default='sync'),
+        parameter('server_mode', help='xman server mode', default='threaded'),
+        parameter('workers', help='number of xman worker threads or processes', type=int, default=8),
+        parameter('keep_alive', help='keep client connections open', type=boolean, default=True),
+        parameter('output', help='JSON file to save results to', default='bench_results.json'),
+        parameter('compare', help='JSON file with results of a previous run to compare with'),
+    ).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,19 @@ from xman.cache import sorted_dict_trait
 from xman.config import Config
 from xman.request import HttpRequest
 from xman.response import HttpResponse
+from xman.routing import RouteTable
+
+routes = RouteTable()
+routes.add('GET', '/health', respond=HttpResponse(status_code=200, headers={}, content=b'OK'))
+routes.add('*', '/users/{id}/avatar', dst_url='http://127.0.0.1:8001', cacheable=False)
+
+
+@routes.route('GET', '/items/{id}')
+def item_responder(request: HttpRequest) -> Optional[HttpResponse]:
+    """Returns immediate response for requests matching the route, params are taken from the path"""
+    item_id = routes.match(request).params['id']
+    return HttpResponse(status_code=200, headers={'Content-Type': 'application/json'},
+                        content=f'{{"id": "{item_id}"}}'.encode())
 
 
 def transform_request(request: HttpRequest) -> HttpRequest:
@@ -57,5 +70,50 @@ def override_config(config: Config):
     # config.replay_clear_cache = False
     # config.replay_clear_cache_seconds = 60
     # config.allow_chunking = True
+    # config.chunk_size = 0
+    # config.compression = True
+    # config.compression_min_size = 1024
+    # config.compression_offload_size = 65536
     # config.proxy_timeout = 10
+    # config.accept_queue_size = 64
+    # config.keep_alive = False
+    # config.keep_alive_timeout = 5
+    # config.keep_alive_max_requests = 100
+    # config.streaming = False
+    # config.stream_buffer_size = 65536
+    # config.stream_spool_size = 16777216
+    # config.upstream_pool_size = 10
+    # config.upstream_max_connections = 10
+    # config.upstream_idle_timeout = 60
+    # config.tape_index = True
+    # config.tape_background_load = False
+    # config.record_async = True
+    # config.record_batch_size = 100
+    # config.record_queue_size = 10000
+    # config.record_fsync = 'never'
+    # config.record_fsync_interval = 1.0
+    # config.cache_max_entries = 0
+    # config.cache_max_bytes = 0
+    # config.cache_eviction = 'lru'
+    # config.cache_backend = ''
+    # config.cache_backend_batch_size = 100
+    # config.cache_spill = False
+    # config.coalesce_requests = False
+    # config.coalesce_timeout = 10
+    # config.rate_limit = 0
+    # config.rate_limit_burst = 10
+    # config.rate_limit_by = 'client'
+    # config.upstream_rate_limit = 0
+    # config.upstream_rate_limit_burst = 10
+    # config.upstream_balancing = 'round-robin'
+    # config.upstream_retries = 1
+    # config.upstream_retry_budget = 0.2
+    # config.upstream_eject_failures = 5
+    # config.upstream_eject_seconds = 30
+    # config.upstream_health_path = ''
+    # config.upstream_health_interval = 10
+    # config.mock_dir = ''
+    # config.mock_sendfile_size = 1048576
+    # config.metrics_path = ''
+    # config.metrics_port = 0
     config.verbose = 0
@@ -24,11 +24,12 @@ setuptools.setup(
     ],
     install_requires=install_requires,
     license='MIT',
-    python_requires='>=3.6.0',
+    python_requires='>=3.7.0',
     entry_points={
         "console_scripts": [
             "xman = xman:main",
             "x-man = xman:main",
+            "xman-tape = xman.convert:main",
         ],
     },
 )
@@ -0,0 +1,215 @@
+import asyncio
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import requests
+
+from xman import async_engine
+from xman.async_engine import AsyncProxyServer
+from xman.async_proxy import AsyncConnectionPool, async_proxy_request
+from xman.cache import RequestCache
+from xman.config import Config
+from xman.extension import Extensions
+from xman.request import HttpRequest
+from xman.response import HttpResponse
+from tests.test_server import body_responder, assert_head_has_no_body
+
+
+class StubUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    calls = 0
+
+    def do_GET(self):
+        StubUpstreamHandler.calls += 1
+        body = f'upstream {self.path}'.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def immediate_responder(request: HttpRequest) -> Optional[HttpResponse]:
+    if request.path == '/immediate':
+        return HttpResponse(status_code=200, headers={}).set_content('immediate')
+    return None
+
+
+def test_async_engine_proxy_and_replay():
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), StubUpstreamHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+
+    config = Config(listen_port=0, listen_ssl=False, record_file='', replay=True, engine='asyncio',
+                    dst_url=f'http://127.0.0.1:{upstream.server_address[1]}')
+    extensions = Extensions(immediate_responder=immediate_responder)
+    server = AsyncProxyServer(config, extensions, RequestCache(extensions, config))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.started.wait(5)
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+    try:
+        with requests.Session() as session:
+            response = session.get(f'{url}/some/path')
+            assert response.status_code == 200
+            assert response.text == 'upstream /some/path'
+
+            response = session.get(f'{url}/some/path')
+            assert response.text == 'upstream /some/path'
+            assert StubUpstreamHandler.calls == 1
+
+            response = session.get(f'{url}/immediate')
+            assert response.text == 'immediate'
+    finally:
+        server.shutdown()
+        thread.join(5)
+        server.server_close()
+        upstream.shutdown()
+        upstream.server_close()
+
+
+def test_async_engine_upstream_failed():
+    config = Config(listen_port=0, listen_ssl=False, record_file='', engine='asyncio', timeout=1,
+                    dst_url='http://127.0.0.1:1')
+    extensions = Extensions()
+    server = AsyncProxyServer(config, extensions, RequestCache(extensions, config))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.started.wait(5)
+    try:
+        response = requests.get(f'http://127.0.0.1:{server.server_address[1]}/')
+        assert response.status_code == 502
+        assert 'Proxying failed' in response.text
+    finally:
+        server.shutdown()
+        thread.join(5)
+        server.server_close()
+
+
+def test_async_engine_queries_cache_backend_off_the_event_loop():
+    config = Config(listen_port=0, listen_ssl=False, record_file='', replay=True, engine='asyncio', timeout=1,
+                    dst_url='http://127.0.0.1:1', cache_backend='memory://')
+    extensions = Extensions()
+    cache = RequestCache(extensions, config)
+    lookup_threads = []
+    original_get = cache.backend_reader.get
+
+    def get(key: bytes) -> Optional[bytes]:
+        lookup_threads.append(threading.current_thread())
+        return original_get(key)
+
+    cache.backend_reader.get = get
+    server = AsyncProxyServer(config, extensions, cache)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.started.wait(5)
+    try:
+        requests.get(f'http://127.0.0.1:{server.server_address[1]}/')
+        assert lookup_threads and thread not in lookup_threads
+    finally:
+        server.shutdown()
+        thread.join(5)
+        server.server_close()
+
+
+def test_async_engine_compresses_large_responses_off_the_event_loop(monkeypatch):
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), StubUpstreamHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    config = Config(listen_port=0, listen_ssl=False, record_file='', engine='asyncio', compression_min_size=1,
+                    compression_offload_size=1, dst_url=f'http://127.0.0.1:{upstream.server_address[1]}')
+    compression_threads = []
+    original_encoded_response = async_engine.encoded_response
+
+    def encoded_response(response: HttpResponse, encoding: str) -> HttpResponse:
+        compression_threads.append(threading.current_thread())
+        return original_encoded_response(response, encoding)
+
+    monkeypatch.setattr(async_engine, 'encoded_response', encoded_response)
+    extensions = Extensions()
+    server = AsyncProxyServer(config, extensions, RequestCache(extensions, config))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.started.wait(5)
+    try:
+        response = requests.get(f'http://127.0.0.1:{server.server_address[1]}/compressed',
+                                headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.text == 'upstream /compressed'
+        assert compression_threads and thread not in compression_threads
+    finally:
+        server.shutdown()
+        thread.join(5)
+        server.server_close()
+        upstream.shutdown()
+        upstream.server_close()
+
+
+class DroppingSecondRequestHandler(socketserver.StreamRequestHandler):
+    """Answers the first request on a connection, then closes it once the next one arrives"""
+    methods = []
+
+    def handle(self):
+        for index in range(2):
+            request_line = self.rfile.readline()
+            if not request_line:
+                return
+            length = 0
+            for line in iter(self.rfile.readline, b'\r\n'):
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':', 1)[1])
+            self.rfile.read(length)
+            DroppingSecondRequestHandler.methods.append(request_line.split()[0])
+            if index == 0:
+                self.wfile.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+
+
+def test_request_on_stale_upstream_connection_retried_only_if_idempotent():
+    DroppingSecondRequestHandler.methods = []
+    upstream = socketserver.ThreadingTCPServer(('127.0.0.1', 0), DroppingSecondRequestHandler)
+    upstream.daemon_threads = True
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    dst_url = f'http://127.0.0.1:{upstream.server_address[1]}'
+
+    def request(method: str) -> HttpRequest:
+        return HttpRequest(requestline=f'{method} /', method=method, path='/', content=b'x', headers={},
+                           client_addr='127.0.0.1', client_port=9999, timestamp=0)
+
+    async def exchange(method: str):
+        pool = AsyncConnectionPool()
+        first = await async_proxy_request(request(method), dst_url, 1, 0, pool)
+        second = await async_proxy_request(request(method), dst_url, 1, 0, pool)
+        await pool.close()
+        return first.status_code, second.status_code
+
+    try:
+        assert asyncio.run(exchange('GET')) == (200, 200)
+        assert DroppingSecondRequestHandler.methods == [b'GET'] * 3
+        DroppingSecondRequestHandler.methods = []
+        assert asyncio.run(exchange('POST')) == (200, 502)
+        assert DroppingSecondRequestHandler.methods == [b'POST'] * 2
+    finally:
+        upstream.shutdown()
+        upstream.server_close()
+
+
+def test_async_engine_keep_alive_head_request_followed_by_get():
+    config = Config(listen_port=0, listen_ssl=False, record_file='', replay=True, engine='asyncio')
+    extensions = Extensions(immediate_responder=body_responder, cache_request_traits=lambda request: request.path)
+    cache = RequestCache(extensions, config)
+    request = HttpRequest(requestline='GET /cached HTTP/1.1', method='GET', path='/cached', headers={},
+                          content=b'', client_addr='127.0.0.1', client_port=1, timestamp=1)
+    cache.save_response(request, HttpResponse(status_code=200, headers={}).set_content('bodybody'))
+    server = AsyncProxyServer(config, extensions, cache)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.started.wait(5)
+    try:
+        assert_head_has_no_body(server.server_address[1])
+    finally:
+        server.shutdown()
+        thread.join(5)
+        server.server_close()
@@ -0,0 +1,104 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from xman.balancer import UpstreamPool, parse_upstream_urls
+from xman.proxy import proxy_request, SessionPool
+from xman.request import HttpRequest
+from xman.response import HttpResponse
+
+
+class NamedHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    name = b''
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.name)))
+        self.end_headers()
+        self.wfile.write(self.name)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _request(path: str = '/', method: str = 'GET') -> HttpRequest:
+    return HttpRequest(requestline=f'{method} {path}', method=method, path=path, content=b'', headers={},
+                       client_addr='127.0.0.1', client_port=9999, timestamp=0)
+
+
+def _failure() -> HttpResponse:
+    return HttpResponse(status_code=502, headers={'X-Man-Error': 'proxying failed'})
+
+
+def test_parse_upstream_urls():
+    assert parse_upstream_urls('http://a:80, http://b:80/,') == ['http://a:80', 'http://b:80']
+
+
+def test_round_robin_and_least_requests():
+    pool = UpstreamPool(['http://a', 'http://b', 'http://c'])
+    chosen = [pool.choose(_request(), []).url for _ in range(6)]
+    assert sorted(chosen) == ['http://a', 'http://a', 'http://b', 'http://b', 'http://c', 'http://c']
+
+    pool = UpstreamPool(['http://a', 'http://b'], strategy='least-requests')
+    busy = pool.choose(_request(), [])
+    pool.begin(busy)
+    assert pool.choose(_request(), []) is not busy
+
+
+def test_hash_keeps_requests_on_the_same_upstream():
+    pool = UpstreamPool(['http://a', 'http://b', 'http://c'], strategy='hash',
+                        request_key=lambda request: request.path.encode())
+    chosen = {path: pool.choose(_request(path), []).url for path in [f'/item/{i}' for i in range(50)]}
+    assert len(set(chosen.values())) == 3
+    assert all(pool.choose(_request(path), []).url == url for path, url in chosen.items())
+
+    # ejecting an upstream moves only its own requests
+    ejected = pool.upstreams[0]
+    ejected.ejected_until = float('inf')
+    for path, url in chosen.items():
+        if url != ejected.url:
+            assert pool.choose(_request(path), []).url == url
+
+
+def test_upstream_ejected_after_consecutive_failures():
+    pool = UpstreamPool(['http://a', 'http://b'], eject_failures=2, eject_seconds=60)
+    upstream = pool.upstreams[0]
+    for _ in range(2):
+        pool.begin(upstream)
+        assert pool.end(upstream, _failure())
+    assert upstream.ejections == 1
+    assert all(pool.choose(_request(), []) is pool.upstreams[1] for _ in range(4))
+    assert pool.stats()['available'] == 1
+
+    # all upstreams ejected, balancing between them anyway
+    pool.upstreams[1].ejected_until = upstream.ejected_until
+    assert pool.choose(_request(), []) in pool.upstreams
+
+
+def test_retry_budget_and_idempotency():
+    pool = UpstreamPool(['http://a', 'http://b'], max_retries=1, retry_budget=0)
+    pool.budget.min_retries = 1
+    assert not pool.should_retry(_request(method='POST'), 1)
+    assert not pool.should_retry(_request(), 2)
+    assert pool.should_retry(_request(), 1)
+    assert not pool.should_retry(_request(), 1)
+    assert pool.budget.denied == 1
+
+
+def test_failed_request_retried_on_another_upstream():
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), type('Handler', (NamedHandler,), {'name': b'up'}))
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    live_url = f'http://127.0.0.1:{upstream.server_address[1]}'
+    pool = UpstreamPool(['http://127.0.0.1:1', live_url], eject_failures=1)
+    session_pool = SessionPool()
+    try:
+        for _ in range(3):
+            response = proxy_request(_request(), default_url='', timeout=1, verbose=0, session_pool=session_pool,
+                                     upstreams=pool)
+            assert response.status_code == 200
+            assert response.content == b'up'
+        assert pool.upstreams[0].ejections == 1
+    finally:
+        session_pool.close()
+        upstream.shutdown()
+        upstream.server_close()
@@ -0,0 +1,86 @@
+import zlib
+from pathlib import Path
+
+from xman.binary_tape import LazyCacheEntry, BinaryTape, HEADER, MAGIC, RECORD_HEADER, RECORD_HEADERS, \
+    serialize_record
+from xman.cache import RequestCache, default_request_hash, default_request_traits, DEFAULT_KEY_TAG
+from xman.config import Config
+from xman.convert import convert_tape
+from xman.entry import CacheEntry
+from xman.extension import Extensions
+from xman.request import HttpRequest
+from xman.response import HttpResponse
+from tests.test_cache import request1, response1, request2, response2
+
+
+def _clean(*paths: str):
+    for path in paths:
+        if Path(path).exists():
+            Path(path).unlink()
+
+
+def test_convert_json_tape_to_binary_and_back():
+    _clean('tests/res/tape_converted.xtape', 'tests/res/tape_converted.jsonl')
+    assert convert_tape('tests/res/tape_read.json', 'tests/res/tape_converted.xtape') == 2
+    assert Path('tests/res/tape_converted.xtape').read_bytes().startswith(b'XMANTAPE')
+
+    cache = RequestCache(Extensions(), Config(record_file='tests/res/tape_converted.xtape', replay=True))
+    assert len(cache.cache) == 2
+    assert all(isinstance(entry, LazyCacheEntry) for entry in cache.cache.values())
+    assert cache.find_cached_response(request1) == response1
+    assert cache.find_cached_response(request2) == response2
+
+    assert convert_tape('tests/res/tape_converted.xtape', 'tests/res/tape_converted.jsonl') == 2
+    assert Path('tests/res/tape_converted.jsonl').read_text() == Path('tests/res/tape_read.jsonl').read_text()
+    _clean('tests/res/tape_converted.xtape', 'tests/res/tape_converted.jsonl')
+
+
+def test_binary_tape_appending_and_indexing():
+    _clean('tests/res/tape_save.xtape')
+    cache = RequestCache(Extensions(), Config(record_file='tests/res/tape_save.xtape', record=True, replay=True))
+    cache.save_response(request1, response1)
+    cache.close()
+    index_size = Path('tests/res/tape_save.xtape').stat().st_size
+
+    cache = RequestCache(Extensions(), Config(record_file='tests/res/tape_save.xtape', record=True, replay=True))
+    cache.save_response(request2, response2)
+    cache.flush()
+    cache.tape.append([(default_request_hash(request1), cache.cache[default_request_hash(request1)])])
+    with open('tests/res/tape_save.xtape', 'ab') as f:
+        f.write(b'\x01\x02\x03')  # incomplete record
+
+    tape = BinaryTape('tests/res/tape_save.xtape', default_request_hash, DEFAULT_KEY_TAG)
+    assert len(tape.load()) == 3
+    assert tape.torn_records == 1
+
+    cache.close()
+    assert Path('tests/res/tape_save.xtape').stat().st_size > index_size
+    cache = RequestCache(Extensions(), Config(record_file='tests/res/tape_save.xtape', replay=True))
+    assert len(cache.cache) == 2
+    assert cache.find_cached_response(request1) == response1
+    assert cache.find_cached_response(request2) == response2
+    _clean('tests/res/tape_save.xtape')
+
+
+def test_loading_binary_tape_version_1():
+    _clean('tests/res/tape_save.xtape')
+    records = b''.join(_v1_record(request, response)
+                       for request, response in [(request1, response1), (request2, response2)])
+    Path('tests/res/tape_save.xtape').write_bytes(HEADER.pack(MAGIC, 1, b'adler32', 0, 0) + records)
+
+    cache = RequestCache(Extensions(), Config(record_file='tests/res/tape_save.xtape', record=True, replay=True))
+    assert cache.find_cached_response(request1) == response1
+    assert cache.find_cached_response(request2) == response2
+    assert HEADER.unpack_from(Path('tests/res/tape_save.xtape').read_bytes())[1] == 2
+
+    cache = RequestCache(Extensions(), Config(record_file='tests/res/tape_save.xtape', replay=True))
+    assert len(cache.cache) == 2
+    assert cache.find_cached_response(request2) == response2
+    _clean('tests/res/tape_save.xtape')
+
+
+def _v1_record(request: HttpRequest, response: HttpResponse) -> bytes:
+    serialized = serialize_record(bytes(16), CacheEntry(request, response))
+    lengths = RECORD_HEADER.unpack_from(serialized)[1:]
+    adler32_hash = zlib.adler32(str(default_request_traits(request)).encode())
+    return RECORD_HEADERS[1].pack(adler32_hash, *lengths) + serialized[RECORD_HEADER.size:]
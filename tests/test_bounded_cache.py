@@ -0,0 +1,108 @@
+from dataclasses import replace
+from pathlib import Path
+
+from xman.bounded_cache import BoundedCache
+from xman.cache import RequestCache
+from xman.config import Config
+from xman.extension import Extensions
+from tests.test_cache import request1, response1, request2, response2
+
+
+def test_lru_eviction():
+    evicted = []
+    cache = BoundedCache(max_entries=2, policy='lru', on_evict=lambda key, value: evicted.append(key))
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache['a'] == 1
+    cache['c'] = 3
+    assert evicted == ['b']
+    assert list(cache) == ['a', 'c']
+    assert cache.evictions == 1
+
+
+def test_lfu_eviction():
+    cache = BoundedCache(max_entries=2, policy='lfu')
+    cache['a'] = 1
+    cache['b'] = 2
+    for _ in range(3):
+        assert cache['b'] == 2
+    assert cache['a'] == 1
+    cache['c'] = 3
+    assert sorted(cache) == ['b', 'c']
+    cache['d'] = 4
+    assert sorted(cache) == ['b', 'd']
+
+
+def test_fifo_eviction_by_bytes():
+    cache = BoundedCache(max_bytes=10, policy='fifo', sizeof=len)
+    cache['a'] = 'xxxx'
+    cache['b'] = 'yyyy'
+    assert cache['a'] == 'xxxx'
+    cache['c'] = 'zzzz'
+    assert list(cache) == ['b', 'c']
+    assert cache.total_bytes == 8
+    del cache['b']
+    assert cache.total_bytes == 4
+
+
+def test_ttl_eviction_by_timestamp():
+    timestamps = {'a': 30, 'b': 10, 'c': 20}
+    cache = BoundedCache(max_entries=2, policy='ttl',
+                         oldest_key=lambda: min(cache, key=timestamps.get))
+    cache['a'] = 1
+    cache['b'] = 2
+    cache['c'] = 3
+    assert sorted(cache) == ['a', 'c']
+
+
+def test_request_cache_evicts_the_oldest_recorded_entry():
+    cache = RequestCache(Extensions(), Config(record_file='', replay=True, cache_max_entries=2,
+                                              cache_eviction='ttl'))
+    old_request = replace(request2, path='/old', timestamp=request1.timestamp - 60)
+    cache.save_response(request1, response1)
+    cache.save_response(old_request, response2)
+    assert cache.find_cached_response(old_request) == response2
+    cache.save_response(request2, response2)
+    assert cache.find_cached_response(old_request) is None
+    assert cache.find_cached_response(request1) == response1
+    assert cache.find_cached_response(request2) == response2
+
+
+def test_evicted_entries_spill_to_tape():
+    record_file = 'tests/res/tape_save.json'
+    if Path(record_file).exists():
+        Path(record_file).unlink()
+    cache = RequestCache(Extensions(), Config(record_file=record_file, replay=True, cache_max_entries=1,
+                                              cache_spill=True))
+    cache.save_response(request1, response1)
+    cache.save_response(request2, response2)
+    assert cache.find_cached_response(request1) == response1
+    assert cache.find_cached_response(request2) == response2
+    assert cache.stats() == {'entries': 1, 'bytes': cache.cache.total_bytes, 'hits': 2, 'misses': 0,
+                             'evictions': 3, 'spilled': 2, 'faulted': 2}
+    cache.flush()
+
+    cache = RequestCache(Extensions(), Config(record_file=record_file, replay=True))
+    assert cache.find_cached_response(request1) == response1
+
+
+def test_evicted_entries_read_back_from_tape(tmp_path):
+    for record_file, tape_index in [('tape.json', True), ('tape.json', False), ('tape.xtape', False)]:
+        record_file = str(tmp_path / f'{tape_index}_{record_file}')
+        cache = RequestCache(Extensions(), Config(record_file=record_file, record=True, replay=True,
+                                                  tape_index=tape_index, cache_max_entries=1))
+        cache.save_response(request1, response1)
+        cache.save_response(request2, response2)
+        assert cache.evicted == {cache.request_fingerprint(request1)}
+        assert cache.find_cached_response(request1) == response1
+        assert cache.find_cached_response(request2) == response2
+        assert cache.find_cached_response(request1) == response1
+        cache.close()
+
+        cache = RequestCache(Extensions(), Config(record_file=record_file, replay=True, tape_index=tape_index,
+                                                  cache_max_entries=1))
+        assert len(cache.cache) == 1 and len(cache.evicted) == 1
+        assert cache.find_cached_response(request1) == response1
+        assert cache.find_cached_response(request2) == response2
+        assert cache.stats()['faulted'] == 2
+        assert cache.stats()['misses'] == 0
@@ -1,9 +1,11 @@
 import os
+from dataclasses import replace
 from pathlib import Path
 
-from xman.cache import RequestCache
+from xman.cache import RequestCache, default_request_traits, now_seconds
 from xman.config import Config
 from xman.extension import Extensions
+from xman.fingerprint import fingerprint
 from xman.request import HttpRequest
 from xman.response import HttpResponse
 
@@ -67,6 +69,25 @@ def test_clear_cache():
     assert len(cache.cache) == 0
 
 
+def test_expired_entries_are_misses_until_cleared():
+    cache = RequestCache(Extensions(), Config(
+        record_file='tests/res/tape_empty.json',
+        replay=True,
+        replay_clear_cache=True,
+        replay_clear_cache_seconds=10,
+    ))
+    cache.save_response(replace(request1, timestamp=now_seconds() - 20), response1)
+    cache.save_response(replace(request2, timestamp=now_seconds()), response2)
+    assert len(cache.cache) == 2
+    assert cache.find_cached_response(request1) is None
+    assert cache.find_cached_response(request2) == response2
+
+    cache.clear_old()
+    assert len(cache.cache) == 1
+    assert len(cache.expiry_heap) == 1
+    assert cache.find_cached_response(request2) == response2
+
+
 def test_clear_cache_but_disabled():
     cache = RequestCache(Extensions(), Config(
         record_file='tests/res/tape_read.json',
@@ -104,7 +125,8 @@ def test_replay_disabled():
 
 
 def test_save_new():
-    Path('tests/res/tape_save.json').unlink()
+    if Path('tests/res/tape_save.json').exists():
+        Path('tests/res/tape_save.json').unlink()
     cache = RequestCache(Extensions(), Config(
         record_file='tests/res/tape_save.json',
         record=True,
@@ -115,7 +137,46 @@ def test_save_new():
     cache.save_response(request1, response1)
     assert cache.saving_enabled(request2, response2)
     cache.save_response(request2, response2)
+    cache.flush()
 
     saved = Path('tests/res/tape_save.json').read_text()
-    expected = Path('tests/res/tape_read.json').read_text()
+    expected = Path('tests/res/tape_read.jsonl').read_text()
     assert saved == expected
+
+
+def test_loading_journal_cache():
+    cache = RequestCache(Extensions(), Config(
+        record_file='tests/res/tape_read.jsonl',
+        replay=True,
+    ))
+
+    assert len(cache.cache) == 2
+    assert cache.replay_response(request1) == response1
+    assert cache.replay_response(request2) == response2
+
+
+def test_append_to_legacy_tape_and_compact():
+    Path('tests/res/tape_save.json').write_text(Path('tests/res/tape_read.json').read_text())
+    cache = RequestCache(Extensions(), Config(
+        record_file='tests/res/tape_save.json',
+        record=True,
+    ))
+    assert len(cache.cache) == 2
+    assert Path('tests/res/tape_save.json').read_text() == Path('tests/res/tape_read.jsonl').read_text()
+
+    duplicated_entry = list(cache.cache.items())[0]
+    cache.tape.append([duplicated_entry])
+    assert len(Path('tests/res/tape_save.json').read_text().splitlines()) == 3
+
+    cache.close()
+    assert Path('tests/res/tape_save.json').read_text() == Path('tests/res/tape_read.jsonl').read_text()
+
+
+def test_fingerprint_collision_is_not_replayed():
+    cache = RequestCache(Extensions(), Config(record_file='tests/res/tape_read.json', replay=True))
+    assert fingerprint(('a', b'bc')) != fingerprint(('ab', b'c'))
+    hash1 = fingerprint(default_request_traits(request1))
+    hash2 = fingerprint(default_request_traits(request2))
+    cache.cache[hash1] = cache.cache[hash2]
+    assert cache.find_cached_response(request1) is None
+    assert cache.find_cached_response(request2) == response2
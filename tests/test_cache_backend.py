@@ -0,0 +1,137 @@
+import socketserver
+import threading
+import time
+from typing import Dict, List
+
+import pytest
+
+from xman.cache import RequestCache
+from xman.cache_backend import BatchedReader, CacheBackend, MemoryBackend, RespBackend, open_backend, encode_command, \
+    read_reply
+from xman.config import Config
+from xman.extension import Extensions
+from tests.test_cache import request1, response1, request2, response2
+
+
+class RespStandInHandler(socketserver.StreamRequestHandler):
+    """Stand-in for a Redis server, supporting the commands used by the cache backend"""
+    store: Dict[bytes, bytes] = {}
+    commands: List[bytes] = []
+
+    def handle(self):
+        while True:
+            try:
+                args = read_reply(self.rfile)
+            except ConnectionError:
+                return
+            self.commands.append(args[0])
+            self.wfile.write(self.execute(args))
+
+    def execute(self, args: List[bytes]) -> bytes:
+        if args[0] == b'MGET':
+            values = [self.store.get(key) for key in args[1:]]
+            return b'*%d\r\n' % len(values) + b''.join(
+                b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value) for value in values)
+        if args[0] == b'SET' and args[3:] == [b'NX']:
+            if args[1] in self.store:
+                return b'$-1\r\n'
+            self.store[args[1]] = args[2]
+            return b'+OK\r\n'
+        if args[0] == b'SELECT':
+            return b'+OK\r\n'
+        return b'-ERR unknown command\r\n'
+
+
+def _start_resp_server() -> socketserver.ThreadingTCPServer:
+    RespStandInHandler.store = {}
+    RespStandInHandler.commands = []
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), RespStandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _replica(cache_backend: str) -> RequestCache:
+    return RequestCache(Extensions(), Config(record_file='', replay=True, cache_backend=cache_backend))
+
+
+def test_replicas_share_sqlite_backend(tmp_path):
+    url = f'sqlite:///{tmp_path}/cache.db'
+    replica1, replica2 = _replica(url), _replica(url)
+    replica1.save_response(request1, response1)
+    replica1.flush()
+    assert replica2.find_cached_response(request1) == response1
+    assert replica2.stats()['shared_hits'] == 1
+    # found in memory from now on
+    assert replica2.find_cached_response(request1) == response1
+    assert replica2.stats()['shared_hits'] == 1
+    assert replica2.find_cached_response(request2) is None
+    replica1.close()
+    replica2.close()
+
+
+def test_first_recorded_entry_wins(tmp_path):
+    backend = open_backend(f'sqlite:///{tmp_path}/cache.db')
+    backend.add_many([(b'key', b'first')])
+    backend.add_many([(b'key', b'second'), (b'other', b'value')])
+    assert backend.get_many([b'key', b'other', b'missing']) == {b'key': b'first', b'other': b'value'}
+
+
+def test_resp_backend_with_stand_in_server():
+    server = _start_resp_server()
+    url = f'redis://127.0.0.1:{server.server_address[1]}/1'
+    try:
+        replica1, replica2 = _replica(url), _replica(url)
+        replica1.save_response(request1, response1)
+        replica1.save_response(request2, response2)
+        replica1.flush()
+        assert RespStandInHandler.commands.count(b'SET') == 2
+        assert replica2.find_cached_response(request2) == response2
+        assert replica2.find_cached_response(request1) == response1
+        assert all(key.startswith(b'xman:') for key in RespStandInHandler.store)
+        replica1.close()
+        replica2.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_backend_failure_is_a_miss():
+    cache = _replica('redis://127.0.0.1:1')
+    assert cache.find_cached_response(request1) is None
+    cache.close()
+
+
+def test_concurrent_lookups_fetched_in_batches():
+    class SlowBackend(MemoryBackend):
+        def get_many(self, keys):
+            time.sleep(0.05)
+            return super().get_many(keys)
+
+    backend = SlowBackend()
+    backend.add_many([(b'%d' % i, b'value') for i in range(10)])
+    reader = BatchedReader(backend, batch_size=100)
+    results = {}
+    threads = [threading.Thread(target=lambda i=i: results.update({i: reader.get(b'%d' % (i % 12))}))
+               for i in range(24)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(results[i] == (b'value' if i % 12 < 10 else None) for i in range(24))
+    assert reader.batches < 24
+
+
+def test_encode_command():
+    assert encode_command([b'GET', b'key']) == b'*2\r\n$3\r\nGET\r\n$3\r\nkey\r\n'
+    assert isinstance(open_backend('memory://'), MemoryBackend)
+    assert isinstance(open_backend('redis://host:6380/2'), RespBackend)
+
+
+def test_incomplete_backend_fails_when_constructed():
+    class ReadOnlyBackend(CacheBackend):
+        def get_many(self, keys):
+            return {}
+
+    with pytest.raises(TypeError):
+        ReadOnlyBackend()
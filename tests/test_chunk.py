@@ -0,0 +1,39 @@
+import io
+import socket
+import threading
+
+from xman.chunk import send_chunked_response, send_chunked_stream, read_chunked_content, adaptive_chunk_size, \
+    MIN_CHUNK_SIZE, MAX_CHUNK_SIZE
+
+
+def test_chunked_response_to_file():
+    out = io.BytesIO()
+    send_chunked_response(out, b'abcdefgh', chunk_size=3)
+    assert out.getvalue() == b'3\r\nabc\r\n3\r\ndef\r\n2\r\ngh\r\n0\r\n\r\n'
+
+
+def test_chunked_stream_splits_large_blocks():
+    out = io.BytesIO()
+    send_chunked_stream(out, iter([b'abcde', b'', b'f']), chunk_size=4)
+    assert out.getvalue() == b'4\r\nabcd\r\n1\r\ne\r\n1\r\nf\r\n0\r\n\r\n'
+
+
+def test_adaptive_chunk_size():
+    assert adaptive_chunk_size(100) == MIN_CHUNK_SIZE
+    assert adaptive_chunk_size(16 * 256 * 1024) == 256 * 1024
+    assert adaptive_chunk_size(1024 ** 3) == MAX_CHUNK_SIZE
+
+
+def test_vectored_send_of_large_body():
+    content = bytes(range(256)) * 40000
+    server, client = socket.socketpair()
+    received = []
+    reader = threading.Thread(target=lambda: received.append(read_chunked_content(client.makefile('rb'))))
+    reader.start()
+    try:
+        send_chunked_response(server, content, chunk_size=1000)
+        reader.join(timeout=10)
+        assert received == [content]
+    finally:
+        server.close()
+        client.close()
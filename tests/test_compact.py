@@ -0,0 +1,67 @@
+import json
+
+from xman.cache import RequestCache
+from xman.compact import CompactEntry, StringPool
+from xman.config import Config
+from xman.entry import CacheEntry, serialize_cache_entry
+from xman.extension import Extensions
+from xman.header import Headers
+from xman.request import HttpRequest
+from xman.response import HttpResponse
+
+
+def _entry(path: str) -> CacheEntry:
+    request = HttpRequest(requestline=f'GET {path} HTTP/1.1', method='GET', path=path, content=b'',
+                          headers={'Host': 'localhost', 'Accept': '*/*'},
+                          client_addr='127.0.0.1', client_port=41696, timestamp=100.5)
+    response = HttpResponse(status_code=200, headers=Headers([('Content-Type', 'text/plain'),
+                                                              ('Set-Cookie', 'a=1'), ('Set-Cookie', 'b=2')]),
+                            content=path.encode())
+    return CacheEntry(request, response)
+
+
+def test_compact_entry_rebuilds_request_and_response():
+    compact = CompactEntry(_entry('/items'), StringPool())
+    request, response = compact.request, compact.response
+    assert request.method == 'GET'
+    assert request.path == '/items'
+    assert request.timestamp == 100.5
+    assert request.headers['host'] == 'localhost'
+    assert response.status_code == 200
+    assert response.headers.get_all('Set-Cookie') == ['a=1', 'b=2']
+    assert response.content == b'/items'
+    assert compact.encoded is compact.encoded
+
+
+def test_header_strings_are_shared_between_entries():
+    pool = StringPool()
+    first = CompactEntry(_entry('/a'), pool)
+    second = CompactEntry(_entry('/b'), pool)
+    assert first.response_headers[0][1] is second.response_headers[0][1]
+    assert first.request_headers[0][0] is second.request_headers[0][0]
+
+
+def test_string_pool_stops_growing_at_max_size():
+    pool = StringPool(max_size=2)
+    for value in ['a', 'b', 'c', 'd']:
+        assert pool.intern(value) == value
+    assert len(pool.strings) == 2
+
+
+def test_cache_keeps_recorded_entries_compact():
+    cache = RequestCache(Extensions(), Config(record=False, replay=True))
+    entry = _entry('/compact')
+    cache.save_response(entry.request, entry.response)
+    assert isinstance(next(iter(cache.cache.values())), CompactEntry)
+
+    replayed = cache.replay_response(entry.request)
+    assert replayed is not None
+    assert replayed.content == b'/compact'
+    assert replayed.headers.get_all('Set-Cookie') == ['a=1', 'b=2']
+
+
+def test_compact_entry_is_serialized_like_full_one():
+    compact = CompactEntry(_entry('/spill'), StringPool())
+    data = json.loads(serialize_cache_entry(compact))
+    assert HttpRequest.from_json(data['request']).path == '/spill'
+    assert HttpResponse.from_json(data['response']).headers.get_all('Set-Cookie') == ['a=1', 'b=2']
@@ -0,0 +1,86 @@
+import gzip
+import json
+
+import requests
+
+from xman.cache import RequestCache
+from xman.compression import negotiate_encoding, compressed_response
+from xman.config import Config
+from xman.extension import Extensions
+from xman.handler import normalize_response_headers
+from xman.request import HttpRequest
+from xman.response import HttpResponse
+from tests.test_server import start_server
+
+json_content = json.dumps([{'id': i, 'name': 'item'} for i in range(100)]).encode()
+
+
+def json_response() -> HttpResponse:
+    return HttpResponse(status_code=200, content=json_content, headers={
+        'Content-Type': 'application/json',
+        'Content-Length': str(len(json_content)),
+        'ETag': '"v1"',
+    })
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding('gzip, deflate') == 'gzip'
+    assert negotiate_encoding('deflate, gzip;q=0.5') == 'deflate'
+    assert negotiate_encoding('gzip;q=0, deflate;q=0') is None
+    assert negotiate_encoding('identity') is None
+    assert negotiate_encoding('*') is not None
+
+
+def test_compressed_response_headers():
+    response = compressed_response(json_response(), 'gzip', min_size=1024)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Content-Length'] == str(len(response.content))
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert response.headers['ETag'] == 'W/"v1"'
+    assert gzip.decompress(response.content) == json_content
+
+
+def test_not_worth_compressing():
+    small = HttpResponse(status_code=200, headers={'Content-Type': 'application/json'}, content=b'{}')
+    assert compressed_response(small, 'gzip', min_size=1024) is small
+    image = HttpResponse(status_code=200, headers={'Content-Type': 'image/png'}, content=b'\x89PNG' * 1000)
+    assert compressed_response(image, 'gzip', min_size=1024) is image
+    response = json_response()
+    assert compressed_response(response, '', min_size=1024) is response
+
+
+def test_cached_response_compressed_once():
+    cache = RequestCache(Extensions(), Config(record_file='', replay=True))
+    request = HttpRequest(requestline='GET /items HTTP/1.1', method='GET', path='/items', headers={},
+                          content=b'', client_addr='127.0.0.1', client_port=1, timestamp=1)
+    cache.save_response(request, json_response())
+    first = compressed_response(cache.find_cached_response(request), 'gzip', min_size=1024)
+    second = compressed_response(cache.find_cached_response(request), 'gzip', min_size=1024)
+    assert first.content is second.content
+    assert cache.find_cached_response(request).content == json_content
+
+
+def test_decoded_content_length_fixed():
+    response = HttpResponse(status_code=200, content=json_content, headers={
+        'content-encoding': 'gzip',
+        'content-length': '120',
+    })
+    normalize_response_headers(response, verbose=0)
+    assert response.headers == {'content-length': str(len(json_content))}
+
+
+def test_proxy_serves_compressed_response():
+    config = Config(listen_port=0, listen_ssl=False, record_file='', server_mode='threaded')
+    httpd = start_server(config, Extensions(immediate_responder=lambda request: json_response()))
+    url = f'http://127.0.0.1:{httpd.server_address[1]}/'
+    try:
+        response = requests.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert int(response.headers['Content-Length']) < len(json_content)
+        assert response.content == json_content
+        identity = requests.get(url, headers={'Accept-Encoding': 'identity'})
+        assert 'Content-Encoding' not in identity.headers
+        assert identity.content == json_content
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
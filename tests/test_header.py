@@ -0,0 +1,79 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from xman.config import Config
+from xman.entry import CacheEntry, serialize_cache_entry
+from xman.extension import Extensions
+from xman.header import Headers, get_header, has_header
+from xman.response import HttpResponse
+from tests.test_cache import request1
+from tests.test_server import start_server
+
+
+def test_case_insensitive_lookup():
+    headers = Headers({'Content-Type': 'application/json'})
+    assert headers['content-type'] == 'application/json'
+    assert 'CONTENT-TYPE' in headers
+    assert get_header(headers, 'content-Type', '') == 'application/json'
+    assert not has_header(headers, 'Content-Length')
+    headers['content-type'] = 'text/plain'
+    assert list(headers.items()) == [('Content-Type', 'text/plain')]
+    del headers['CONTENT-TYPE']
+    assert len(headers) == 0
+
+
+def test_repeated_headers_kept():
+    headers = Headers([('Set-Cookie', 'a=1'), ('set-cookie', 'b=2'), ('Vary', 'Accept')])
+    assert headers.get_all('Set-Cookie') == ['a=1', 'b=2']
+    assert headers['Set-Cookie'] == 'a=1, b=2'
+    assert headers.multi_items() == [('Set-Cookie', 'a=1'), ('Set-Cookie', 'b=2'), ('Vary', 'Accept')]
+    assert headers.marshal() == {'Set-Cookie': 'a=1, b=2', 'Vary': 'Accept'}
+    assert headers.marshal_repeated() == {'Set-Cookie': ['a=1', 'b=2']}
+
+
+def test_tape_serialization_shape():
+    response = HttpResponse(status_code=200, headers={'Content-Type': 'text/plain'}, content=b'ok')
+    response.headers.add('Set-Cookie', 'a=1')
+    response.headers.add('Set-Cookie', 'b=2')
+    data = json.loads(serialize_cache_entry(CacheEntry(request1, response)))
+    assert data['request']['headers'] == dict(request1.headers)
+    assert 'repeated_headers' not in data['request']
+    assert data['response']['headers'] == {'Content-Type': 'text/plain', 'Set-Cookie': 'a=1, b=2'}
+    assert data['response']['repeated_headers'] == {'Set-Cookie': ['a=1', 'b=2']}
+    loaded = CacheEntry.from_json(data)
+    assert loaded.response.headers.get_all('set-cookie') == ['a=1', 'b=2']
+    assert loaded == CacheEntry(request1, response)
+
+
+class CookiesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'a=1; Path=/')
+        self.send_header('Set-Cookie', 'b=2; Expires=Wed, 21 Oct 2026 07:28:00 GMT')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_repeated_headers_proxied():
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), CookiesHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    config = Config(listen_port=0, listen_ssl=False, record_file='', server_mode='threaded',
+                    dst_url=f'http://127.0.0.1:{upstream.server_address[1]}')
+    httpd = start_server(config, Extensions())
+    try:
+        response = requests.get(f'http://127.0.0.1:{httpd.server_address[1]}/')
+        assert response.raw.headers.getlist('Set-Cookie') == [
+            'a=1; Path=/', 'b=2; Expires=Wed, 21 Oct 2026 07:28:00 GMT']
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        upstream.shutdown()
+        upstream.server_close()
@@ -0,0 +1,59 @@
+import requests
+
+from xman.config import Config
+from xman.extension import Extensions
+from xman.handler import RequestHandler
+from xman.metrics import Histogram, Metrics
+from tests.test_server import start_server, client_port_responder
+
+
+def test_histogram_buckets():
+    histogram = Histogram(bounds=(0.1, 1))
+    for value in [0.05, 0.1, 0.5, 3]:
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.count == 4
+
+
+def test_render_prometheus_format():
+    metrics = Metrics()
+    metrics.observe('proxy', 0.002)
+    metrics.inc('replayed')
+    metrics.upstream_response(200, failed=False)
+    metrics.upstream_response(502, failed=True)
+    metrics.add_gauge_source('cache', lambda: {'entries': 3})
+    text = metrics.render()
+    assert 'xman_stage_duration_seconds_bucket{stage="proxy",le="0.0025"} 1' in text
+    assert 'xman_stage_duration_seconds_bucket{stage="proxy",le="+Inf"} 1' in text
+    assert 'xman_stage_duration_seconds_count{stage="proxy"} 1' in text
+    assert 'xman_replayed_total 1' in text
+    assert 'xman_upstream_errors_total 1' in text
+    assert 'xman_upstream_responses_total{status="200"} 1' in text
+    assert 'xman_cache_entries 3' in text
+
+
+def test_disabled_metrics_are_not_collected():
+    metrics = Metrics(enabled=False)
+    with metrics.timer('total'):
+        metrics.inc('requests')
+    assert metrics.stages['total'].count == 0
+    assert metrics.counters['requests'] == 0
+
+
+def test_metrics_path_served_by_proxy():
+    config = Config(listen_port=0, listen_ssl=False, record_file='', metrics_path='/__xman/metrics')
+    RequestHandler.metrics = Metrics()
+    httpd = start_server(config, Extensions(immediate_responder=client_port_responder))
+    url = f'http://127.0.0.1:{httpd.server_address[1]}'
+    try:
+        assert requests.get(f'{url}/api').status_code == 200
+        response = requests.get(f'{url}/__xman/metrics')
+        assert response.status_code == 200
+        assert response.headers['Content-Type'].startswith('text/plain')
+        assert 'xman_requests_total 1' in response.text
+        assert 'xman_responses_total{status="200"} 1' in response.text
+        assert 'xman_stage_duration_seconds_count{stage="immediate_responder"} 1' in response.text
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        RequestHandler.metrics = Metrics(enabled=False)
@@ -0,0 +1,110 @@
+import json
+import threading
+from pathlib import Path
+
+import requests
+
+from xman.async_engine import AsyncProxyServer
+from xman.cache import RequestCache
+from xman.config import Config
+from xman.extension import Extensions, apply_routes
+from xman.mock_store import FileBody, MockStore
+from xman.request import HttpRequest
+from xman.routing import RouteTable
+from tests.test_server import start_server
+
+
+def _fixtures(directory: Path) -> Path:
+    (directory / 'api').mkdir()
+    (directory / 'api' / 'status.json').write_text('{"status": "ok"}')
+    (directory / 'user.json').write_text('{"id": "{{id}}", "verbose": "{{ query.verbose }}"}')
+    (directory / 'user.json.meta.json').write_text(json.dumps({
+        'method': 'GET', 'path': '/users/{id}', 'template': True, 'headers': {'X-Mock': 'user'},
+    }))
+    (directory / 'created.txt').write_text('created')
+    (directory / 'created.txt.meta.json').write_text(json.dumps({'method': 'POST', 'path': '/items', 'status': 201}))
+    (directory / 'large.bin').write_bytes(bytes(range(256)) * 1024)
+    return directory
+
+
+def _routes(directory: Path) -> RouteTable:
+    routes = RouteTable()
+    MockStore(str(directory), sendfile_size=64 * 1024).load().register(routes)
+    return routes
+
+
+def _request(method: str, path: str, headers: dict = None) -> HttpRequest:
+    return HttpRequest(requestline=f'{method} {path} HTTP/1.1', method=method, path=path, headers=headers or {},
+                       content=b'', client_addr='127.0.0.1', client_port=41696, timestamp=0)
+
+
+def test_fixtures_are_served_with_precomputed_headers(tmp_path: Path):
+    ext = apply_routes(Extensions(routes=_routes(_fixtures(tmp_path))))
+
+    response = ext.immediate_responder(_request('GET', '/api/status.json'))
+    assert response.status_code == 200
+    assert response.content == b'{"status": "ok"}'
+    assert response.headers['Content-Type'] == 'application/json'
+    assert response.headers['Content-Length'] == '16'
+    assert response.headers['ETag'].startswith('"')
+
+    response = ext.immediate_responder(_request('POST', '/items'))
+    assert response.status_code == 201
+    assert response.headers['Content-Type'] == 'text/plain'
+
+    response = ext.immediate_responder(_request('GET', '/large.bin'))
+    assert isinstance(response.stream, FileBody)
+    assert response.headers['Content-Length'] == str(256 * 1024)
+    assert b''.join(response.stream) == bytes(range(256)) * 1024
+
+    assert ext.immediate_responder(_request('GET', '/missing')) is None
+
+
+def test_templates_are_filled_with_route_params(tmp_path: Path):
+    ext = apply_routes(Extensions(routes=_routes(_fixtures(tmp_path))))
+    response = ext.immediate_responder(_request('GET', '/users/42?verbose=1'))
+    assert response.content == b'{"id": "42", "verbose": "1"}'
+    assert response.headers['Content-Length'] == str(len(response.content))
+    assert response.headers['X-Mock'] == 'user'
+
+
+def test_matching_etag_returns_not_modified(tmp_path: Path):
+    ext = apply_routes(Extensions(routes=_routes(_fixtures(tmp_path))))
+    etag = ext.immediate_responder(_request('GET', '/api/status.json')).headers['ETag']
+
+    response = ext.immediate_responder(_request('GET', '/api/status.json', {'If-None-Match': f'"other", W/{etag}'}))
+    assert response.status_code == 304
+    assert response.content == b''
+    assert response.headers['ETag'] == etag
+    assert 'Content-Length' not in response.headers
+
+    response = ext.immediate_responder(_request('GET', '/api/status.json', {'If-None-Match': '"other"'}))
+    assert response.status_code == 200
+
+
+def test_large_fixture_sent_from_file_by_both_engines(tmp_path: Path):
+    routes = _routes(_fixtures(tmp_path))
+    config = Config(listen_port=0, listen_ssl=False, record_file='', server_mode='threaded')
+    httpd = start_server(config, apply_routes(Extensions(routes=routes)))
+    try:
+        response = requests.get(f'http://127.0.0.1:{httpd.server_address[1]}/large.bin')
+        assert response.content == bytes(range(256)) * 1024
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    config = Config(listen_port=0, listen_ssl=False, record_file='', engine='asyncio')
+    extensions = apply_routes(Extensions(routes=routes))
+    server = AsyncProxyServer(config, extensions, RequestCache(extensions, config))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.started.wait(5)
+    try:
+        response = requests.get(f'http://127.0.0.1:{server.server_address[1]}/large.bin')
+        assert response.content == bytes(range(256)) * 1024
+        response = requests.get(f'http://127.0.0.1:{server.server_address[1]}/users/7')
+        assert response.json()['id'] == '7'
+    finally:
+        server.shutdown()
+        thread.join(5)
+        server.server_close()
@@ -1,7 +1,34 @@
-from xman.proxy import proxy_request
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from xman.proxy import proxy_request, SessionPool
 from xman.request import HttpRequest
 
 
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    client_ports = []
+
+    def do_GET(self):
+        self.client_ports.append(self.client_address[1])
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ClosingHandler(KeepAliveHandler):
+    """Upstream closing the connection after every response"""
+
+    def end_headers(self):
+        self.send_header('Connection', 'close')
+        super().end_headers()
+
+
 def test_proxy_failed():
     request = HttpRequest(
         requestline='GET /',
@@ -16,3 +43,79 @@ def test_proxy_failed():
     response = proxy_request(request, default_url='0.0.0.1:9999', timeout=1, verbose=2)
     assert response.status_code == 502
     assert 'Proxying failed' in response.content.decode()
+
+
+def test_proxy_reuses_upstream_connections():
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    dst_url = f'http://127.0.0.1:{upstream.server_address[1]}'
+    request = HttpRequest(requestline='GET /', method='GET', path='/', content=b'', headers={},
+                          client_addr='127.0.0.1', client_port=9999, timestamp=0)
+    session_pool = SessionPool()
+    try:
+        for _ in range(3):
+            response = proxy_request(request, default_url=dst_url, timeout=1, verbose=0, session_pool=session_pool)
+            assert response.status_code == 200
+            assert response.content == b'ok'
+
+        stats = session_pool.stats()
+        assert stats['sessions'] == 1
+        assert stats['session_misses'] == 1
+        assert stats['session_hits'] == 2
+        assert stats['connection_misses'] == 1
+        assert stats['connection_hits'] == 2
+    finally:
+        session_pool.close()
+        upstream.shutdown()
+        upstream.server_close()
+
+
+def test_client_connection_headers_are_not_forwarded():
+    KeepAliveHandler.client_ports = []
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    dst_url = f'http://127.0.0.1:{upstream.server_address[1]}'
+    request = HttpRequest(requestline='GET /', method='GET', path='/', content=b'',
+                          headers={'Connection': 'close', 'Keep-Alive': 'timeout=5', 'TE': 'trailers'},
+                          client_addr='127.0.0.1', client_port=9999, timestamp=0)
+    session_pool = SessionPool()
+    try:
+        for _ in range(3):
+            assert proxy_request(request, default_url=dst_url, timeout=1, verbose=0,
+                                 session_pool=session_pool).status_code == 200
+        assert len(set(KeepAliveHandler.client_ports)) == 1
+        assert session_pool.stats()['connection_misses'] == 1
+    finally:
+        session_pool.close()
+        upstream.shutdown()
+        upstream.server_close()
+
+
+def test_connections_closed_by_upstream_are_counted_as_misses():
+    ClosingHandler.client_ports = []
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), ClosingHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    dst_url = f'http://127.0.0.1:{upstream.server_address[1]}'
+    request = HttpRequest(requestline='GET /', method='GET', path='/', content=b'', headers={},
+                          client_addr='127.0.0.1', client_port=9999, timestamp=0)
+    session_pool = SessionPool()
+    try:
+        for _ in range(3):
+            assert proxy_request(request, default_url=dst_url, timeout=1, verbose=0,
+                                 session_pool=session_pool).status_code == 200
+        assert len(set(ClosingHandler.client_ports)) == 3
+        stats = session_pool.stats()
+        assert stats['connection_misses'] == 3
+        assert stats['connection_hits'] == 0
+    finally:
+        session_pool.close()
+        upstream.shutdown()
+        upstream.server_close()
+
+
+def test_idle_sessions_are_closed():
+    session_pool = SessionPool(idle_timeout=60)
+    session_pool.get_session('http://127.0.0.1:1')
+    session_pool.last_used['http://127.0.0.1:1'] -= 61
+    session_pool.get_session('http://127.0.0.1:2')
+    assert list(session_pool.sessions.keys()) == ['http://127.0.0.1:2']
@@ -0,0 +1,53 @@
+import time
+
+from xman.cache import RequestCache
+from xman.config import Config
+from xman.extension import Extensions
+from xman.ratelimit import RateLimiter, rate_limit_key
+from tests.test_cache import request1, response1, request2
+
+
+def test_token_bucket_burst_and_refill():
+    limiter = RateLimiter(rate=10, burst=2)
+    assert limiter.acquire('a') == (True, 0)
+    assert limiter.acquire('a') == (True, 0)
+    granted, retry_after = limiter.acquire('a')
+    assert not granted
+    assert 0 < retry_after <= 0.1
+    assert limiter.acquire('b') == (True, 0)
+    time.sleep(0.11)
+    assert limiter.acquire('a')[0]
+
+
+def test_token_reserved_within_max_delay():
+    limiter = RateLimiter(rate=10, burst=1)
+    assert limiter.acquire('a') == (True, 0)
+    granted, delay = limiter.acquire('a', max_delay=1)
+    assert granted
+    assert 0.05 < delay <= 0.1
+    granted, delay = limiter.acquire('a', max_delay=1)
+    assert granted
+    assert 0.15 < delay <= 0.2
+
+
+def test_rate_limit_keys():
+    assert rate_limit_key(request2, 'client', None) == '127.0.0.1'
+    assert rate_limit_key(request2, 'path', None) == '/auth'
+    assert rate_limit_key(request2, 'global', None) == ''
+    assert rate_limit_key(request2, 'client', lambda request: request.method) == 'POST'
+
+
+def test_replay_throttle_with_rate_limit():
+    cache = RequestCache(Extensions(), Config(record_file='tests/res/tape_read.json', replay=True,
+                                              replay_throttle=True, rate_limit=1, rate_limit_burst=2))
+    assert cache.find_cached_response(request1) == response1
+    assert cache.find_cached_response(request1) == response1
+    throttled = cache.find_cached_response(request1)
+    assert throttled.status_code == 429
+    assert throttled.headers['Retry-After'] == '1'
+
+
+def test_replay_throttle_without_rate_limit():
+    cache = RequestCache(Extensions(), Config(record_file='tests/res/tape_read.json', replay=True,
+                                              replay_throttle=True))
+    assert cache.find_cached_response(request1).status_code == 429
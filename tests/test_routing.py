@@ -0,0 +1,70 @@
+from xman.extension import Extensions, apply_routes
+from xman.request import HttpRequest
+from xman.response import HttpResponse
+from xman.routing import RouteTable
+
+
+def _request(method: str, path: str) -> HttpRequest:
+    return HttpRequest(requestline=f'{method} {path} HTTP/1.1', method=method, path=path, headers={}, content=b'',
+                       client_addr='127.0.0.1', client_port=41696, timestamp=0)
+
+
+def test_literal_segments_take_precedence_over_parameters_and_wildcards():
+    routes = RouteTable()
+    rest = routes.add('*', '/api/*')
+    user = routes.add('GET', '/api/users/{id}')
+    me = routes.add('GET', '/api/users/me')
+    avatar = routes.add('GET', '/api/users/{id}/avatar')
+
+    assert routes.match_path('GET', '/api/users/me').route is me
+    found = routes.match_path('GET', '/api/users/42?size=10')
+    assert found.route is user
+    assert found.params == {'id': '42'}
+    assert routes.match_path('GET', '/api/users/42/avatar').params == {'id': '42'}
+    assert routes.match_path('GET', '/api/users/42/avatar').route is avatar
+    assert routes.match_path('GET', '/api/users/42/friends').route is rest
+    assert routes.match_path('POST', '/api/users/42').route is rest
+    assert routes.match_path('GET', '/other') is None
+
+
+def test_regex_routes_are_matched_in_order_of_registration():
+    routes = RouteTable()
+    items = routes.add('GET', r'/items/(?P<id>\d+)', regex=True)
+    routes.add('GET', r'/items/(?P<id>.+)', regex=True)
+    anything = routes.add('*', r'/(?P<id>.*)', regex=True)
+    exact = routes.add('GET', '/items/special')
+
+    found = routes.match_path('GET', '/items/12')
+    assert found.route is items
+    assert found.params == {'id': '12'}
+    assert routes.match_path('GET', '/items/special').route is exact
+    assert routes.match_path('DELETE', '/items/12').route is anything
+
+
+def test_route_hooks_are_chained_with_global_ones():
+    routes = RouteTable()
+    routes.add('GET', '/health', respond=HttpResponse(status_code=200, headers={}, content=b'OK'))
+    routes.add('*', '/users/*', dst_url='http://127.0.0.1:8001', cacheable=False)
+    routes.add('GET', '/users/{id}/avatar', cacheable=True)
+
+    @routes.route('GET', '/echo/{word}')
+    def echo(request: HttpRequest) -> HttpResponse:
+        return HttpResponse(status_code=200, headers={}, content=routes.match(request).params['word'].encode())
+
+    ext = apply_routes(Extensions(routes=routes, immediate_responder=lambda request: HttpResponse(404, {})))
+    assert ext.transform_response is None
+
+    health = ext.immediate_responder(_request('GET', '/health'))
+    assert health.content == b'OK'
+    health.headers['X-Changed'] = '1'
+    assert 'X-Changed' not in ext.immediate_responder(_request('GET', '/health')).headers
+    assert ext.immediate_responder(_request('GET', '/echo/hello')).content == b'hello'
+    assert ext.immediate_responder(_request('GET', '/missing')).status_code == 404
+
+    assert ext.transform_request(_request('GET', '/users/1')).dst_url == 'http://127.0.0.1:8001'
+    assert ext.transform_request(_request('GET', '/health')).dst_url is None
+
+    response = HttpResponse(status_code=200, headers={})
+    assert not ext.can_be_cached(_request('GET', '/users/1'), response)
+    assert ext.can_be_cached(_request('GET', '/users/1/avatar'), response)
+    assert ext.can_be_cached(_request('GET', '/health'), response)
@@ -0,0 +1,159 @@
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import requests
+
+from xman.cache import RequestCache
+from xman.config import Config
+from xman.extension import Extensions
+from xman.handler import RequestHandler
+from xman.request import HttpRequest
+from xman.response import HttpResponse
+from xman.server import create_server, ThreadPoolTCPServer
+
+
+def slow_responder(request: HttpRequest) -> Optional[HttpResponse]:
+    time.sleep(0.5)
+    return HttpResponse(status_code=200, headers={}).set_content('slow')
+
+
+def client_port_responder(request: HttpRequest) -> Optional[HttpResponse]:
+    return HttpResponse(status_code=200, headers={}).set_content(str(request.client_port))
+
+
+def start_server(config: Config, extensions: Extensions) -> ThreadPoolTCPServer:
+    RequestHandler.extensions = extensions
+    RequestHandler.config = config
+    RequestHandler.cache = RequestCache(extensions, config)
+    httpd = create_server(config, RequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def test_threaded_server_handles_requests_concurrently():
+    config = Config(listen_port=0, listen_ssl=False, record_file='', server_mode='threaded', workers=4)
+    httpd = start_server(config, Extensions(immediate_responder=slow_responder))
+    assert isinstance(httpd, ThreadPoolTCPServer)
+    port = httpd.server_address[1]
+    try:
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            responses = list(executor.map(lambda _: requests.get(f'http://127.0.0.1:{port}/'), range(4)))
+        elapsed = time.time() - start
+        assert [r.text for r in responses] == ['slow'] * 4
+        assert elapsed < 1.5
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_threaded_server_stops_accepting_when_queue_is_full():
+    config = Config(listen_port=0, listen_ssl=False, record_file='', server_mode='threaded', workers=1,
+                    accept_queue_size=1)
+    httpd = start_server(config, Extensions(immediate_responder=slow_responder))
+    port = httpd.server_address[1]
+    try:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(requests.get, f'http://127.0.0.1:{port}/') for _ in range(4)]
+            time.sleep(0.3)
+            assert httpd.executor._work_queue.qsize() <= 1
+            assert [future.result().text for future in futures] == ['slow'] * 4
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_keep_alive_client_connections():
+    config = Config(listen_port=0, listen_ssl=False, record_file='', server_mode='threaded', workers=2,
+                    keep_alive=True, keep_alive_max_requests=3)
+    httpd = start_server(config, Extensions(immediate_responder=client_port_responder))
+    url = f'http://127.0.0.1:{httpd.server_address[1]}/'
+    try:
+        with requests.Session() as session:
+            client_ports = [session.get(url).text for _ in range(4)]
+        assert client_ports[0] == client_ports[1] == client_ports[2]
+        assert client_ports[3] != client_ports[0]
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_keep_alive_disabled():
+    config = Config(listen_port=0, listen_ssl=False, record_file='', server_mode='threaded', workers=2)
+    httpd = start_server(config, Extensions(immediate_responder=client_port_responder))
+    url = f'http://127.0.0.1:{httpd.server_address[1]}/'
+    try:
+        with requests.Session() as session:
+            responses = [session.get(url) for _ in range(2)]
+        assert responses[0].headers['Connection'] == 'close'
+        assert responses[0].text != responses[1].text
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_replayed_response_serialized_once():
+    config = Config(listen_port=0, listen_ssl=False, record_file='', replay=True, server_mode='threaded',
+                    keep_alive=True, keep_alive_max_requests=3)
+    httpd = start_server(config, Extensions(cache_request_traits=lambda request: (request.method, request.path)))
+    request = HttpRequest(requestline='GET /cached HTTP/1.1', method='GET', path='/cached', headers={},
+                          content=b'', client_addr='127.0.0.1', client_port=1, timestamp=1)
+    RequestHandler.cache.save_response(request, HttpResponse(status_code=201, headers={
+        'Content-Type': 'text/plain', 'content-encoding': 'gzip'}).set_content('cached ' * 500))
+    url = f'http://127.0.0.1:{httpd.server_address[1]}/cached'
+    try:
+        with requests.Session() as session:
+            responses = [session.get(url, headers={'Accept-Encoding': encoding})
+                         for encoding in ['identity', 'identity', 'gzip']]
+        assert [r.status_code for r in responses] == [201, 201, 201]
+        assert all(r.text == 'cached ' * 500 for r in responses)
+        assert 'Connection' not in responses[0].headers
+        assert responses[2].headers['Content-Encoding'] == 'gzip'
+        assert responses[2].headers['Connection'] == 'close'
+        entry = next(iter(RequestHandler.cache.cache.values()))
+        assert set(entry.wire_heads) == {None, 'gzip'}
+        assert b'content-encoding' not in entry.wire_heads[None].data
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def body_responder(request: HttpRequest) -> Optional[HttpResponse]:
+    if request.path == '/immediate':
+        return HttpResponse(status_code=200, headers={}).set_content('bodybody')
+    return None
+
+
+def assert_head_has_no_body(port: int):
+    """HEAD response on kept-alive connection mustn't be followed by a body, or it would corrupt the next one"""
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as connection:
+        reader = connection.makefile('rb')
+        for path in ['/immediate', '/cached']:
+            connection.sendall(f'HEAD {path} HTTP/1.1\r\nHost: xman\r\n\r\n'
+                               f'GET {path} HTTP/1.1\r\nHost: xman\r\n\r\n'.encode())
+            for method in ['HEAD', 'GET']:
+                assert reader.readline() == b'HTTP/1.1 200 OK\r\n'
+                headers = []
+                while not headers or headers[-1] != b'\r\n':
+                    headers.append(reader.readline())
+                assert b'Content-Length: 8\r\n' in headers
+                assert b'Connection: close\r\n' not in headers
+            assert reader.read(8) == b'bodybody'
+
+
+def test_keep_alive_head_request_followed_by_get():
+    config = Config(listen_port=0, listen_ssl=False, record_file='', replay=True, server_mode='threaded',
+                    keep_alive=True)
+    httpd = start_server(config, Extensions(immediate_responder=body_responder,
+                                            cache_request_traits=lambda request: request.path))
+    request = HttpRequest(requestline='GET /cached HTTP/1.1', method='GET', path='/cached', headers={},
+                          content=b'', client_addr='127.0.0.1', client_port=1, timestamp=1)
+    RequestHandler.cache.save_response(request, HttpResponse(status_code=200, headers={}).set_content('bodybody'))
+    try:
+        assert_head_has_no_body(httpd.server_address[1])
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
@@ -0,0 +1,52 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from xman.singleflight import SingleFlight, AsyncSingleFlight
+
+
+def test_concurrent_calls_are_coalesced():
+    singleflight = SingleFlight()
+    calls = []
+
+    def slow_call():
+        calls.append(threading.get_ident())
+        time.sleep(0.3)
+        return 'result'
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        results = list(executor.map(lambda _: singleflight.do('key', slow_call, timeout=5), range(5)))
+    assert len(calls) == 1
+    assert [result for result, _ in results] == ['result'] * 5
+    assert sorted(shared for _, shared in results) == [False] + [True] * 4
+    assert singleflight.coalesced == 4
+    assert not singleflight.calls
+
+
+def test_waiting_for_call_times_out():
+    singleflight = SingleFlight()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(singleflight.do, 'key', lambda: time.sleep(0.5) or 'slow', 5)
+        time.sleep(0.1)
+        follower = executor.submit(singleflight.do, 'key', lambda: 'own', 0.1)
+        assert follower.result() == ('own', False)
+        assert leader.result() == ('slow', False)
+
+
+def test_async_concurrent_calls_are_coalesced():
+    singleflight = AsyncSingleFlight()
+    calls = []
+
+    async def slow_call():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return 'result'
+
+    async def run_all():
+        return await asyncio.gather(*[singleflight.do('key', slow_call, timeout=5) for _ in range(5)])
+
+    results = asyncio.run(run_all())
+    assert len(calls) == 1
+    assert [result for result, _ in results] == ['result'] * 5
+    assert singleflight.coalesced == 4
@@ -0,0 +1,179 @@
+import io
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import requests
+
+from xman.cache import RequestCache
+from xman.config import Config
+from xman.extension import Extensions
+from xman.handler import RequestHandler
+from xman.server import create_server
+from xman.stream import BodyStream, ChunkedBodyStream, tee_stream
+
+big_body = bytes(range(256)) * 4096
+
+
+class BigBodyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    uploaded = b''
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(big_body)))
+        self.end_headers()
+        self.wfile.write(big_body)
+
+    def do_POST(self):
+        BigBodyHandler.uploaded = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_body_stream():
+    rfile = io.BytesIO(b'0123456789rest')
+    stream = BodyStream(rfile, 10, buffer_size=4)
+    assert len(stream) == 10
+    assert list(stream) == [b'0123', b'4567', b'89']
+    assert stream.exhausted
+    assert rfile.read() == b'rest'
+
+
+def test_chunked_body_stream():
+    rfile = io.BytesIO(b'6\r\nabcdef\r\n2\r\ngh\r\n0\r\n\r\nrest')
+    stream = ChunkedBodyStream(rfile, buffer_size=4)
+    assert list(stream) == [b'abcd', b'ef', b'gh']
+    assert stream.exhausted
+    assert rfile.read() == b'rest'
+
+
+def test_tee_stream_keeps_copy_up_to_max_size():
+    completed = []
+    stream = tee_stream(iter([b'abc', b'def']), max_size=6, on_complete=completed.append)
+    assert list(stream) == [b'abc', b'def']
+    stream = tee_stream(iter([b'abc', b'def', b'g']), max_size=6, on_complete=completed.append)
+    assert list(stream) == [b'abc', b'def', b'g']
+    assert completed == [b'abcdef', None]
+
+
+def test_streaming_and_recording_large_bodies():
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), BigBodyHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    record_file = 'tests/res/tape_save.xtape'
+    if Path(record_file).exists():
+        Path(record_file).unlink()
+
+    config = Config(listen_port=0, listen_ssl=False, record_file=record_file, record=True, streaming=True,
+                    stream_buffer_size=1024, stream_spool_size=len(big_body), server_mode='threaded',
+                    dst_url=f'http://127.0.0.1:{upstream.server_address[1]}')
+    extensions = Extensions()
+    RequestHandler.extensions = extensions
+    RequestHandler.config = config
+    RequestHandler.cache = RequestCache(extensions, config)
+    httpd = create_server(config, RequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{httpd.server_address[1]}'
+    try:
+        response = requests.get(f'{url}/big')
+        assert response.status_code == 200
+        assert response.content == big_body
+        for _ in range(50):  # entry is saved after the last block is sent
+            if RequestHandler.cache.cache:
+                break
+            time.sleep(0.02)
+        assert len(RequestHandler.cache.cache) == 1
+        assert list(RequestHandler.cache.cache.values())[0].response.content == big_body
+
+        config.stream_spool_size = 4096
+        response = requests.get(f'{url}/too-big')
+        assert response.content == big_body
+        time.sleep(0.2)
+        assert len(RequestHandler.cache.cache) == 1
+
+        config.record = False
+        response = requests.post(f'{url}/upload', data=big_body)
+        assert response.status_code == 201
+        assert BigBodyHandler.uploaded == big_body
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        upstream.shutdown()
+        upstream.server_close()
+    assert RequestCache(extensions, config).cache.popitem()[1].response.content == big_body
+
+
+def test_chunked_upload_is_forwarded_decoded():
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), BigBodyHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    config = Config(listen_port=0, listen_ssl=False, record_file='', replay=True, server_mode='threaded',
+                    dst_url=f'http://127.0.0.1:{upstream.server_address[1]}')
+    extensions = Extensions()
+    RequestHandler.extensions = extensions
+    RequestHandler.config = config
+    RequestHandler.cache = RequestCache(extensions, config)
+    httpd = create_server(config, RequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        response = requests.post(f'http://127.0.0.1:{httpd.server_address[1]}/upload',
+                                 data=iter([b'hello', b' ', b'world']), timeout=5)
+        assert response.status_code == 201
+        assert BigBodyHandler.uploaded == b'hello world'
+        request = next(iter(RequestHandler.cache.cache.values())).request
+        assert 'Transfer-Encoding' not in request.headers
+        assert request.headers['Content-Length'] == '11'
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        upstream.shutdown()
+        upstream.server_close()
+
+
+class SlowUploadHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    uploaded = []
+
+    def do_POST(self):
+        SlowUploadHandler.uploaded.append(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(0.3)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_streamed_uploads_are_not_coalesced():
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), SlowUploadHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    config = Config(listen_port=0, listen_ssl=False, record_file='', streaming=True, stream_buffer_size=1024,
+                    coalesce_requests=True, server_mode='threaded',
+                    dst_url=f'http://127.0.0.1:{upstream.server_address[1]}')
+    # response is buffered for the transformation, request body is still streamed
+    extensions = Extensions(transform_response=lambda request, response: response)
+    RequestHandler.extensions = extensions
+    RequestHandler.config = config
+    RequestHandler.cache = RequestCache(extensions, config)
+    httpd = create_server(config, RequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{httpd.server_address[1]}'
+    bodies = [bytes([i]) * 4096 for i in range(3)]
+    try:
+        threads = [threading.Thread(target=requests.post, args=(f'{url}/upload',), kwargs={'data': body})
+                   for body in bodies]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(SlowUploadHandler.uploaded) == bodies
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        upstream.shutdown()
+        upstream.server_close()
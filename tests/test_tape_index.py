@@ -0,0 +1,127 @@
+import threading
+from pathlib import Path
+
+from xman import tape_index
+from xman.cache import RequestCache, default_request_hash, default_request_traits, DEFAULT_KEY_TAG
+from xman.config import Config
+from xman.entry import CacheEntry, serialize_cache_entry
+from xman.extension import Extensions
+from xman.fingerprint import traits_tag
+from xman.request import HttpRequest
+from xman.response import HttpResponse
+from xman.tape_index import LazyJsonEntry, TapeIndex
+from tests.test_cache import request1, response1, request2, response2
+
+
+def _tape(path: Path, count: int) -> str:
+    lines = []
+    for i in range(count):
+        request = HttpRequest(requestline=f'GET /{i} HTTP/1.1', method='GET', path=f'/{i}', headers={}, content=b'',
+                              client_addr='127.0.0.1', client_port=41696, timestamp=100)
+        response = HttpResponse(status_code=200, headers={'Content-Length': '3'}, content=f'{i:03}'.encode())
+        lines.append(serialize_cache_entry(CacheEntry(request, response)) + '\n')
+    path.write_text(''.join(lines))
+    return str(path)
+
+
+def _request(i: int) -> HttpRequest:
+    return HttpRequest(requestline=f'GET /{i} HTTP/1.1', method='GET', path=f'/{i}', headers={}, content=b'',
+                       client_addr='127.0.0.1', client_port=50000, timestamp=200)
+
+
+def test_index_is_built_and_reused(tmp_path: Path, monkeypatch):
+    tape = Path(_tape(tmp_path / 'tape.jsonl', 10))
+    cache = RequestCache(Extensions(), Config(record_file=str(tape), replay=True))
+    assert len(cache.cache) == 10
+    assert Path(f'{tape}.idx').is_file()
+    assert all(isinstance(entry, LazyJsonEntry) for entry in cache.cache.values())
+    assert cache.find_cached_response(_request(7)).content == b'007'
+
+    def build(self, entry_key):
+        raise AssertionError('valid index should be reused')
+
+    monkeypatch.setattr(TapeIndex, 'build', build)
+    cache = RequestCache(Extensions(), Config(record_file=str(tape), replay=True))
+    assert cache.find_cached_response(_request(3)).content == b'003'
+
+
+def test_stale_index_is_rebuilt_and_compaction_refreshes_it(tmp_path: Path):
+    tape = Path(_tape(tmp_path / 'tape.jsonl', 2))
+    RequestCache(Extensions(), Config(record_file=str(tape), replay=True))
+    with open(tape, 'a') as f:
+        f.write(serialize_cache_entry(CacheEntry(request1, response1)) + '\n')
+    index = TapeIndex(str(tape), DEFAULT_KEY_TAG)
+    assert not index.is_valid()
+
+    cache = RequestCache(Extensions(), Config(record_file=str(tape), record=True, replay=True))
+    assert cache.find_cached_response(request1) == response1
+    cache.save_response(request2, response2)
+    cache.close()
+    assert index.is_valid()
+    assert len(index.read()) == 4
+
+
+def test_index_is_rebuilt_when_traits_function_changes(tmp_path: Path):
+    tape = _tape(tmp_path / 'tape.jsonl', 10)
+
+    def path_traits(request: HttpRequest):
+        return request.path
+
+    def method_and_path_traits(request: HttpRequest):
+        return request.method, request.path
+
+    cache = RequestCache(Extensions(cache_request_traits=path_traits), Config(record_file=tape, replay=True))
+    assert cache.find_cached_response(_request(4)).content == b'004'
+    assert TapeIndex(tape, traits_tag(path_traits)).is_valid()
+    assert not TapeIndex(tape, traits_tag(method_and_path_traits)).is_valid()
+
+    cache = RequestCache(Extensions(cache_request_traits=method_and_path_traits),
+                         Config(record_file=tape, replay=True))
+    assert cache.find_cached_response(_request(4)).content == b'004'
+    assert TapeIndex(tape, traits_tag(method_and_path_traits)).is_valid()
+
+
+def test_traits_tag():
+    assert traits_tag(default_request_traits) == DEFAULT_KEY_TAG
+    assert traits_tag(lambda request: request.path) == traits_tag(lambda request: request.path)
+    assert traits_tag(lambda request: request.path) != traits_tag(lambda request: request.method)
+    assert len(DEFAULT_KEY_TAG) <= 16
+
+
+def test_large_tape_is_indexed_by_several_processes(tmp_path: Path, monkeypatch):
+    tape = _tape(tmp_path / 'tape.jsonl', 200)
+    monkeypatch.setattr(tape_index, 'PARALLEL_MIN_BYTES', 1024)
+    monkeypatch.setattr(tape_index.os, 'cpu_count', lambda: 4)
+    positions, torn = TapeIndex(tape, DEFAULT_KEY_TAG).build(default_request_hash)
+    assert torn == 0
+    assert [key for key, _, _ in positions] == [default_request_hash(_request(i)) for i in range(200)]
+    data = Path(tape).read_bytes()
+    assert all(data[offset + length:offset + length + 1] == b'\n' for _, offset, length in positions)
+
+
+def test_background_loading_lookups_wait_for_it(tmp_path: Path, monkeypatch):
+    tape = _tape(tmp_path / 'tape.jsonl', 50)
+    loading = threading.Event()
+    original_load = RequestCache._load_tape
+
+    def slow_load(self, loaded_cache):
+        loading.wait(5)
+        original_load(self, loaded_cache)
+
+    monkeypatch.setattr(RequestCache, '_load_tape', slow_load)
+    cache = RequestCache(Extensions(), Config(record_file=tape, replay=True, tape_background_load=True))
+    assert not cache.loaded.is_set()
+    loading.set()
+    assert cache.find_cached_response(_request(42)).content == b'042'
+    assert cache.loaded.is_set()
+    cache.close()
+
+
+def test_background_loading_disabled_in_multiprocess_mode(tmp_path: Path):
+    tape = _tape(tmp_path / 'tape.jsonl', 5)
+    cache = RequestCache(Extensions(), Config(record_file=tape, replay=True, tape_background_load=True,
+                                              server_mode='multiprocess'))
+    assert cache.loader is None
+    assert cache.loaded.is_set()
+    assert cache.find_cached_response(_request(3)).content == b'003'
+    cache.close()
@@ -0,0 +1,74 @@
+import threading
+from pathlib import Path
+
+from xman.tape_writer import TapeWriter
+
+
+class SlowTape(object):
+    """Tape recording batches of appended entries, writing only when it's released"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.batches = []
+        self.released = threading.Event()
+        self.failures = 0
+
+    def append(self, entries):
+        self.released.wait()
+        if self.failures:
+            self.failures -= 1
+            raise OSError('disk full')
+        self.batches.append(list(entries))
+
+
+def test_entries_are_written_in_batches(tmp_path: Path):
+    tape = SlowTape(str(tmp_path / 'tape.json'))
+    writer = TapeWriter(tape, batch_size=3)
+    writer.append([(1, 'a')])
+    writer.append([(key, 'b') for key in range(2, 7)])
+    tape.released.set()
+    writer.flush()
+    assert sum(tape.batches, []) == [(1, 'a')] + [(key, 'b') for key in range(2, 7)]
+    assert all(len(batch) <= 3 for batch in tape.batches)
+    assert writer.stats()['written'] == 6
+    assert writer.stats()['pending'] == 0
+    writer.close()
+
+
+def test_full_queue_blocks_recording_until_writer_catches_up(tmp_path: Path):
+    tape = SlowTape(str(tmp_path / 'tape.json'))
+    writer = TapeWriter(tape, batch_size=1, max_pending=2)
+    appending = threading.Thread(target=writer.append, args=([(key, 'entry') for key in range(5)],))
+    appending.start()
+    appending.join(timeout=0.2)
+    assert appending.is_alive()
+
+    tape.released.set()
+    appending.join(timeout=5)
+    assert not appending.is_alive()
+    writer.close()
+    assert len(tape.batches) == 5
+    assert writer.stats()['blocked'] > 0
+
+
+def test_close_writes_pending_entries_and_syncs_them(tmp_path: Path):
+    tape = SlowTape(str(tmp_path / 'tape.json'))
+    tape.released.set()
+    writer = TapeWriter(tape, fsync='batch')
+    writer.append([(1, 'a'), (2, 'b')])
+    writer.close()
+    assert sum(tape.batches, []) == [(1, 'a'), (2, 'b')]
+    assert writer.stats()['fsyncs'] == len(tape.batches)
+
+
+def test_failed_write_doesnt_stop_the_writer(tmp_path: Path):
+    tape = SlowTape(str(tmp_path / 'missing' / 'tape.json'))
+    tape.released.set()
+    tape.failures = 1
+    writer = TapeWriter(tape, fsync='interval', fsync_interval=0)
+    writer.append([(1, 'lost')])
+    writer.flush()
+    writer.append([(2, 'written')])
+    writer.close()
+    assert tape.batches == [[(2, 'written')]]
+    assert writer.stats()['written'] == 1
@@ -0,0 +1,316 @@
+import asyncio
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import responses
+from typing import Optional, Callable, Any, Tuple
+
+from nuclear.sublog import log, wrap_context, logerr
+
+from .async_proxy import AsyncConnectionPool, async_proxy_request, read_headers, read_chunked_body, MAX_LINE_SIZE
+from .balancer import UpstreamPool, upstream_pool
+from .cache import RequestCache, now_seconds
+from .chunk import send_chunked_response
+from .compression import response_encoding, encoded_response, encoded_content
+from .config import Config
+from .extension import Extensions
+from .handler import normalize_response_headers, has_message_framing, CONNECTION_HEADERS, metrics_response, \
+    request_body_size, is_proxy_error, is_fast_replay, wire_head, wire_buffers, set_decoded_body_length, \
+    has_message_body
+from .header import get_header
+from .metrics import Metrics
+from .mock_store import FileBody
+from .request import HttpRequest
+from .ratelimit import RateLimiter, client_rate_limiter, upstream_rate_limiter, rate_limited_response
+from .response import HttpResponse
+from .singleflight import AsyncSingleFlight
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None
+
+ENGINES = ['sync', 'asyncio']
+
+
+class AsyncProxyServer(object):
+    """
+    Proxy engine serving all client connections on a single event loop, with non-blocking upstream I/O.
+    Client connections are kept alive. Synchronous extension hooks are run in a thread pool executor.
+    """
+
+    def __init__(self, config: Config, extensions: Extensions, cache: RequestCache, metrics: Optional[Metrics] = None):
+        self.config: Config = config
+        self.metrics: Metrics = metrics or Metrics(enabled=False)
+        self.extensions: Extensions = extensions
+        self.cache: RequestCache = cache
+        self.pool = AsyncConnectionPool(max_idle_per_host=config.upstream_max_connections,
+                                        idle_timeout=config.upstream_idle_timeout)
+        self.executor = ThreadPoolExecutor(max_workers=config.workers)
+        self.singleflight = AsyncSingleFlight()
+        self.rate_limiter: Optional[RateLimiter] = client_rate_limiter(config)
+        self.upstream_rate_limiter: Optional[RateLimiter] = upstream_rate_limiter(config)
+        self.upstreams: Optional[UpstreamPool] = upstream_pool(config, cache.request_fingerprint)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.server_address: Optional[Tuple[str, int]] = None
+        self.started = threading.Event()
+
+    def serve_forever(self):
+        if uvloop is not None:
+            self.loop = uvloop.new_event_loop()
+        else:
+            self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.set_default_executor(self.executor)
+        self.loop.run_until_complete(self._start())
+        self.started.set()
+        self.loop.run_forever()
+
+    def shutdown(self):
+        """Stop serving, may be called from another thread"""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def server_close(self):
+        if self.loop is None:
+            return
+        if self.server is not None:
+            self.server.close()
+        pending = [task for task in asyncio.all_tasks(self.loop) if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            # gather of nothing would be bound to the caller's default loop, not this one
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        if self.server is not None:
+            self.loop.run_until_complete(self.server.wait_closed())
+        log.info('Upstream connection pool stats', **self.pool.stats())
+        self.loop.run_until_complete(self.pool.close())
+        if self.upstreams is not None:
+            self.upstreams.close()
+        self.loop.close()
+        self.executor.shutdown(wait=True)
+
+    async def _start(self):
+        ssl_context = None
+        if self.config.listen_ssl:
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ssl_context.load_cert_chain(certfile='./dev-cert.pem')
+        self.server = await asyncio.start_server(self.handle_connection, host=self.config.listen_addr or '0.0.0.0',
+                                                 port=self.config.listen_port, ssl=ssl_context,
+                                                 limit=MAX_LINE_SIZE, backlog=1024)
+        self.server_address = self.server.sockets[0].getsockname()[:2]
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info('peername') or ('', 0)
+        try:
+            requests_served = 1
+            idle_timeout = self.config.timeout
+            while await self.handle_request(reader, writer, peer, idle_timeout, requests_served):
+                requests_served += 1
+                idle_timeout = self.config.keep_alive_timeout
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                             peer: Tuple, idle_timeout: float, requests_served: int) -> bool:
+        """Handle single request on a connection. Return whether connection should be kept alive"""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), idle_timeout)
+        except asyncio.TimeoutError:
+            return False
+        if not request_line.strip():
+            return False
+        start = time.perf_counter()
+        with logerr('handling request'):
+            with self.metrics.timer('read_request'):
+                incoming_request, keep_alive = await self.incoming_request(request_line, reader, peer)
+            keep_alive = keep_alive and requests_served < self.config.keep_alive_max_requests
+            if self.config.metrics_path and incoming_request.path == self.config.metrics_path:
+                return await self.respond_to_client(writer, incoming_request, metrics_response(self.metrics),
+                                                    keep_alive, peer)
+            self.metrics.request_received(request_body_size(incoming_request))
+            incoming_request.log(self.config.verbose)
+            response_0 = await self.generate_response(incoming_request)
+            if is_fast_replay(response_0, self.extensions):
+                with self.metrics.timer('write_response'):
+                    keep_alive = await self.respond_from_cache(writer, incoming_request, response_0, keep_alive, peer)
+                self.metrics.client_response(response_0.status_code)
+                self.metrics.observe('total', time.perf_counter() - start)
+                return keep_alive
+            with self.metrics.timer('transform_response'):
+                response = await self.run_hook(self.extensions.transform_response, response_0.transform,
+                                               self.extensions.transform_response, incoming_request)
+            if response != response_0 and self.config.verbose >= 2:
+                response.log('response transformed', self.config.verbose)
+            with self.metrics.timer('write_response'):
+                keep_alive = await self.respond_to_client(writer, incoming_request, response, keep_alive, peer)
+            self.metrics.client_response(response.status_code)
+            self.metrics.observe('total', time.perf_counter() - start)
+            return keep_alive
+        return False
+
+    async def incoming_request(self, request_line: bytes, reader: asyncio.StreamReader,
+                               peer: Tuple) -> Tuple[HttpRequest, bool]:
+        with wrap_context('building incoming request'):
+            requestline = request_line.decode('latin-1').rstrip('\r\n')
+            method, path, version = requestline.split(' ', 2)
+            headers = await asyncio.wait_for(read_headers(reader), self.config.timeout)
+            if 'chunked' in headers.get('transfer-encoding', '').lower():
+                content = await asyncio.wait_for(read_chunked_body(reader), self.config.timeout)
+                set_decoded_body_length(headers, content)
+            else:
+                content_len = int(headers.get('content-length', '0') or '0')
+                content = await asyncio.wait_for(reader.readexactly(content_len), self.config.timeout) \
+                    if content_len else b''
+            connection = headers.get('connection', '').lower()
+            if version == 'HTTP/1.1':
+                keep_alive = connection != 'close'
+            else:
+                keep_alive = connection == 'keep-alive'
+            request = HttpRequest(requestline=requestline, method=method.upper(), path=path,
+                                  headers=headers, content=content,
+                                  client_addr=peer[0], client_port=peer[1], timestamp=now_seconds())
+            return request, keep_alive
+
+    async def generate_response(self, request_0: HttpRequest) -> HttpResponse:
+        with wrap_context('generating response'):
+            with self.metrics.timer('transform_request'):
+                request = await self.run_hook(self.extensions.transform_request, request_0.transform,
+                                              self.extensions.transform_request)
+            if request != request_0 and self.config.verbose >= 2:
+                log.debug('request transformed')
+
+            limited_response = await self.run_hook(self.extensions.rate_limit_key, rate_limited_response,
+                                                   self.rate_limiter, request, self.config.rate_limit_by,
+                                                   self.extensions.rate_limit_key)
+            if limited_response is not None:
+                self.metrics.inc('rate_limited')
+                return limited_response.log('> rate limit exceeded', self.config.verbose)
+
+            if self.extensions.immediate_responder is not None:
+                with self.metrics.timer('immediate_responder'):
+                    immediate_reponse = await self.run_hook(self.extensions.immediate_responder,
+                                                            self.extensions.immediate_responder, request)
+                if immediate_reponse:
+                    return immediate_reponse.log('> immediate response', self.config.verbose)
+
+            with self.metrics.timer('cache_lookup'):
+                self.cache.clear_old()
+                # lookup waiting for the tape loaded in background or querying cache backend mustn't block the loop
+                blocking = self.extensions.can_be_cached or self.extensions.cache_request_traits \
+                    or not self.cache.loaded.is_set() or self.cache.backend_reader is not None \
+                    or bool(self.cache.evicted)
+                cached_response = await self.run_hook(blocking, self.cache.find_cached_response, request)
+            if cached_response is not None:
+                self.metrics.inc('replayed')
+                return cached_response.log('> Cache: returning cached response', self.config.verbose)
+
+            if self.config.replay and self.config.verbose:
+                log.warn('request not found in cache', path=request.path)
+            if not self.config.coalesce_requests:
+                return await self.fetch_response(request)
+
+            request_fingerprint = await self.run_hook(self.extensions.cache_request_traits,
+                                                      self.cache.request_fingerprint, request)
+            response, shared = await self.singleflight.do(request_fingerprint, lambda: self.fetch_response(request),
+                                                          self.config.coalesce_timeout)
+            if shared and self.config.verbose:
+                log.debug('> response shared with identical request in flight', path=request.path)
+            return response.copy()
+
+    async def fetch_response(self, request: HttpRequest) -> HttpResponse:
+        """Proxy request to upstream and save the response to cache"""
+        with self.metrics.timer('proxy'):
+            response: HttpResponse = await async_proxy_request(request, default_url=self.config.dst_url,
+                                                               timeout=self.config.timeout,
+                                                               verbose=self.config.verbose, pool=self.pool,
+                                                               rate_limiter=self.upstream_rate_limiter,
+                                                               upstreams=self.upstreams)
+        self.metrics.upstream_response(response.status_code, failed=is_proxy_error(response))
+
+        if self.config.record or self.config.replay:
+            await self.loop.run_in_executor(None, self._save_response, request, response)
+
+        return response
+
+    def _save_response(self, request: HttpRequest, response: HttpResponse):
+        if self.cache.saving_enabled(request, response):
+            self.cache.save_response(request, response)
+
+    async def run_hook(self, hook: Any, func: Callable, *args) -> Any:
+        """Run synchronous code in executor only if it involves extension hook (or may block otherwise)"""
+        if not hook:
+            return func(*args)
+        return await self.loop.run_in_executor(None, func, *args)
+
+    def compression_blocks(self, response: HttpResponse, encoding: str) -> bool:
+        """Compressing large content (not compressed before) would hold up the event loop for too long"""
+        return len(response.content) >= self.config.compression_offload_size and \
+            (response.encoded is None or encoding not in response.encoded)
+
+    async def respond_to_client(self, writer: asyncio.StreamWriter, request: HttpRequest, response: HttpResponse,
+                                keep_alive: bool, peer: Tuple) -> bool:
+        with wrap_context('responding to client'):
+            normalize_response_headers(response, self.config.verbose)
+            if self.config.compression:
+                encoding = response_encoding(response, get_header(request.headers, 'Accept-Encoding', ''),
+                                             self.config.compression_min_size)
+                if encoding is not None:
+                    response = await self.run_hook(self.compression_blocks(response, encoding), encoded_response,
+                                                   response, encoding)
+            chunked = self.config.allow_chunking and response.headers.get('Transfer-Encoding') == 'chunked'
+            keep_alive = keep_alive and has_message_framing(request.method, response, self.config.allow_chunking)
+
+            lines = [f'HTTP/1.1 {response.status_code} {responses.get(response.status_code, "")}']
+            for name, value in response.headers.multi_items():
+                if name.lower() not in CONNECTION_HEADERS:
+                    lines.append(f'{name}: {value}')
+            if not keep_alive:
+                lines.append('Connection: close')
+            head = '\r\n'.join(lines) + '\r\n\r\n'
+            writer.write(head.encode('latin-1'))
+
+            if not has_message_body(request.method, response):
+                pass  # headers describe the body that isn't sent
+            elif isinstance(response.stream, FileBody):
+                await writer.drain()
+                with open(response.stream.path, 'rb') as f:
+                    await self.loop.sendfile(writer.transport, f, 0, response.stream.size)
+                self.metrics.inc('bytes_out', response.stream.size)
+            elif chunked:
+                send_chunked_response(writer, response.content, self.config.chunk_size)
+                self.metrics.inc('bytes_out', len(response.content))
+            else:
+                writer.write(response.content)
+                self.metrics.inc('bytes_out', len(response.content))
+            await writer.drain()
+            if self.config.verbose >= 2:
+                log.debug('> response sent', client_addr=peer[0], client_port=peer[1])
+            return keep_alive
+
+    async def respond_from_cache(self, writer: asyncio.StreamWriter, request: HttpRequest, response: HttpResponse,
+                                 keep_alive: bool, peer: Tuple) -> bool:
+        """Send cached response with its status line & headers serialized once, in a single write"""
+        with wrap_context('responding to client'):
+            encoding = None
+            if self.config.compression:
+                encoding = response_encoding(response, get_header(request.headers, 'Accept-Encoding', ''),
+                                             self.config.compression_min_size)
+            head = wire_head(response, encoding, self.config)
+            keep_alive = keep_alive and (head.framed or request.method == 'HEAD')
+            content = response.content
+            if encoding is not None:
+                content = await self.run_hook(self.compression_blocks(response, encoding), encoded_content,
+                                              response, encoding)
+            with_body = has_message_body(request.method, response)
+            writer.writelines(wire_buffers(head, content, keep_alive, self.config.chunk_size, with_body))
+            if with_body:
+                self.metrics.inc('bytes_out', len(content))
+            await writer.drain()
+            if self.config.verbose >= 2:
+                log.debug('> response sent', client_addr=peer[0], client_port=peer[1])
+            return keep_alive
@@ -0,0 +1,228 @@
+import asyncio
+import ssl
+import time
+import zlib
+from typing import Dict, List, Tuple, Optional
+from urllib.parse import urlsplit
+
+from nuclear.sublog import log, wrap_context, logerr
+
+from .balancer import Upstream, UpstreamPool, IDEMPOTENT_METHODS
+from .header import Headers
+from .proxy import bad_gateway_response, HOP_BY_HOP_HEADERS
+from .ratelimit import RateLimiter, too_many_requests
+from .request import HttpRequest
+from .response import HttpResponse
+
+MAX_LINE_SIZE = 64 * 1024
+
+Destination = Tuple[str, str, int]
+Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+class AsyncConnectionPool(object):
+    """Idle keep-alive connections to upstream servers, grouped by destination"""
+
+    def __init__(self, max_idle_per_host: int = 10, idle_timeout: float = 60):
+        self.max_idle_per_host: int = max_idle_per_host
+        self.idle_timeout: float = idle_timeout
+        self.idle: Dict[Destination, List[Tuple[Connection, float]]] = {}
+        self.connection_hits: int = 0
+        self.connection_misses: int = 0
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+
+    async def acquire(self, destination: Destination) -> Tuple[Connection, bool]:
+        """Get idle connection or open a new one. Returns connection and flag whether it was reused"""
+        idle = self.idle.get(destination)
+        now = time.monotonic()
+        while idle:
+            (reader, writer), released_at = idle.pop()
+            if not writer.is_closing() and not reader.at_eof() and now - released_at <= self.idle_timeout:
+                self.connection_hits += 1
+                return (reader, writer), True
+            writer.close()
+        self.connection_misses += 1
+        return await self.connect(destination), False
+
+    async def connect(self, destination: Destination) -> Connection:
+        scheme, host, port = destination
+        ssl_context = self.ssl_context if scheme == 'https' else None
+        return await asyncio.open_connection(host, port, ssl=ssl_context, limit=MAX_LINE_SIZE)
+
+    def release(self, destination: Destination, connection: Connection):
+        idle = self.idle.setdefault(destination, [])
+        if len(idle) >= self.max_idle_per_host:
+            connection[1].close()
+            return
+        idle.append((connection, time.monotonic()))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'connection_hits': self.connection_hits,
+            'connection_misses': self.connection_misses,
+        }
+
+    async def close(self):
+        writers = [writer for connections in self.idle.values() for (_, writer), _ in connections]
+        self.idle = {}
+        for writer in writers:
+            writer.close()
+        for writer in writers:
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, ssl.SSLError):
+                pass
+
+
+async def async_proxy_request(request: HttpRequest, default_url: str, timeout: int, verbose: int,
+                              pool: AsyncConnectionPool, rate_limiter: Optional[RateLimiter] = None,
+                              upstreams: Optional[UpstreamPool] = None) -> HttpResponse:
+    if request.dst_url or upstreams is None:
+        return await _proxy_to(request, request.dst_url or default_url, timeout, verbose, pool, rate_limiter)
+    upstreams.budget.record_request()
+    tried: List[Upstream] = []
+    while True:
+        upstream = upstreams.choose(request, tried)
+        tried.append(upstream)
+        upstreams.begin(upstream)
+        response = await _proxy_to(request, upstream.url, timeout, verbose, pool, rate_limiter)
+        if not upstreams.end(upstream, response) or not upstreams.should_retry(request, len(tried)):
+            return response
+        log.warn('Retrying request on another upstream', dst_url=upstream.url, status=response.status_code)
+
+
+async def _proxy_to(request: HttpRequest, dst_url: str, timeout: int, verbose: int, pool: AsyncConnectionPool,
+                    rate_limiter: Optional[RateLimiter]) -> HttpResponse:
+    if rate_limiter is not None:
+        granted, delay = rate_limiter.acquire(dst_url, max_delay=timeout)
+        if not granted:
+            log.warn('Upstream rate limit exceeded', dst_url=dst_url, retry_after=delay)
+            return too_many_requests(delay)
+        if delay > 0:
+            await asyncio.sleep(delay)
+    with logerr():
+        with wrap_context('proxying to URL', dst_url=dst_url, path=request.path, content=request.content):
+            url = f'{dst_url}{request.path}'
+            if verbose:
+                log.debug(f'>> proxying to', url=url)
+            http_response = await asyncio.wait_for(_exchange(request, dst_url, pool), timeout)
+            return http_response.log('<< received', verbose)
+
+    return bad_gateway_response(dst_url)
+
+
+async def _exchange(request: HttpRequest, dst_url: str, pool: AsyncConnectionPool) -> HttpResponse:
+    split = urlsplit(dst_url)
+    scheme = split.scheme or 'http'
+    port = split.port or (443 if scheme == 'https' else 80)
+    destination = (scheme, split.hostname, port)
+    path_prefix = split.path.rstrip('/')
+    raw_request = _serialize_request(request, f'{path_prefix}{request.path}')
+
+    connection, reused = await pool.acquire(destination)
+    try:
+        try:
+            response, keep_alive = await _send_and_receive(connection, raw_request, request.method)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            if not reused or request.method not in IDEMPOTENT_METHODS:
+                raise
+            # stale keep-alive connection closed by server in the meantime, retry on a fresh one
+            # (only if it's safe to send the request again, server might have processed it)
+            connection[1].close()
+            connection = await pool.connect(destination)
+            response, keep_alive = await _send_and_receive(connection, raw_request, request.method)
+    except BaseException:
+        connection[1].close()
+        raise
+
+    if keep_alive:
+        pool.release(destination, connection)
+    else:
+        connection[1].close()
+    return response
+
+
+def _serialize_request(request: HttpRequest, path: str) -> bytes:
+    lines = [f'{request.method} {path} HTTP/1.1']
+    for name, value in request.headers.multi_items():
+        if name.lower() not in HOP_BY_HOP_HEADERS:
+            lines.append(f'{name}: {value}')
+    if request.content or request.method in {'POST', 'PUT', 'PATCH'}:
+        lines.append(f'Content-Length: {len(request.content)}')
+    head = '\r\n'.join(lines) + '\r\n\r\n'
+    return head.encode('latin-1') + request.content
+
+
+async def _send_and_receive(connection: Connection, raw_request: bytes, method: str) -> Tuple[HttpResponse, bool]:
+    reader, writer = connection
+    writer.write(raw_request)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError('connection closed by upstream')
+    version, status_code = _parse_status_line(status_line)
+    while 100 <= status_code < 200:  # skip interim responses
+        await read_headers(reader)
+        version, status_code = _parse_status_line(await reader.readline())
+    headers = await read_headers(reader)
+
+    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+    if method == 'HEAD' or status_code in {204, 304}:
+        content = b''
+    elif 'chunked' in headers.get('transfer-encoding', '').lower():
+        content = await read_chunked_body(reader)
+    elif 'content-length' in headers:
+        content = await reader.readexactly(int(headers.get('content-length')))
+    else:
+        content = await reader.read()
+        keep_alive = False
+
+    content = _decode_content(content, headers.get('content-encoding', ''))
+    return HttpResponse(status_code=status_code, headers=headers, content=content), keep_alive
+
+
+def _parse_status_line(line: bytes) -> Tuple[str, int]:
+    parts = line.decode('latin-1').split(None, 2)
+    if len(parts) < 2:
+        raise ValueError(f'malformed status line: {line!r}')
+    return parts[0], int(parts[1])
+
+
+async def read_headers(reader: asyncio.StreamReader) -> Headers:
+    headers = Headers()
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return headers
+        name, _, value = line.decode('latin-1').partition(':')
+        headers.add(name.strip(), value.strip())
+
+
+async def read_chunked_body(reader: asyncio.StreamReader) -> bytes:
+    parts = []
+    while True:
+        size_line = await reader.readline()
+        size = int(size_line.split(b';', 1)[0].strip(), 16)
+        if size == 0:
+            await read_headers(reader)  # trailers
+            return b''.join(parts)
+        parts.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+
+
+def _decode_content(content: bytes, content_encoding: str) -> bytes:
+    """Decompress body the same way as synchronous client does, Content-Encoding header is removed later"""
+    encoding = content_encoding.strip().lower()
+    if not content or not encoding:
+        return content
+    if encoding in {'gzip', 'x-gzip'}:
+        return zlib.decompress(content, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(content)
+        except zlib.error:
+            return zlib.decompress(content, -zlib.MAX_WBITS)
+    return content
@@ -0,0 +1,250 @@
+import bisect
+import hashlib
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import requests
+from nuclear.sublog import log
+
+from .config import Config
+from .request import HttpRequest
+from .response import HttpResponse
+
+BALANCING_STRATEGIES = ['round-robin', 'least-requests', 'hash']
+# methods that can be sent again after a failure without side effects
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'}
+# points on the hash ring per upstream
+RING_REPLICAS = 100
+# ejection time grows with every subsequent ejection, up to this many times
+MAX_EJECTION_MULTIPLIER = 10
+
+
+class Upstream(object):
+    __slots__ = ('url', 'outstanding', 'failures', 'ejections', 'ejected_until', 'healthy')
+
+    def __init__(self, url: str):
+        self.url: str = url
+        self.outstanding: int = 0
+        # consecutive failures
+        self.failures: int = 0
+        self.ejections: int = 0
+        self.ejected_until: float = 0
+        # result of the last active health check
+        self.healthy: bool = True
+
+    def available(self, now: float) -> bool:
+        return self.healthy and self.ejected_until <= now
+
+
+class RetryBudget(object):
+    """
+    Limits retries to a fraction of requests made within the last window (plus min_retries per window),
+    so that retrying can't multiply the load on upstreams that are already failing.
+    """
+
+    def __init__(self, ratio: float, min_retries: int = 10, window: float = 10):
+        self.ratio: float = ratio
+        self.min_retries: int = min_retries
+        self.window: float = window
+        self.window_start: float = time.monotonic()
+        self.requests: int = 0
+        self.retries: int = 0
+        self.denied: int = 0
+        self.lock = threading.Lock()
+
+    def record_request(self):
+        with self.lock:
+            self._roll_window()
+            self.requests += 1
+
+    def try_withdraw(self) -> bool:
+        with self.lock:
+            self._roll_window()
+            if self.retries >= self.min_retries + self.ratio * self.requests:
+                self.denied += 1
+                return False
+            self.retries += 1
+            return True
+
+    def _roll_window(self):
+        now = time.monotonic()
+        if now - self.window_start >= self.window:
+            self.window_start = now
+            self.requests = 0
+            self.retries = 0
+
+
+class UpstreamPool(object):
+    """
+    Destination URLs the requests are balanced between, according to a strategy:
+    round-robin, least-requests (fewest outstanding requests) or hash (consistent hashing of request key,
+    so the same requests go to the same upstream).
+    Upstreams failing repeatedly are ejected for a while (passive health checking),
+    those failing active health checks are skipped until they pass again.
+    If no upstream is available, requests are balanced between all of them anyway.
+    """
+
+    def __init__(self, urls: List[str], strategy: str = 'round-robin',
+                 request_key: Optional[Callable[[HttpRequest], bytes]] = None, max_retries: int = 1,
+                 retry_budget: float = 0.2, eject_failures: int = 5, eject_seconds: float = 30,
+                 health_path: str = '', health_interval: float = 10, health_timeout: float = 2):
+        if not urls:
+            raise ValueError('no upstream URL given')
+        if strategy not in BALANCING_STRATEGIES:
+            raise ValueError(f'unknown balancing strategy: {strategy}, '
+                             f'expected one of: {", ".join(BALANCING_STRATEGIES)}')
+        self.upstreams: List[Upstream] = [Upstream(url) for url in urls]
+        self.strategy: str = strategy
+        self.request_key: Optional[Callable[[HttpRequest], bytes]] = request_key
+        self.max_retries: int = max_retries
+        self.budget: RetryBudget = RetryBudget(retry_budget)
+        self.eject_failures: int = eject_failures
+        self.eject_seconds: float = eject_seconds
+        self.health_path: str = health_path
+        self.health_interval: float = health_interval
+        self.health_timeout: float = health_timeout
+        self.lock = threading.Lock()
+        self.next_index: int = 0
+        self.ring: List[int] = []
+        self.ring_upstreams: List[Upstream] = []
+        self._build_ring()
+        self.health_thread: Optional[threading.Thread] = None
+        self.health_pid: int = 0
+        self.closed = threading.Event()
+
+    def _build_ring(self):
+        points = []
+        for upstream in self.upstreams:
+            for replica in range(RING_REPLICAS):
+                points.append((_ring_point(f'{upstream.url}#{replica}'.encode()), upstream))
+        points.sort(key=lambda point: point[0])
+        self.ring = [point for point, _ in points]
+        self.ring_upstreams = [upstream for _, upstream in points]
+
+    def choose(self, request: HttpRequest, tried: List[Upstream]) -> Upstream:
+        """Pick upstream for a request, avoiding the ones already tried if there's any other available"""
+        self._ensure_health_checks()
+        now = time.monotonic()
+        candidates = [upstream for upstream in self.upstreams
+                      if upstream.available(now) and upstream not in tried]
+        if not candidates:
+            candidates = [upstream for upstream in self.upstreams if upstream not in tried] or self.upstreams
+        if len(candidates) == 1:
+            return candidates[0]
+        if self.strategy == 'least-requests':
+            return min(candidates, key=lambda upstream: upstream.outstanding)
+        if self.strategy == 'hash' and self.request_key is not None:
+            return self._ring_lookup(self.request_key(request), candidates)
+        with self.lock:
+            self.next_index += 1
+            return candidates[self.next_index % len(candidates)]
+
+    def _ring_lookup(self, key: bytes, candidates: List[Upstream]) -> Upstream:
+        """First candidate clockwise from the key's point on the ring"""
+        start = bisect.bisect(self.ring, _ring_point(key))
+        for i in range(len(self.ring)):
+            upstream = self.ring_upstreams[(start + i) % len(self.ring)]
+            if upstream in candidates:
+                return upstream
+        return candidates[0]
+
+    def begin(self, upstream: Upstream):
+        with self.lock:
+            upstream.outstanding += 1
+
+    def end(self, upstream: Upstream, response: HttpResponse) -> bool:
+        """Record the result of a request, eject upstream failing repeatedly. Tell whether it failed"""
+        failed = is_upstream_failure(response)
+        with self.lock:
+            upstream.outstanding -= 1
+            if not failed:
+                upstream.failures = 0
+                return False
+            upstream.failures += 1
+            if upstream.failures >= self.eject_failures and upstream.ejected_until <= time.monotonic():
+                upstream.ejections += 1
+                duration = self.eject_seconds * min(upstream.ejections, MAX_EJECTION_MULTIPLIER)
+                upstream.ejected_until = time.monotonic() + duration
+                upstream.failures = 0
+                log.warn('Upstream ejected after failures', dst_url=upstream.url, seconds=duration)
+        return True
+
+    def should_retry(self, request: HttpRequest, attempts: int) -> bool:
+        """Failed request is retried if it's safe to send it again and the retry budget allows it"""
+        if attempts > self.max_retries or request.method not in IDEMPOTENT_METHODS or request.stream is not None:
+            return False
+        return self.budget.try_withdraw()
+
+    def stats(self) -> Dict[str, int]:
+        now = time.monotonic()
+        return {
+            'upstreams': len(self.upstreams),
+            'available': sum(1 for upstream in self.upstreams if upstream.available(now)),
+            'outstanding': sum(upstream.outstanding for upstream in self.upstreams),
+            'ejections': sum(upstream.ejections for upstream in self.upstreams),
+            'retries_denied': self.budget.denied,
+        }
+
+    def _ensure_health_checks(self):
+        """Run active health checks in current process, thread started before fork doesn't run in a worker"""
+        if not self.health_path or (self.health_thread is not None and self.health_pid == os.getpid()):
+            return
+        with self.lock:
+            if self.health_thread is not None and self.health_pid == os.getpid():
+                return
+            self.health_pid = os.getpid()
+            self.health_thread = threading.Thread(target=self._check_health_periodically, name='health-checks',
+                                                  daemon=True)
+            self.health_thread.start()
+
+    def _check_health_periodically(self):
+        with requests.Session() as session:
+            while not self.closed.is_set():
+                for upstream in self.upstreams:
+                    self.check_health(upstream, session)
+                self.closed.wait(self.health_interval)
+
+    def check_health(self, upstream: Upstream, session: requests.Session):
+        try:
+            response = session.get(f'{upstream.url}{self.health_path}', timeout=self.health_timeout, verify=False)
+            healthy = response.status_code < 500
+        except requests.RequestException:
+            healthy = False
+        if healthy != upstream.healthy:
+            if healthy:
+                log.info('Upstream passed health check', dst_url=upstream.url)
+            else:
+                log.warn('Upstream failed health check', dst_url=upstream.url)
+        upstream.healthy = healthy
+
+    def close(self):
+        self.closed.set()
+
+
+def is_upstream_failure(response: HttpResponse) -> bool:
+    """Upstream couldn't be reached (response made by xman) or it's unavailable"""
+    return 'X-Man-Error' in response.headers or response.status_code in {502, 503, 504}
+
+
+def parse_upstream_urls(dst_url: str) -> List[str]:
+    """Destination URLs separated by commas"""
+    return [url.strip().rstrip('/') for url in dst_url.split(',') if url.strip()]
+
+
+def _ring_point(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+
+def upstream_pool(config: Config, request_key: Optional[Callable[[HttpRequest], bytes]] = None
+                  ) -> Optional[UpstreamPool]:
+    """Pool of upstreams given by destination URL, None if it's a single one"""
+    urls = parse_upstream_urls(config.dst_url)
+    if len(urls) < 2:
+        return None
+    return UpstreamPool(urls, strategy=config.upstream_balancing,
+                        request_key=request_key, max_retries=config.upstream_retries,
+                        retry_budget=config.upstream_retry_budget, eject_failures=config.upstream_eject_failures,
+                        eject_seconds=config.upstream_eject_seconds, health_path=config.upstream_health_path,
+                        health_interval=config.upstream_health_interval)
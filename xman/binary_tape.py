@@ -0,0 +1,259 @@
+import json
+import mmap
+import os
+import struct
+from typing import List, Tuple, Any, Callable, Optional, Dict
+
+from nuclear.sublog import log
+
+from .entry import CacheEntry
+from .header import unmarshal_headers
+from .request import HttpRequest
+from .response import HttpResponse
+from .tape import locked_file
+
+BINARY_TAPE_SUFFIX = '.xtape'
+MAGIC = b'XMANTAPE'
+VERSION = 2
+# magic, version, key tag, index offset, index entries count
+HEADER = struct.Struct('<8sH16sQQ')
+# entry key, metadata length, request body length, response body length - for every supported version
+RECORD_HEADERS = {
+    1: struct.Struct('<QIQQ'),
+    2: struct.Struct('<16sIQQ'),
+}
+# entry key, record offset, record length
+INDEX_ENTRIES = {
+    1: struct.Struct('<QQQ'),
+    2: struct.Struct('<16sQQ'),
+}
+RECORD_HEADER = RECORD_HEADERS[VERSION]
+INDEX_ENTRY = INDEX_ENTRIES[VERSION]
+
+
+class BinaryTape(object):
+    """
+    Tape file keeping request & response bodies as raw bytes, next to JSON-encoded metadata (method, path, headers).
+    Records are appended to the end of a file. On compaction, index of records (entry key -> offset, length)
+    is written after them and pointed to by a file header, so loading a tape doesn't need to scan records.
+    File is memory-mapped and bodies are read from it only when entry is accessed.
+    """
+
+    def __init__(self, path: str, entry_key: Callable[[HttpRequest], Any], key_tag: Optional[str]):
+        self.path: str = path
+        self.entry_key: Callable[[HttpRequest], Any] = entry_key
+        self.key_tag: bytes = (key_tag or '').encode()[:16]
+        self.torn_records: int = 0
+        self.mm: Optional[mmap.mmap] = None
+        self.version: int = VERSION
+        self._valid_end: int = 0
+        self._append_ready: bool = False
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def load(self) -> List[Tuple[Any, 'LazyCacheEntry']]:
+        """Read entry keys and positions, leaving the metadata and bodies in the mapped file"""
+        return self.entries_from(0)[0]
+
+    def entries_from(self, offset: int) -> Tuple[List[Tuple[Any, 'LazyCacheEntry']], int]:
+        """
+        Lazy entries of records starting from given offset (0 for all records), along with the offset they end at,
+        so that the next call reads only the records appended since then
+        """
+        if not self.exists() or os.path.getsize(self.path) == 0:
+            return [], offset
+        self._map()
+        trusted_keys = self._trusted_keys()
+        positions = self._record_positions() if offset == 0 else self._scan_records(offset)
+        loaded = []
+        for key, record_offset in positions:
+            entry = LazyCacheEntry(self.mm, record_offset, RECORD_HEADERS[self.version])
+            if not trusted_keys:
+                key = self.entry_key(entry.request)
+            loaded.append((key, entry))
+        return loaded, self._valid_end
+
+    def prepare_recording(self):
+        self._prepare_append()
+
+    def append(self, entries: List[Tuple[Any, CacheEntry]]):
+        if not entries:
+            return
+        self._prepare_append()
+        data = b''.join(serialize_record(key, entry) for key, entry in entries)
+        with open(self.path, 'ab', buffering=0) as f:
+            with locked_file(f):
+                f.write(data)
+
+    def compact(self) -> int:
+        """
+        Rewrite tape keeping only the first entry for every key, with index of all records at the end.
+        :return: number of dropped entries
+        """
+        if not self.exists() or os.path.getsize(self.path) == 0:
+            return 0
+        self._map()
+        trusted_keys = self._trusted_keys()
+        _, index_offset, index_count = self._header()
+        seen = set()
+        kept: List[Tuple[Any, int]] = []
+        positions = self._record_positions()
+        for key, offset in positions:
+            if not trusted_keys:
+                key = self.entry_key(LazyCacheEntry(self.mm, offset, RECORD_HEADERS[self.version]).request)
+            if key in seen:
+                continue
+            seen.add(key)
+            kept.append((key, offset))
+        dropped = len(positions) - len(kept)
+        if dropped or not trusted_keys or self.torn_records or index_count != len(positions) \
+                or index_offset == 0:
+            self._rewrite(kept)
+        return dropped
+
+    def _rewrite(self, records: List[Tuple[Any, int]]):
+        """Write records in current version format, along with the index"""
+        tmp_path = f'{self.path}.tmp'
+        record_header = RECORD_HEADERS[self.version]
+        index = []
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.key_tag, 0, 0))
+            for key, offset in records:
+                _, meta_len, req_len, resp_len = record_header.unpack_from(self.mm, offset)
+                data_offset = offset + record_header.size
+                index.append((key, f.tell(), RECORD_HEADER.size + meta_len + req_len + resp_len))
+                f.write(RECORD_HEADER.pack(key, meta_len, req_len, resp_len))
+                f.write(self.mm[data_offset:data_offset + meta_len + req_len + resp_len])
+            index_offset = f.tell()
+            f.write(b''.join(INDEX_ENTRY.pack(*item) for item in index))
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, self.key_tag, index_offset, len(index)))
+        os.replace(tmp_path, self.path)
+        self._append_ready = False
+
+    def _map(self):
+        """Map current content of the file. Previous mapping is left to entries still referring to it"""
+        with open(self.path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < HEADER.size or self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{self.path} is not a binary tape file')
+        self.version = self._header()[0]
+        if self.version not in RECORD_HEADERS:
+            raise ValueError(f'unsupported binary tape version: {self.version}')
+
+    def _header(self) -> Tuple[int, int, int]:
+        _, version, _, index_offset, index_count = HEADER.unpack_from(self.mm, 0)
+        return version, index_offset, index_count
+
+    def _trusted_keys(self) -> bool:
+        """Stored keys are reused only if they were computed the same way, otherwise they're computed again"""
+        stored_key_tag = HEADER.unpack_from(self.mm, 0)[2].rstrip(b'\0')
+        return self.version == VERSION and bool(self.key_tag) and stored_key_tag == self.key_tag
+
+    def _record_positions(self) -> List[Tuple[Any, int]]:
+        """Keys and offsets of indexed records, followed by the ones appended after the index was written"""
+        _, index_offset, index_count = self._header()
+        index_entry = INDEX_ENTRIES[self.version]
+        positions = []
+        tail_offset = HEADER.size
+        if index_offset:
+            for i in range(index_count):
+                key, offset, _ = index_entry.unpack_from(self.mm, index_offset + i * index_entry.size)
+                positions.append((key, offset))
+            tail_offset = index_offset + index_count * index_entry.size
+        positions.extend(self._scan_records(tail_offset))
+        return positions
+
+    def _scan_records(self, offset: int) -> List[Tuple[Any, int]]:
+        self.torn_records = 0
+        record_header = RECORD_HEADERS[self.version]
+        size = len(self.mm)
+        positions = []
+        while offset < size:
+            if offset + record_header.size > size:
+                length = size
+            else:
+                key, meta_len, req_len, resp_len = record_header.unpack_from(self.mm, offset)
+                length = record_header.size + meta_len + req_len + resp_len
+            if offset + length > size:
+                log.warn('Tape: skipping incomplete entry', record_file=self.path, offset=offset)
+                self.torn_records += 1
+                break
+            positions.append((key, offset))
+            offset += length
+        self._valid_end = offset
+        return positions
+
+    def _outdated_version(self) -> bool:
+        with open(self.path, 'rb') as f:
+            return HEADER.unpack(f.read(HEADER.size))[1] != VERSION
+
+    def _prepare_append(self):
+        """Create file with a header if it's missing, cut off incomplete record left by interrupted write"""
+        if self._append_ready:
+            return
+        if not self.exists() or os.path.getsize(self.path) == 0:
+            with open(self.path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, self.key_tag, 0, 0))
+        elif is_binary_tape(self.path) and self._outdated_version():
+            self.compact()
+            log.info('Tape: upgraded binary tape format', record_file=self.path, version=VERSION)
+        else:
+            self._map()
+            self._record_positions()
+            if self.torn_records:
+                with open(self.path, 'r+b') as f:
+                    f.truncate(self._valid_end)
+        self._append_ready = True
+
+
+class LazyCacheEntry(object):
+    """Request-response entry stored in a mapped binary tape, decoded on every access"""
+    __slots__ = ('mm', 'offset', 'record_header', 'encoded', 'wire_heads')
+
+    def __init__(self, mm: mmap.mmap, offset: int, record_header: struct.Struct = RECORD_HEADER):
+        self.mm: mmap.mmap = mm
+        self.offset: int = offset
+        self.record_header: struct.Struct = record_header
+        self.encoded: Dict[str, bytes] = {}
+        self.wire_heads: Dict[Optional[str], Any] = {}
+
+    @property
+    def request(self) -> HttpRequest:
+        meta, body_offset, req_len, _ = self._read_meta()
+        data = dict(meta['request'])
+        data['content'] = self.mm[body_offset:body_offset + req_len]
+        return HttpRequest(**unmarshal_headers(data))
+
+    @property
+    def response(self) -> HttpResponse:
+        meta, body_offset, req_len, resp_len = self._read_meta()
+        data = dict(meta['response'])
+        body_offset += req_len
+        data['content'] = self.mm[body_offset:body_offset + resp_len]
+        return HttpResponse(**unmarshal_headers(data))
+
+    def _read_meta(self) -> Tuple[Dict[str, dict], int, int, int]:
+        _, meta_len, req_len, resp_len = self.record_header.unpack_from(self.mm, self.offset)
+        meta_offset = self.offset + self.record_header.size
+        meta = json.loads(self.mm[meta_offset:meta_offset + meta_len])
+        return meta, meta_offset + meta_len, req_len, resp_len
+
+
+def serialize_record(key: bytes, entry: CacheEntry) -> bytes:
+    request = entry.request.marshal()
+    response = entry.response.marshal()
+    request_body = request.pop('content')
+    response_body = response.pop('content')
+    meta = json.dumps({'request': request, 'response': response}, sort_keys=True).encode('utf-8')
+    return RECORD_HEADER.pack(key, len(meta), len(request_body), len(response_body)) \
+        + meta + request_body + response_body
+
+
+def is_binary_tape(path: str) -> bool:
+    """Recognize binary tape by its content, or by its extension if it's not written yet"""
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        return path.endswith(BINARY_TAPE_SUFFIX)
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
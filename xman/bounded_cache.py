@@ -0,0 +1,120 @@
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterator, Optional
+
+EVICTION_POLICIES = ['lru', 'lfu', 'fifo', 'ttl']
+
+
+class BoundedCache(MutableMapping):
+    """
+    Mapping holding up to max_entries items of total size up to max_bytes (0 means no limit).
+    When it's full, items are evicted according to the policy:
+    lru - least recently used, lfu - least frequently used, fifo - the first inserted,
+    ttl - the one with the oldest timestamp (the closest to expiry), given by oldest_key.
+    """
+
+    def __init__(self, max_entries: int = 0, max_bytes: int = 0, policy: str = 'lru',
+                 sizeof: Callable[[Any], int] = lambda value: 0,
+                 on_evict: Optional[Callable[[Any, Any], None]] = None,
+                 oldest_key: Optional[Callable[[], Any]] = None):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f'unknown eviction policy: {policy}, expected one of {EVICTION_POLICIES}')
+        if policy == 'ttl' and oldest_key is None:
+            raise ValueError('ttl eviction policy needs a function finding key of the oldest item')
+        self.max_entries: int = max_entries
+        self.max_bytes: int = max_bytes
+        self.policy: str = policy
+        self.sizeof: Callable[[Any], int] = sizeof
+        self.on_evict: Optional[Callable[[Any, Any], None]] = on_evict
+        self.oldest_key: Optional[Callable[[], Any]] = oldest_key
+        self.entries: OrderedDict = OrderedDict()
+        self.sizes: Dict[Any, int] = {}
+        self.total_bytes: int = 0
+        self.evictions: int = 0
+        # LFU bookkeeping: access count of every key and keys grouped by count, in order of last access
+        self.frequencies: Dict[Any, int] = {}
+        self.buckets: Dict[int, OrderedDict] = {}
+        self.lock = threading.RLock()
+
+    def __getitem__(self, key: Any) -> Any:
+        with self.lock:
+            value = self.entries[key]
+            self._touch(key)
+            return value
+
+    def __setitem__(self, key: Any, value: Any):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            size = self.sizeof(value)
+            if self.max_bytes and size > self.max_bytes:
+                self._evicted(key, value)
+                return
+            while self.entries and self._over_budget(size):
+                self._evict_one()
+            self.entries[key] = value
+            self.sizes[key] = size
+            self.total_bytes += size
+            if self.policy == 'lfu':
+                self.frequencies[key] = 1
+                self.buckets.setdefault(1, OrderedDict())[key] = None
+
+    def __delitem__(self, key: Any):
+        with self.lock:
+            if key not in self.entries:
+                raise KeyError(key)
+            self._remove(key)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self.entries
+
+    def __iter__(self) -> Iterator:
+        return iter(list(self.entries))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _touch(self, key: Any):
+        if self.policy == 'lru':
+            self.entries.move_to_end(key)
+        elif self.policy == 'lfu':
+            frequency = self.frequencies[key]
+            self._bucket_remove(key, frequency)
+            self.frequencies[key] = frequency + 1
+            self.buckets.setdefault(frequency + 1, OrderedDict())[key] = None
+
+    def _over_budget(self, new_size: int) -> bool:
+        """Check whether there's no room for a new item of given size"""
+        if self.max_entries and len(self.entries) >= self.max_entries:
+            return True
+        return bool(self.max_bytes) and self.total_bytes + new_size > self.max_bytes
+
+    def _evict_one(self):
+        key = None
+        if self.policy == 'lfu':
+            key = next(iter(self.buckets[min(self.buckets)]))
+        elif self.policy == 'ttl':
+            key = self.oldest_key()
+        if key is None:
+            key = next(iter(self.entries))
+        value = self.entries[key]
+        self._remove(key)
+        self._evicted(key, value)
+
+    def _evicted(self, key: Any, value: Any):
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def _remove(self, key: Any):
+        del self.entries[key]
+        self.total_bytes -= self.sizes.pop(key)
+        if self.policy == 'lfu':
+            self._bucket_remove(key, self.frequencies.pop(key))
+
+    def _bucket_remove(self, key: Any, frequency: int):
+        bucket = self.buckets[frequency]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[frequency]
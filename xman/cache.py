@@ -1,62 +1,147 @@
-import json
-import os
-import zlib
+import heapq
+import threading
 from datetime import datetime
-from pathlib import Path
-from typing import Dict, Tuple, List, Any
+from typing import Dict, Tuple, List, Any, Optional, Callable, Union, Set
 
-from dataclasses import dataclass, is_dataclass, asdict
-from nuclear.sublog import log
+from nuclear.sublog import log, logerr
 
+from .binary_tape import BinaryTape, LazyCacheEntry, is_binary_tape
+from .bounded_cache import BoundedCache
+from .cache_backend import CacheBackend, BatchedReader, open_backend, decode_entry
+from .chunk import chunks
+from .compact import CompactEntry, StringPool
 from .config import Config
+from .entry import CacheEntry
 from .extension import Extensions
+from .fingerprint import fingerprint, traits_tag
+from .ratelimit import RateLimiter, rate_limited_response
 from .request import HttpRequest
 from .response import HttpResponse
+from .tape import JournalTape
+from .tape_index import LazyJsonEntry
+from .tape_writer import TapeWriter
 
-
-@dataclass
-class CacheEntry(object):
-    request: HttpRequest
-    response: HttpResponse
-
-    @staticmethod
-    def from_json(data: dict) -> 'CacheEntry':
-        return CacheEntry(
-            request=HttpRequest.from_json(data.get('request')),
-            response=HttpResponse.from_json(data.get('response')),
-        )
+Tape = Union[JournalTape, BinaryTape]
 
 
 class RequestCache(object):
     def __init__(self, extensions: Extensions, config: Config):
         self.extensions: Extensions = extensions
         self.config: Config = config
-        self.cache: Dict[int, CacheEntry] = self._init_request_cache()
-
-    def _init_request_cache(self) -> Dict[int, CacheEntry]:
-        if self.config.record_file and os.path.isfile(self.config.record_file):
-            txt = Path(self.config.record_file).read_text()
-            if not txt:
-                return {}
-            entries = json.loads(txt)
-            loaded_cache = {}
-            for entry in entries:
-                parsed_entry = CacheEntry.from_json(entry)
-                request_hash = self._request_hash(parsed_entry.request)
-                loaded_cache[request_hash] = parsed_entry
-            conflicts = len(entries) - len(loaded_cache)
+        self.tape: Optional[Tape] = None
+        if config.record_file:
+            # keys stored in the tape (or its index) are tagged with the code of traits function computing them
+            if extensions.cache_request_traits is None:
+                self.tape = open_tape(config.record_file, default_request_hash, DEFAULT_KEY_TAG,
+                                      index=config.tape_index)
+            else:
+                self.tape = open_tape(config.record_file, self.request_fingerprint,
+                                      traits_tag(extensions.cache_request_traits), index=config.tape_index)
+        self.lock = threading.RLock()
+        self.throttle: Optional[RateLimiter] = None
+        if config.replay_throttle and config.rate_limit > 0:
+            self.throttle = RateLimiter(config.rate_limit, config.rate_limit_burst)
+        # writes entries to the tape in background, if it's enabled
+        self.writer: Optional[TapeWriter] = None
+        if self.tape is not None and config.record_async:
+            self.writer = TapeWriter(self.tape, batch_size=config.record_batch_size,
+                                     max_pending=config.record_queue_size, fsync=config.record_fsync,
+                                     fsync_interval=config.record_fsync_interval)
+        # cache shared with other xman processes, looked up when entry is missing in memory
+        self.backend: Optional[CacheBackend] = None
+        self.backend_reader: Optional[BatchedReader] = None
+        self.backend_writer: Optional[TapeWriter] = None
+        if config.cache_backend:
+            self.backend = open_backend(config.cache_backend)
+            self.backend_reader = BatchedReader(self.backend, config.cache_backend_batch_size)
+            self.backend_writer = TapeWriter(self.backend, batch_size=config.cache_backend_batch_size,
+                                             max_pending=config.record_queue_size, name='cache-backend-writer')
+        self.shared_hits: int = 0
+        # keys of entries kept only in memory, not written to the tape
+        self.unsaved: Set[bytes] = set()
+        # keys of entries evicted from memory that are on the tape, read back from it on a miss
+        self.evicted: Set[bytes] = set()
+        # lazy entries referring to positions of entries on the tape, known from loading or looked up later
+        self.tape_entries: Dict[bytes, Union[LazyCacheEntry, LazyJsonEntry]] = {}
+        # tape offset up to which positions of entries have been looked up
+        self.tape_scanned: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.spilled: int = 0
+        self.faulted: int = 0
+        # expiry queue of (timestamp, hash) pairs, ordered by the oldest, with timestamps of cached entries
+        self.expiry_heap: List[Tuple[float, bytes]] = []
+        self.timestamps: Dict[bytes, float] = {}
+        # strings shared by compact entries, they're used unless custom traits may need other request fields
+        self.string_pool: Optional[StringPool] = StringPool() if extensions.cache_request_traits is None else None
+        # set once all entries from the tape are in the cache
+        self.loaded = threading.Event()
+        self.loader: Optional[threading.Thread] = None
+        self.cache: BoundedCache = BoundedCache(max_entries=config.cache_max_entries, max_bytes=config.cache_max_bytes,
+                                                policy=config.cache_eviction, sizeof=entry_size,
+                                                on_evict=self._on_evict, oldest_key=self._oldest_entry)
+        self._init_request_cache()
+
+    def _init_request_cache(self):
+        background = self.config.tape_background_load
+        if background and self.config.server_mode == 'multiprocess':
+            # loader thread wouldn't exist in forked workers, they'd wait for it forever
+            log.warn('Tape: background loading is not supported in multiprocess mode, loading it before forking')
+            background = False
+        if self.tape is None or not self.tape.exists():
+            self.loaded.set()
+        elif background:
+            if self.config.record:
+                self.tape.prepare_recording()
+            self.loader = threading.Thread(target=self._load_tape_in_background, args=(self.cache,),
+                                           name='tape-loader', daemon=True)
+            self.loader.start()
+        else:
+            self._load_tape(self.cache)
+            if self.config.record and len(self.cache):
+                self.tape.prepare_recording()
+
+    def _load_tape(self, loaded_cache: BoundedCache):
+        """Put entries from the tape into the cache, in batches, so lookups can proceed when it's done in background"""
+        try:
+            entries = self.tape.load()
+            if not entries:
+                return
+            conflicts = 0
+            for batch in chunks(entries, LOAD_BATCH_SIZE):
+                with self.lock:
+                    for request_hash, entry in batch:
+                        if request_hash in loaded_cache:
+                            conflicts += 1
+                        else:
+                            entry = self._compact(entry)
+                            loaded_cache[request_hash] = entry
+                            self._track_expiry(request_hash, entry)
             log.info(f'Loaded cached request-response entries', record_file=self.config.record_file,
-                     loaded=len(loaded_cache), conflicts=conflicts)
-            return loaded_cache
-        return {}
+                     loaded=len(loaded_cache), conflicts=conflicts, evicted=loaded_cache.evictions)
+        finally:
+            self.loaded.set()
+
+    def _load_tape_in_background(self, loaded_cache: BoundedCache):
+        with logerr('loading tape'):
+            self._load_tape(loaded_cache)
 
     def has_cached_response(self, request: HttpRequest) -> bool:
+        return self.find_cached_response(request) is not None
+
+    def find_cached_response(self, request: HttpRequest) -> Optional[HttpResponse]:
+        """Look up the cache once, so that concurrent removal of an entry can't happen in between"""
         if not self.config.replay:
-            return False
-        rhash = self._request_hash(request)
-        if rhash not in self.cache:
-            return False
-        return self._can_be_cached(request, self.cache[rhash].response)
+            return None
+        entry = self._find_entry(request)
+        if entry is None:
+            return None
+        response = entry.response
+        if not self._can_be_cached(request, response):
+            return None
+        response.encoded = entry.encoded
+        response.wire_heads = entry.wire_heads
+        return self._throttled(request) or response
 
     def _can_be_cached(self, request: HttpRequest, response: HttpResponse) -> bool:
         if self.extensions.can_be_cached is None:
@@ -64,47 +149,237 @@ class RequestCache(object):
         return self.extensions.can_be_cached(request, response)
 
     def replay_response(self, request: HttpRequest) -> HttpResponse:
-        request_hash = self._request_hash(request)
-        if self.config.replay_throttle:
-            if self.config.verbose:
-                log.debug('Cache: Throttled response')
-            return too_many_requests_response
-        return self.cache[request_hash].response
+        entry = self._find_entry(request)
+        if entry is None:
+            raise KeyError(f'no cached response for request: {request.method} {request.path}')
+        response = entry.response
+        response.encoded = entry.encoded
+        response.wire_heads = entry.wire_heads
+        return self._throttled(request) or response
+
+    def _throttled(self, request: HttpRequest) -> Optional[HttpResponse]:
+        """
+        Throttle cached responses exceeding the rate limit.
+        Without rate limit configured, every cached response is throttled.
+        """
+        if not self.config.replay_throttle:
+            return None
+        if self.throttle is None:
+            response = too_many_requests_response
+        else:
+            response = rate_limited_response(self.throttle, request, self.config.rate_limit_by,
+                                             self.extensions.rate_limit_key)
+        if response is not None and self.config.verbose:
+            log.debug('Cache: Throttled response')
+        return response
+
+    def _find_entry(self, request: HttpRequest) -> Optional[CacheEntry]:
+        """Find entry by request fingerprint, verifying whole traits to rule out a collision"""
+        traits = self._request_traits(request)
+        request_hash = fingerprint(traits)
+        entry = None if self._expired(request_hash) else self.cache.get(request_hash)
+        if entry is None and not self.loaded.is_set():
+            self.loaded.wait()
+            entry = None if self._expired(request_hash) else self.cache.get(request_hash)
+        if entry is None and request_hash in self.evicted:
+            entry = self._find_evicted_entry(request_hash)
+        if entry is None and self.backend_reader is not None:
+            entry = self._find_shared_entry(request_hash)
+        if entry is not None and self._request_traits(entry.request) != traits:
+            log.warn('Cache: request fingerprint collision, ignoring cached entry', path=request.path)
+            entry = None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def _find_evicted_entry(self, request_hash: bytes) -> Optional[CacheEntry]:
+        """Read entry evicted from memory back from the tape and keep it in memory again"""
+        if request_hash not in self.tape_entries:
+            self._scan_tape()
+        with self.lock:
+            if request_hash in self.cache:
+                return self.cache[request_hash]
+            entry = self.tape_entries.get(request_hash)
+            # entry queued for the tape before it was evicted should be there, otherwise it's gone for good
+            self.evicted.discard(request_hash)
+            if entry is None:
+                return None
+            if self.config.replay_clear_cache and \
+                    now_seconds() - entry.request.timestamp > self.config.replay_clear_cache_seconds:
+                return None
+            self.cache[request_hash] = entry
+            self._track_expiry(request_hash, entry)
+        self.faulted += 1
+        return entry
+
+    def _scan_tape(self):
+        """Find positions of entries on the tape, reading only the part appended since the last time"""
+        if self.writer is not None:
+            self.writer.flush()
+        with self.lock:
+            entries, self.tape_scanned = self.tape.entries_from(self.tape_scanned)
+            for key, entry in entries:
+                self.tape_entries.setdefault(key, entry)
+
+    def _find_shared_entry(self, request_hash: bytes) -> Optional[CacheEntry]:
+        """Look up entry in the shared backend and keep it in memory, backend failure is treated as a miss"""
+        data = None
+        with logerr('reading cache backend'):
+            data = self.backend_reader.get(request_hash)
+        if data is None:
+            return None
+        entry = decode_entry(data)
+        if self.config.replay_clear_cache and \
+                now_seconds() - entry.request.timestamp > self.config.replay_clear_cache_seconds:
+            return None
+        with self.lock:
+            if request_hash not in self.cache:
+                self.cache[request_hash] = self._compact(entry)
+                self._track_expiry(request_hash, entry)
+        self.shared_hits += 1
+        return entry
 
     def clear_old(self):
+        """Remove expired entries, popping them from the expiry queue, so only these entries are visited"""
         if not self.config.replay_clear_cache:
             return
-        to_remove = []
-        now_timestamp: float = now_seconds()
-        for request_hash, entry in self.cache.items():
-            if now_timestamp - entry.request.timestamp > self.config.replay_clear_cache_seconds:
-                to_remove.append(request_hash)
-        for request_hash in to_remove:
-            del self.cache[request_hash]
-        if to_remove:
+        deadline = now_seconds() - self.config.replay_clear_cache_seconds
+        if not self.expiry_heap or self.expiry_heap[0][0] >= deadline:
+            return
+        removed = 0
+        with self.lock:
+            while self.expiry_heap and self.expiry_heap[0][0] < deadline:
+                timestamp, request_hash = heapq.heappop(self.expiry_heap)
+                if self.timestamps.get(request_hash) != timestamp:
+                    continue  # entry already evicted or replaced
+                del self.timestamps[request_hash]
+                if request_hash in self.cache:
+                    del self.cache[request_hash]
+                    removed += 1
+                self.unsaved.discard(request_hash)
+        if removed:
             if self.config.verbose:
-                log.debug('Cache: cleared old cache entries', removed=len(to_remove))
+                log.debug('Cache: cleared old cache entries', removed=removed)
+
+    def _compact(self, entry: CacheEntry) -> CacheEntry:
+        """Keep entry loaded from JSON tape or recorded in a compact form, lazy binary tape entries are small already"""
+        if self.string_pool is None or not isinstance(entry, CacheEntry):
+            return entry
+        return CompactEntry(entry, self.string_pool)
+
+    def _track_expiry(self, request_hash: bytes, entry: CacheEntry):
+        """Queue timestamp of entry put into the cache, for clearing expired entries or evicting by ttl policy"""
+        if not self.config.replay_clear_cache and self.config.cache_eviction != 'ttl':
+            return
+        timestamp = entry.timestamp if isinstance(entry, CompactEntry) else entry.request.timestamp
+        self.timestamps[request_hash] = timestamp
+        heapq.heappush(self.expiry_heap, (timestamp, request_hash))
+
+    def _oldest_entry(self) -> Optional[bytes]:
+        """Key of cached entry with the oldest timestamp, dropping queued timestamps of entries already gone"""
+        while self.expiry_heap:
+            timestamp, request_hash = self.expiry_heap[0]
+            if self.timestamps.get(request_hash) == timestamp and request_hash in self.cache:
+                return request_hash
+            heapq.heappop(self.expiry_heap)
+        return None
+
+    def _expired(self, request_hash: bytes) -> bool:
+        """Expired entry is treated as missing, even if it hasn't been cleared yet"""
+        if not self.config.replay_clear_cache:
+            return False
+        timestamp = self.timestamps.get(request_hash)
+        return timestamp is not None and now_seconds() - timestamp > self.config.replay_clear_cache_seconds
 
     def saving_enabled(self, request: HttpRequest, response: HttpResponse) -> bool:
         return (self.config.record or self.config.replay) and self._can_be_cached(request, response)
 
     def save_response(self, request: HttpRequest, response: HttpResponse):
-        request_hash = self._request_hash(request)
-        if request_hash not in self.cache:
-            self.cache[request_hash] = CacheEntry(request, response)
-            if self.config.record and self.config.record_file:
-                serializable = list(self.cache.values())
-                txt = json.dumps(serializable, sort_keys=True, indent=4, cls=EnhancedJSONEncoder)
-                Path(self.config.record_file).write_text(txt)
-            ctx = {}
-            if self.config.verbose:
-                ctx['traits'] = str(self._request_traits(request))
-            log.debug(f'+ Cache: new request-response recorded',
-                      hash=request_hash, total_entries=len(self.cache), **ctx)
+        traits = self._request_traits(request)
+        request_hash = fingerprint(traits)
+        with self.lock:
+            existing = self.cache.get(request_hash)
+            if existing is not None:
+                if self._request_traits(existing.request) != traits:
+                    log.warn('Cache: request fingerprint collision, entry not recorded', path=request.path)
+                return
+            entry = CacheEntry(request, response)
+            recorded = self.config.record and self.tape is not None
+            if not recorded:
+                self.unsaved.add(request_hash)
+            self.cache[request_hash] = self._compact(entry)
+            self._track_expiry(request_hash, entry)
+        if recorded:
+            self._write_tape([(request_hash, entry)])
+        if self.backend_writer is not None:
+            self.backend_writer.append([(request_hash, entry)])
+        ctx = {}
+        if self.config.verbose:
+            ctx['traits'] = str(traits)
+        log.debug(f'+ Cache: new request-response recorded',
+                  hash=request_hash.hex(), total_entries=len(self.cache), **ctx)
+
+    def _on_evict(self, request_hash: bytes, entry: CacheEntry):
+        """Spill entry evicted from memory to the tape, unless it's already there, and remember it's on the tape"""
+        self.timestamps.pop(request_hash, None)
+        if self.tape is None:
+            self.unsaved.discard(request_hash)
+            return
+        if request_hash in self.unsaved:
+            self.unsaved.discard(request_hash)
+            if not self.config.cache_spill:
+                return
+            self._write_tape([(request_hash, entry)])
+            self.spilled += 1
+        self.evicted.add(request_hash)
+        if isinstance(entry, (LazyCacheEntry, LazyJsonEntry)):
+            self.tape_entries.setdefault(request_hash, entry)
+
+    def _write_tape(self, entries: List[Tuple[bytes, CacheEntry]]):
+        if self.writer is not None:
+            self.writer.append(entries)
+        else:
+            self.tape.append(entries)
+
+    def flush(self):
+        """Wait until entries queued for the tape (and cache backend) are written"""
+        if self.writer is not None:
+            self.writer.flush()
+        if self.backend_writer is not None:
+            self.backend_writer.flush()
+
+    def stats(self) -> Dict[str, int]:
+        stats = {
+            'entries': len(self.cache),
+            'bytes': self.cache.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.cache.evictions,
+            'spilled': self.spilled,
+            'faulted': self.faulted,
+        }
+        if self.backend is not None:
+            stats['shared_hits'] = self.shared_hits
+        return stats
 
-    def _request_hash(self, request: HttpRequest) -> int:
-        traits_str = str(self._request_traits(request))
-        return zlib.adler32(traits_str.encode())
+    def close(self):
+        """Write pending entries and compact the tape journal, dropping duplicated entries recorded on the way"""
+        if self.loader is not None:
+            self.loader.join()
+        if self.writer is not None:
+            self.writer.close()
+        if self.backend_writer is not None:
+            self.backend_writer.close()
+            self.backend.close()
+        if (self.config.record or self.spilled) and self.tape is not None:
+            dropped = self.tape.compact()
+            log.info('Tape compacted', record_file=self.config.record_file, dropped=dropped)
+
+    def request_fingerprint(self, request: HttpRequest) -> bytes:
+        """Key identifying requests treated as the same"""
+        return fingerprint(self._request_traits(request))
 
     def _request_traits(self, request: HttpRequest) -> Tuple:
         if self.extensions.cache_request_traits is None:
@@ -116,6 +391,30 @@ def default_request_traits(request: HttpRequest) -> Tuple:
     return request.method, request.path, request.content, sorted_dict_trait(request.headers)
 
 
+def entry_size(entry: CacheEntry) -> int:
+    """Approximate memory taken by an entry. Lazy entries keep their content in the mapped tape file"""
+    if isinstance(entry, (LazyCacheEntry, LazyJsonEntry)):
+        return ENTRY_OVERHEAD
+    if isinstance(entry, CompactEntry):
+        return ENTRY_OVERHEAD + entry.size()
+    size = ENTRY_OVERHEAD + len(entry.request.content) + len(entry.response.content)
+    for headers in (entry.request.headers, entry.response.headers):
+        size += sum(len(name) + len(value) for name, value in headers.items())
+    return size
+
+
+ENTRY_OVERHEAD = 256
+# entries put into the cache at once when loading the tape
+LOAD_BATCH_SIZE = 1000
+
+
+def default_request_hash(request: HttpRequest) -> bytes:
+    return fingerprint(default_request_traits(request))
+
+
+DEFAULT_KEY_TAG = traits_tag(default_request_traits)
+
+
 def sorted_dict_trait(d: Dict[str, Any]) -> List[Tuple[str, Any]]:
     return sorted([(k, v) for k, v in d.items()], key=lambda t: t[0])
 
@@ -127,14 +426,13 @@ def now_seconds() -> float:
     return datetime.now().timestamp()
 
 
-class EnhancedJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, CacheEntry):
-            d = asdict(obj)
-            d['request'] = obj.request.marshal()
-            return d
-        if is_dataclass(obj):
-            return asdict(obj)
-        if isinstance(obj, bytes):
-            return obj.decode('utf-8')
-        return super().default(obj)
+def open_tape(path: str, entry_key: Callable[[HttpRequest], Any], key_tag: Optional[str],
+              index: bool = False) -> Tape:
+    """
+    Open tape in a format recognized by its content or extension.
+    key_tag names the way of computing entry keys, keys stored in a binary tape are reused only if it matches.
+    With index enabled, JSON Lines tape keeps keys of its entries in a sidecar index.
+    """
+    if is_binary_tape(path):
+        return BinaryTape(path, entry_key, key_tag)
+    return JournalTape(path, entry_key, key_tag if index else None)
@@ -0,0 +1,280 @@
+import json
+from abc import ABC, abstractmethod
+import os
+import socket
+import sqlite3
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+from .entry import CacheEntry, serialize_cache_entry
+
+BACKEND_SCHEMES = ['memory', 'sqlite', 'redis']
+# prefix of keys stored in a RESP server, so they don't mix with other data kept there
+RESP_KEY_PREFIX = b'xman:'
+# max number of SQL parameters used by a single query
+SQLITE_MAX_PARAMS = 500
+
+RespReply = Union[None, int, bytes, List['RespReply']]
+
+
+class CacheBackend(ABC):
+    """
+    Storage of serialized entries shared by xman processes, looked up when an entry is missing in memory.
+    Entries are never replaced: when replicas record the same request, the first entry stored wins,
+    so all of them converge on the same response.
+    """
+
+    @abstractmethod
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, bytes]:
+        """Serialized entries found by keys, missing ones are left out"""
+
+    @abstractmethod
+    def add_many(self, items: List[Tuple[bytes, bytes]]):
+        """Store serialized entries, unless there are entries with the same keys already"""
+
+    def append(self, entries: List[Tuple[bytes, CacheEntry]]):
+        """Store entries, so the backend can be written by TapeWriter like a tape"""
+        self.add_many([(key, encode_entry(entry)) for key, entry in entries])
+
+    def close(self):
+        pass
+
+
+class MemoryBackend(CacheBackend):
+    """Entries kept in a dict of the current process, shared by its threads only"""
+
+    def __init__(self):
+        self.entries: Dict[bytes, bytes] = {}
+        self.lock = threading.Lock()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, bytes]:
+        with self.lock:
+            return {key: self.entries[key] for key in keys if key in self.entries}
+
+    def add_many(self, items: List[Tuple[bytes, bytes]]):
+        with self.lock:
+            for key, value in items:
+                self.entries.setdefault(key, value)
+
+
+class SqliteBackend(CacheBackend):
+    """
+    Entries kept in SQLite database file, shared by processes on the same host.
+    Every thread (and forked process) has its own connection. WAL journal lets readers proceed while one is writing.
+    """
+
+    def __init__(self, path: str, timeout: float = 10):
+        self.path: str = path
+        self.timeout: float = timeout
+        self.local = threading.local()
+        self._connection().execute('CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, entry BLOB NOT NULL)')
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, bytes]:
+        connection = self._connection()
+        found = {}
+        for start in range(0, len(keys), SQLITE_MAX_PARAMS):
+            batch = keys[start:start + SQLITE_MAX_PARAMS]
+            rows = connection.execute(f'SELECT key, entry FROM entries WHERE key IN ({",".join("?" * len(batch))})',
+                                      batch)
+            found.update(rows)
+        return found
+
+    def add_many(self, items: List[Tuple[bytes, bytes]]):
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('INSERT OR IGNORE INTO entries (key, entry) VALUES (?, ?)', items)
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and self.local.pid == os.getpid():
+            connection.close()
+            self.local.connection = None
+
+
+class RespBackend(CacheBackend):
+    """
+    Entries kept in a server speaking RESP (Redis serialization protocol), shared by xman on many hosts.
+    Uses MGET for reads and pipelined SET NX for writes, so a batch takes a single round trip.
+    Every thread (and forked process) has its own connection, the broken one is opened again on the next call.
+    """
+
+    def __init__(self, host: str, port: int = 6379, db: int = 0, password: str = '', timeout: float = 5):
+        self.host: str = host
+        self.port: int = port
+        self.db: int = db
+        self.password: str = password
+        self.timeout: float = timeout
+        self.local = threading.local()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, bytes]:
+        if not keys:
+            return {}
+        values = self._call([[b'MGET'] + [RESP_KEY_PREFIX + key for key in keys]])[0]
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    def add_many(self, items: List[Tuple[bytes, bytes]]):
+        if items:
+            self._call([[b'SET', RESP_KEY_PREFIX + key, value, b'NX'] for key, value in items])
+
+    def _call(self, commands: List[List[bytes]]) -> List[RespReply]:
+        """Send pipelined commands and read their replies"""
+        connection = self._connection()
+        try:
+            connection.sendall(b''.join(encode_command(command) for command in commands))
+            return [self._reply() for _ in commands]
+        except Exception:
+            self.close()
+            raise
+
+    def _connection(self) -> socket.socket:
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and self.local.pid == os.getpid():
+            return connection
+        connection = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.local.connection = connection
+        self.local.pid = os.getpid()
+        self.local.reader = connection.makefile('rb')
+        setup = ([[b'AUTH', self.password.encode()]] if self.password else []) + \
+            ([[b'SELECT', str(self.db).encode()]] if self.db else [])
+        if setup:
+            self._call(setup)
+        return connection
+
+    def _reply(self) -> RespReply:
+        reply = read_reply(self.local.reader)
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and self.local.pid == os.getpid():
+            self.local.reader.close()
+            connection.close()
+        self.local.connection = None
+
+
+class RespError(Exception):
+    pass
+
+
+def encode_command(args: List[bytes]) -> bytes:
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+def read_reply(reader) -> Union[RespReply, RespError]:
+    line = reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError('connection closed by cache server')
+    kind, data = line[:1], line[1:-2]
+    if kind == b'+':
+        return data
+    if kind == b'-':
+        return RespError(data.decode(errors='replace'))
+    if kind == b':':
+        return int(data)
+    if kind == b'$':
+        if int(data) < 0:
+            return None
+        value = reader.read(int(data) + 2)
+        if len(value) != int(data) + 2:
+            raise ConnectionError('connection closed by cache server')
+        return value[:-2]
+    if kind == b'*':
+        if int(data) < 0:
+            return None
+        return [read_reply(reader) for _ in range(int(data))]
+    raise ValueError(f'malformed reply from cache server: {line!r}')
+
+
+class BatchedReader(object):
+    """
+    Looks up keys in the backend in batches: lookups made while one batch is being fetched wait
+    and are fetched together in the next one, the same keys looked up at once are fetched only once.
+    """
+
+    def __init__(self, backend: CacheBackend, batch_size: int = 100):
+        self.backend: CacheBackend = backend
+        self.batch_size: int = max(batch_size, 1)
+        self.cond = threading.Condition()
+        self.pending: Dict[bytes, Future] = {}
+        self.in_flight: Dict[bytes, Future] = {}
+        self.fetching: bool = False
+        self.batches: int = 0
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        with self.cond:
+            future = self.pending.get(key) or self.in_flight.get(key)
+            if future is None:
+                future = self.pending[key] = Future()
+            while not future.done():
+                if self.fetching:
+                    self.cond.wait()
+                    continue
+                self.in_flight = self._take_batch(key)
+                self.fetching = True
+                self.cond.release()
+                try:
+                    self._fetch(self.in_flight)
+                finally:
+                    self.cond.acquire()
+                    self.in_flight = {}
+                    self.fetching = False
+                    self.cond.notify_all()
+        return future.result()
+
+    def _take_batch(self, key: bytes) -> Dict[bytes, Future]:
+        batch = {key: self.pending.pop(key)} if key in self.pending else {}
+        while self.pending and len(batch) < self.batch_size:
+            pending_key = next(iter(self.pending))
+            batch[pending_key] = self.pending.pop(pending_key)
+        return batch
+
+    def _fetch(self, batch: Dict[bytes, Future]):
+        try:
+            found = self.backend.get_many(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+            return
+        self.batches += 1
+        for key, future in batch.items():
+            future.set_result(found.get(key))
+
+
+def encode_entry(entry: CacheEntry) -> bytes:
+    return serialize_cache_entry(entry).encode()
+
+
+def decode_entry(data: bytes) -> CacheEntry:
+    return CacheEntry.from_json(json.loads(data))
+
+
+def open_backend(url: str) -> CacheBackend:
+    """Backend by URL: memory://, sqlite:///path/to/cache.db, redis://[:password@]host[:port][/db]"""
+    split = urlsplit(url)
+    if split.scheme == 'memory':
+        return MemoryBackend()
+    if split.scheme == 'sqlite':
+        return SqliteBackend(split.netloc + split.path)
+    if split.scheme == 'redis':
+        db = split.path.strip('/')
+        return RespBackend(split.hostname or '127.0.0.1', split.port or 6379, int(db) if db else 0,
+                           split.password or '')
+    raise ValueError(f'unknown cache backend: {url}, expected one of schemes: {", ".join(BACKEND_SCHEMES)}')
@@ -1,12 +1,113 @@
-from typing import Iterable, Sequence
+import asyncio
+import socket
+import ssl
+from typing import Iterable, Iterator, List, Sequence, Union
 
+# adaptive chunk size: a body is split into about CHUNKS_PER_BODY chunks, each of them within these bounds
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+CHUNKS_PER_BODY = 16
+# max number of buffers passed to a single vectored send
+IOV_MAX = 1024
+LAST_CHUNK = b'0\r\n\r\n'
+CRLF = b'\r\n'
 
-def send_chunked_response(wfile, content: bytes):
-    content_chunks: Iterable[bytes] = chunks(content, 512)
-    for chunk in content_chunks:
-        tosend = ('%X' % len(chunk)).encode('utf-8') + b'\r\n' + chunk + b'\r\n'
-        wfile.write(tosend)
-    wfile.write('0\r\n\r\n'.encode('utf-8'))
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+def send_chunked_response(out, content: bytes, chunk_size: int = 0):
+    """
+    Send body with chunked Transfer-Encoding, slicing it without copying and writing all chunks at once.
+    :param out: plain socket (vectored send), asyncio.StreamWriter or file-like object
+    :param chunk_size: max size of a chunk in bytes, 0 to adapt it to the body size
+    """
+    buffers = list(chunked_buffers(content, chunk_size or adaptive_chunk_size(len(content))))
+    buffers.append(LAST_CHUNK)
+    send_buffers(out, buffers)
+
+
+def send_chunked_stream(out, stream: Iterable[bytes], chunk_size: int = 0):
+    """
+    Send every block of streamed body as it comes, as a separate chunk.
+    Blocks larger than chunk_size (if it's set) are split into several chunks.
+    """
+    for block in stream:
+        if block:
+            send_buffers(out, list(chunked_buffers(block, chunk_size or len(block))))
+    send_buffers(out, [LAST_CHUNK])
+
+
+def chunked_buffers(content: Buffer, chunk_size: int) -> Iterator[Buffer]:
+    """Chunk headers, body slices (views of the content) and line endings making up a chunked body"""
+    view = memoryview(content)
+    for start in range(0, len(view), chunk_size):
+        chunk = view[start:start + chunk_size]
+        yield b'%X\r\n' % len(chunk)
+        yield chunk
+        yield CRLF
+
+
+def adaptive_chunk_size(content_length: int) -> int:
+    return min(max(content_length // CHUNKS_PER_BODY, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+
+def send_buffers(out, buffers: List[Buffer]):
+    """
+    Write buffers in one go: vectored send on a plain socket, writelines on asyncio writer.
+    Otherwise (TLS socket, file-like object) they're joined into writes of up to MAX_CHUNK_SIZE bytes.
+    """
+    if isinstance(out, asyncio.StreamWriter):
+        out.writelines(buffers)
+        return
+    if isinstance(out, socket.socket):
+        if not isinstance(out, ssl.SSLSocket) and hasattr(out, 'sendmsg'):
+            sendmsg_all(out, buffers)
+            return
+        write = out.sendall
+    else:
+        write = out.write
+    pending: List[Buffer] = []
+    pending_size = 0
+    for buffer in buffers:
+        pending.append(buffer)
+        pending_size += len(buffer)
+        if pending_size >= MAX_CHUNK_SIZE:
+            write(b''.join(pending))
+            pending, pending_size = [], 0
+    if pending:
+        write(b''.join(pending))
+
+
+def sendmsg_all(sock: socket.socket, buffers: List[Buffer]):
+    """Send all buffers with vectored writes, resuming after partial sends"""
+    views = [memoryview(buffer).cast('B') for buffer in buffers]
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index:index + IOV_MAX])
+        while sent > 0:
+            size = len(views[index])
+            if sent >= size:
+                sent -= size
+                index += 1
+            else:
+                views[index] = views[index][sent:]
+                sent = 0
+        while index < len(views) and not views[index]:
+            index += 1
+
+
+def read_chunked_content(rfile) -> bytes:
+    """Read body sent with chunked Transfer-Encoding"""
+    parts = []
+    while True:
+        size_line = rfile.readline()
+        size = int(size_line.split(b';', 1)[0].strip(), 16)
+        if size == 0:
+            while rfile.readline() not in (b'\r\n', b'\n', b''):  # skip trailers
+                pass
+            return b''.join(parts)
+        parts.append(rfile.read(size))
+        rfile.readline()
 
 
 def chunks(lst: Sequence, n: int) -> Iterable:
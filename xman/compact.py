@@ -0,0 +1,82 @@
+from typing import Any, Dict, Optional, Tuple
+
+from .entry import CacheEntry
+from .header import Headers
+from .request import HttpRequest
+from .response import HttpResponse
+
+HeaderPairs = Tuple[Tuple[str, str], ...]
+
+
+class StringPool(object):
+    """
+    Deduplicates strings repeated across many cached entries, like header names & values.
+    Once it holds max_size strings, new ones are no longer added, so unique values can't grow it endlessly.
+    """
+    __slots__ = ('strings', 'max_size')
+
+    def __init__(self, max_size: int = 100000):
+        self.strings: Dict[str, str] = {}
+        self.max_size: int = max_size
+
+    def intern(self, value: str) -> str:
+        if len(self.strings) < self.max_size:
+            return self.strings.setdefault(value, value)
+        return self.strings.get(value, value)
+
+    def header_pairs(self, headers: Headers) -> HeaderPairs:
+        items = headers.multi_items() if isinstance(headers, Headers) else Headers(headers).multi_items()
+        return tuple((self.intern(name), self.intern(value)) for name, value in items)
+
+
+class CompactEntry(object):
+    """
+    Cached request-response entry keeping only what's needed to match the request and replay the response.
+    Client address, request line and metadata are dropped. Request and response are rebuilt on every access.
+    """
+    __slots__ = ('method', 'path', 'request_headers', 'request_content', 'timestamp',
+                 'status_code', 'response_headers', 'response_content', '_encoded', '_wire_heads')
+
+    def __init__(self, entry: CacheEntry, pool: StringPool):
+        request, response = entry.request, entry.response
+        self.method: str = pool.intern(request.method)
+        self.path: str = request.path
+        self.request_headers: HeaderPairs = pool.header_pairs(request.headers)
+        self.request_content: bytes = request.content
+        self.timestamp: float = request.timestamp
+        self.status_code: int = response.status_code
+        self.response_headers: HeaderPairs = pool.header_pairs(response.headers)
+        self.response_content: bytes = response.content
+        # variants built on replay, created on demand to keep entries never replayed small
+        self._encoded: Optional[Dict[str, bytes]] = None
+        self._wire_heads: Optional[Dict[Optional[str], Any]] = None
+
+    @property
+    def request(self) -> HttpRequest:
+        return HttpRequest(requestline=f'{self.method} {self.path} HTTP/1.1', method=self.method, path=self.path,
+                           headers=Headers(self.request_headers), content=self.request_content,
+                           client_addr='', client_port=0, timestamp=self.timestamp)
+
+    @property
+    def response(self) -> HttpResponse:
+        return HttpResponse(status_code=self.status_code, headers=Headers(self.response_headers),
+                            content=self.response_content)
+
+    @property
+    def encoded(self) -> Dict[str, bytes]:
+        if self._encoded is None:
+            self._encoded = {}
+        return self._encoded
+
+    @property
+    def wire_heads(self) -> Dict[Optional[str], Any]:
+        if self._wire_heads is None:
+            self._wire_heads = {}
+        return self._wire_heads
+
+    def size(self) -> int:
+        """Approximate size of variable-length data: bodies and headers"""
+        size = len(self.request_content) + len(self.response_content) + len(self.path)
+        for headers in (self.request_headers, self.response_headers):
+            size += sum(len(name) + len(value) for name, value in headers)
+        return size
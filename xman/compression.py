@@ -0,0 +1,125 @@
+import gzip
+import zlib
+from typing import Callable, Dict, List, Optional
+
+from .header import Headers, get_header, has_header
+from .response import HttpResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Content types worth compressing, besides text/*
+COMPRESSIBLE_TYPES = {'json', 'xml', 'javascript', 'ecmascript', 'x-www-form-urlencoded', 'svg', 'graphql',
+                      'yaml', 'csv'}
+
+
+def _compressors() -> Dict[str, Callable[[bytes], bytes]]:
+    """Available encodings, in order of preference"""
+    compressors: Dict[str, Callable[[bytes], bytes]] = {}
+    if brotli is not None:
+        compressors['br'] = lambda content: brotli.compress(content, quality=5)
+    if zstandard is not None:
+        compressors['zstd'] = lambda content: zstandard.ZstdCompressor(level=3).compress(content)
+    compressors['gzip'] = lambda content: gzip.compress(content, compresslevel=6)
+    compressors['deflate'] = lambda content: zlib.compress(content, 6)
+    return compressors
+
+
+COMPRESSORS = _compressors()
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Choose the available encoding the client prefers, None if identity should be sent"""
+    weights = parse_accept_encoding(accept_encoding)
+    best, best_weight = None, 0.0
+    for encoding in COMPRESSORS:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def parse_accept_encoding(accept_encoding: str) -> Dict[str, float]:
+    weights = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights['gzip' if name == 'x-gzip' else name] = weight
+    return weights
+
+
+def is_compressible(response: HttpResponse, min_size: int) -> bool:
+    if response.stream is not None or len(response.content) < min_size:
+        return False
+    if response.status_code in {204, 206, 304} or has_header(response.headers, 'Content-Encoding'):
+        return False
+    content_type = get_header(response.headers, 'Content-Type', '').split(';', 1)[0].strip().lower()
+    if content_type.startswith('text/'):
+        return True
+    subtype = content_type.partition('/')[2]
+    return any(name in subtype for name in COMPRESSIBLE_TYPES)
+
+
+def compressed_response(response: HttpResponse, accept_encoding: str, min_size: int) -> HttpResponse:
+    """Return response compressed with encoding accepted by the client, or the same response if it's not worth it"""
+    encoding = response_encoding(response, accept_encoding, min_size)
+    if encoding is None:
+        return response
+    return encoded_response(response, encoding)
+
+
+def response_encoding(response: HttpResponse, accept_encoding: str, min_size: int) -> Optional[str]:
+    """Encoding the response should be sent with, None if it's not worth compressing"""
+    if not accept_encoding or not is_compressible(response, min_size):
+        return None
+    return negotiate_encoding(accept_encoding)
+
+
+def encoded_response(response: HttpResponse, encoding: str) -> HttpResponse:
+    """
+    Response compressed with given encoding. Compressed content is kept in response's variants
+    (if it has them, like cached responses), so it's compressed only once.
+    """
+    content = encoded_content(response, encoding)
+    headers = Headers((name, value) for name, value in Headers(response.headers).multi_items()
+                      if name.lower() not in {'content-length', 'vary', 'etag'})
+    headers['Content-Encoding'] = encoding
+    if 'Transfer-Encoding' not in headers:
+        headers['Content-Length'] = str(len(content))
+    headers['Vary'] = _vary_accept_encoding(get_header(response.headers, 'Vary', ''))
+    etag = get_header(response.headers, 'ETag', '')
+    if etag:
+        headers['ETag'] = etag if etag.startswith('W/') else f'W/{etag}'
+    return HttpResponse(status_code=response.status_code, headers=headers, content=content)
+
+
+def encoded_content(response: HttpResponse, encoding: str) -> bytes:
+    if response.encoded is None:
+        return COMPRESSORS[encoding](response.content)
+    content = response.encoded.get(encoding)
+    if content is None:
+        content = response.encoded[encoding] = COMPRESSORS[encoding](response.content)
+    return content
+
+
+def _vary_accept_encoding(vary: str) -> str:
+    values: List[str] = [value.strip() for value in vary.split(',') if value.strip()]
+    if not any(value.lower() in {'accept-encoding', '*'} for value in values):
+        values.append('Accept-Encoding')
+    return ', '.join(values)
@@ -17,6 +17,112 @@ class Config(object):
     # Verbosity level: 0 (disabled), 1 or 2 (highest)
     verbose: int = 0
     allow_chunking: bool = True
+    # Max size of a chunk sent in response with chunked Transfer-Encoding, 0 to adapt it to the body size
+    chunk_size: int = 0
+    # Compress responses with encoding accepted by client: gzip, deflate (br, zstd if brotli, zstandard are installed)
+    compression: bool = True
+    # Responses smaller than this size (in bytes) are sent uncompressed
+    compression_min_size: int = 1024
+    # Responses larger than this size (in bytes) are compressed in a thread pool by asyncio engine,
+    # so that compressing them doesn't hold up other connections
+    compression_offload_size: int = 64 * 1024
+    # Server mode: single (one connection at a time), threaded or multiprocess
+    server_mode: str = 'single'
+    # Number of worker threads (threaded mode) or processes (multiprocess mode)
+    workers: int = 8
+    # Max number of accepted connections waiting for a free worker thread (threaded mode),
+    # above it new connections aren't accepted until one is taken, they wait in the listen backlog
+    accept_queue_size: int = 64
+    # Proxy engine: sync (blocking handlers served according to server_mode) or asyncio (single event loop)
+    engine: str = 'sync'
+    # Keep client connections open for subsequent requests (sync engine, asyncio always does)
+    keep_alive: bool = False
+    # Seconds to wait for the next request on idle client connection
+    keep_alive_timeout: int = 5
+    # Max number of requests served on a single client connection
+    keep_alive_max_requests: int = 100
+    # Relay large request & response bodies in blocks instead of buffering them in memory (sync engine)
+    streaming: bool = False
+    # Size of a block of streamed body in bytes
+    stream_buffer_size: int = 64 * 1024
+    # Max size (in bytes) of streamed response kept aside to be cached, larger ones are relayed but not recorded
+    stream_spool_size: int = 16 * 1024 * 1024
+    # Upstream connection pooling: number of destination hosts to keep pools for
+    upstream_pool_size: int = 10
+    # Max number of idle connections kept to a single upstream host
+    upstream_max_connections: int = 10
+    # Seconds after which idle upstream connections are closed
+    upstream_idle_timeout: int = 60
+    # Max number of entries kept in memory by the cache, 0 for no limit
+    cache_max_entries: int = 0
+    # Max total size of entries (bodies and headers) kept in memory by the cache in bytes, 0 for no limit
+    cache_max_bytes: int = 0
+    # Entry evicted when cache is full: lru (least recently used), lfu (least frequently used), fifo (first inserted),
+    # ttl (the oldest recorded one, closest to expiry)
+    # Evicted entries recorded on the tape are read back from it when they're requested again
+    cache_eviction: str = 'lru'
+    # Keep index of JSON Lines tape entries in a sidecar file (<record_file>.idx), so that loading doesn't parse them
+    tape_index: bool = True
+    # Start serving while the tape is being loaded, lookups of requests not loaded yet wait until it's done
+    tape_background_load: bool = False
+    # Write recorded entries to the tape in a background thread, so responses don't wait for the disk
+    record_async: bool = True
+    # Max number of entries written to the tape at once by the background writer
+    record_batch_size: int = 100
+    # Max number of entries waiting to be written, recording waits for the writer above it
+    record_queue_size: int = 10000
+    # Syncing the tape to disk: never (left to the OS), interval (every record_fsync_interval), batch (every write)
+    record_fsync: str = 'never'
+    # Seconds between syncing the tape to disk with interval fsync policy
+    record_fsync_interval: float = 1.0
+    # URL of cache shared by xman processes and hosts, looked up on a miss in memory and storing new entries:
+    # sqlite:///path/to/cache.db (processes on the same host), redis://host:port/db (RESP server), empty to disable
+    cache_backend: str = ''
+    # Max number of entries read from or written to the cache backend at once
+    cache_backend_batch_size: int = 100
+    # Write evicted entries to the tape if they're not recorded there yet, so they are not lost
+    cache_spill: bool = False
+    # Identical requests missing in cache at the same time wait for a single upstream call and share its response
+    coalesce_requests: bool = False
+    # Max seconds to wait for the identical request in flight, before making own upstream call
+    coalesce_timeout: int = 10
+    # Max requests per second accepted for a single key (see rate_limit_by), 0 for no limit
+    rate_limit: float = 0
+    # Number of requests that can be accepted at once, above the rate
+    rate_limit_burst: int = 10
+    # Requests are limited per: client (address), path (first segment of path), global (all together)
+    rate_limit_by: str = 'client'
+    # Max requests per second sent to a single upstream URL, 0 for no limit. Requests above wait for their turn
+    upstream_rate_limit: float = 0
+    # Number of requests that can be sent upstream at once, above the rate
+    upstream_rate_limit_burst: int = 10
+    # Requests are balanced between destination URLs (given separated by commas) by:
+    # round-robin, least-requests (fewest requests in flight), hash (the same requests go to the same upstream)
+    upstream_balancing: str = 'round-robin'
+    # Max times a failed idempotent request is retried on another upstream
+    upstream_retries: int = 1
+    # Retries can't exceed this fraction of requests made (plus a few per 10 seconds)
+    upstream_retry_budget: float = 0.2
+    # Number of consecutive failures (unreachable, 502, 503, 504) after which upstream is ejected from balancing
+    upstream_eject_failures: int = 5
+    # Seconds the upstream is ejected for, multiplied by number of its ejections so far
+    upstream_eject_seconds: float = 30
+    # Path requested periodically to check health of upstreams (eg. /health), empty to disable active checks
+    upstream_health_path: str = ''
+    # Seconds between health checks of upstreams
+    upstream_health_interval: float = 10
+    # Directory with mock responses (fixture files) served instead of proxying, see MockStore
+    mock_dir: str = ''
+    # Mock bodies larger than this size (in bytes) are not loaded into memory, they're sent from the file
+    mock_sendfile_size: int = 1024 * 1024
+    # Path on which metrics are returned in Prometheus text format instead of proxying (eg. /__xman/metrics)
+    metrics_path: str = ''
+    # Port of a separate HTTP server exposing metrics, 0 to disable it
+    metrics_port: int = 0
+
+    @property
+    def metrics_enabled(self) -> bool:
+        return bool(self.metrics_path or self.metrics_port)
 
     @property
     def listen_scheme(self) -> str:
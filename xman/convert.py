@@ -0,0 +1,37 @@
+import os
+
+from nuclear import CliBuilder, argument
+from nuclear.sublog import log, wrap_context
+
+from .cache import open_tape, default_request_hash, DEFAULT_KEY_TAG
+from .entry import CacheEntry
+from .version import __version__
+
+
+def convert_tape(src_file: str, dst_file: str) -> int:
+    """
+    Copy entries from one tape to another, format of each one is recognized by its content or extension
+    (.xtape for binary tape, JSON Lines otherwise).
+    :return: number of converted entries
+    """
+    with wrap_context('converting tape', src_file=src_file, dst_file=dst_file):
+        if not os.path.isfile(src_file):
+            raise FileNotFoundError(f'tape file not found: {src_file}')
+        if os.path.exists(dst_file):
+            raise FileExistsError(f'destination tape already exists: {dst_file}')
+        src = open_tape(src_file, default_request_hash, DEFAULT_KEY_TAG)
+        dst = open_tape(dst_file, default_request_hash, DEFAULT_KEY_TAG)
+        entries = [(key, CacheEntry(entry.request, entry.response)) for key, entry in src.load()]
+        dst.prepare_recording()
+        dst.append(entries)
+        dst.compact()
+        log.info('Tape converted', src_file=src_file, dst_file=dst_file, entries=len(entries))
+        return len(entries)
+
+
+def main():
+    CliBuilder('xman-tape', run=convert_tape, help_on_empty=True, version=__version__,
+               help='Convert xman tape between JSON Lines and binary (.xtape) format').has(
+        argument('src_file', help='tape to read entries from'),
+        argument('dst_file', help='new tape to write entries to, binary one if it has .xtape extension'),
+    ).run()
@@ -0,0 +1,49 @@
+import json
+
+from typing import Dict, Optional, Any
+
+from dataclasses import dataclass, is_dataclass, asdict, field
+
+from .header import Headers
+from .request import HttpRequest
+from .response import HttpResponse
+
+
+@dataclass
+class CacheEntry(object):
+    request: HttpRequest
+    response: HttpResponse
+    """Compressed variants of response content by encoding, kept in memory only"""
+    encoded: Dict[str, bytes] = field(default_factory=dict, compare=False, repr=False)
+    """Serialized status line & headers of response by content encoding, built on the first replay"""
+    wire_heads: Dict[Optional[str], Any] = field(default_factory=dict, compare=False, repr=False)
+
+    @staticmethod
+    def from_json(data: dict) -> 'CacheEntry':
+        return CacheEntry(
+            request=HttpRequest.from_json(data.get('request')),
+            response=HttpResponse.from_json(data.get('response')),
+        )
+
+
+def serialize_cache_entry(entry: CacheEntry) -> str:
+    """Serialize entry to JSON, entries of other kinds (compact, lazy) are serialized the same way"""
+    if not isinstance(entry, CacheEntry):
+        entry = CacheEntry(entry.request, entry.response)
+    return json.dumps(entry, sort_keys=True, cls=EnhancedJSONEncoder)
+
+
+class EnhancedJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, CacheEntry):
+            return {
+                'request': obj.request.marshal(),
+                'response': obj.response.marshal(),
+            }
+        if isinstance(obj, Headers):
+            return obj.marshal()
+        if is_dataclass(obj):
+            return asdict(obj)
+        if isinstance(obj, bytes):
+            return obj.decode('utf-8')
+        return super().default(obj)
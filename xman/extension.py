@@ -7,6 +7,7 @@ from nuclear.sublog import log
 from .config import Config
 from .request import HttpRequest
 from .response import HttpResponse
+from .routing import RouteTable
 
 
 @dataclass
@@ -17,6 +18,8 @@ class Extensions(object):
     can_be_cached: Optional[Callable[[HttpRequest, HttpResponse], bool]] = None
     cache_request_traits: Optional[Callable[[HttpRequest], Tuple]] = None
     override_config: Optional[Callable[[Config], None]] = None
+    rate_limit_key: Optional[Callable[[HttpRequest], Optional[str]]] = None
+    routes: Optional[RouteTable] = None
 
 
 def load_extensions(extension_path: str) -> Extensions:
@@ -37,3 +40,19 @@ def load_extensions(extension_path: str) -> Extensions:
     log.info('Loaded extensions', file=extension_path, extensions=loaded)
 
     return ext
+
+
+def apply_routes(ext: Extensions) -> Extensions:
+    """Chain hooks of the routes with the global ones, only hooks used by any route are set"""
+    if ext.routes is None:
+        return ext
+    if ext.routes.has_hook('transform_request') or ext.routes.has_hook('dst_url'):
+        ext.transform_request = ext.routes.request_hook(ext.transform_request)
+    if ext.routes.has_hook('respond'):
+        ext.immediate_responder = ext.routes.responder_hook(ext.immediate_responder)
+    if ext.routes.has_hook('transform_response'):
+        ext.transform_response = ext.routes.response_hook(ext.transform_response)
+    if ext.routes.has_hook('cacheable'):
+        ext.can_be_cached = ext.routes.cacheable_hook(ext.can_be_cached)
+    log.info('Routes registered', routes=len(ext.routes.routes))
+    return ext
@@ -0,0 +1,68 @@
+import hashlib
+from typing import Any, Callable
+
+FINGERPRINT_NAME = 'blake2b-128'
+FINGERPRINT_SIZE = 16
+
+
+def fingerprint(traits: Any) -> bytes:
+    """
+    128-bit BLAKE2b digest of request traits.
+    Traits are fed to the hash in a canonical, length-prefixed binary encoding, so bodies are never stringified.
+    """
+    digest = hashlib.blake2b(digest_size=FINGERPRINT_SIZE)
+    _feed(digest, traits)
+    return digest.digest()
+
+
+def traits_tag(traits: Callable) -> str:
+    """
+    Tag of the way entry keys are computed: fingerprint and code of the traits function (short enough for tape headers).
+    Keys stored along with another tag, eg. by a changed traits function, are computed again.
+    """
+    digest = hashlib.blake2b(FINGERPRINT_NAME.encode(), digest_size=6)
+    code = getattr(traits, '__code__', None) or getattr(getattr(traits, '__call__', None), '__code__', None)
+    if code is None:
+        _feed(digest, repr(traits))
+    else:
+        _feed_code(digest, code)
+    return f'b2-{digest.hexdigest()}'
+
+
+def _feed_code(digest, code):
+    """Feed instructions, names and constants of the code object, leaving out its location"""
+    _feed_bytes(digest, b'c', code.co_code)
+    _feed(digest, code.co_names)
+    digest.update(b'l%d:' % len(code.co_consts))
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            _feed_code(digest, const)
+        elif isinstance(const, frozenset):
+            _feed(digest, sorted(repr(item) for item in const))  # order of set items varies between processes
+        else:
+            _feed(digest, const)
+
+
+def _feed(digest, value: Any):
+    if isinstance(value, bytes):
+        _feed_bytes(digest, b'b', value)
+    elif isinstance(value, str):
+        _feed_bytes(digest, b's', value.encode('utf-8', 'surrogatepass'))
+    elif isinstance(value, (tuple, list)):
+        digest.update(b'l%d:' % len(value))
+        for item in value:
+            _feed(digest, item)
+    elif isinstance(value, dict):
+        digest.update(b'd%d:' % len(value))
+        for key, item in sorted(value.items(), key=lambda kv: repr(kv[0])):
+            _feed(digest, key)
+            _feed(digest, item)
+    elif value is None or isinstance(value, (bool, int, float)):
+        _feed_bytes(digest, b'n', repr(value).encode())
+    else:
+        _feed_bytes(digest, b'r', repr(value).encode('utf-8', 'surrogatepass'))
+
+
+def _feed_bytes(digest, tag: bytes, data: bytes):
+    digest.update(b'%s%d:' % (tag, len(data)))
+    digest.update(data)
@@ -1,105 +1,261 @@
+import time
+from http.client import responses
 from http.server import SimpleHTTPRequestHandler
-from typing import Optional
+from typing import Optional, Iterable, List
 
 from nuclear.sublog import log, wrap_context, logerr
 
-from xman.chunk import send_chunked_response
-from xman.header import has_header, get_header
+from xman.chunk import send_chunked_response, read_chunked_content, send_chunked_stream, send_buffers, \
+    chunked_buffers, adaptive_chunk_size, Buffer, CRLF, LAST_CHUNK
+from xman.header import has_header, Headers
+from .balancer import UpstreamPool
 from .cache import RequestCache, now_seconds
+from .compression import compressed_response, response_encoding, encoded_response, encoded_content
 from .config import Config
 from .extension import Extensions
-from .proxy import proxy_request
+from .metrics import Metrics, PROMETHEUS_CONTENT_TYPE
+from .mock_store import FileBody
+from .proxy import proxy_request, SessionPool
+from .ratelimit import RateLimiter, rate_limited_response
 from .request import HttpRequest
 from .response import HttpResponse
+from .singleflight import SingleFlight
+from .stream import BodyStream, ChunkedBodyStream, tee_stream
 
 
 class RequestHandler(SimpleHTTPRequestHandler):
     extensions: Extensions
     config: Config
     cache: RequestCache
+    session_pool: Optional[SessionPool] = None
+    singleflight: SingleFlight = SingleFlight()
+    rate_limiter: Optional[RateLimiter] = None
+    upstream_rate_limiter: Optional[RateLimiter] = None
+    upstreams: Optional[UpstreamPool] = None
+    metrics: Metrics = Metrics(enabled=False)
+    protocol_version = 'HTTP/1.1'
+    # head and body are written separately, Nagle's algorithm would delay the body on kept-alive connections
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.requests_served: int = 0
+        self.request_stream = None
 
     def handle_request(self):
+        self.requests_served += 1
+        self.request_stream = None
+        keep_alive_requested = not self.close_connection
+        # connection is closed unless the response is sent successfully
+        self.close_connection = True
+        start = time.perf_counter()
         with logerr('handling request'):
             self.connection.settimeout(self.config.timeout)
-            incoming_request = self.incoming_request()
+            with self.metrics.timer('read_request'):
+                incoming_request = self.incoming_request()
+            if self.config.metrics_path and incoming_request.path == self.config.metrics_path:
+                self.respond_to_client(metrics_response(self.metrics), keep_alive_requested)
+                return
+            self.metrics.request_received(request_body_size(incoming_request))
             incoming_request.log(self.config.verbose)
             response_0 = self.generate_response(incoming_request)
-            response = response_0.transform(self.extensions.transform_response, incoming_request)
+            if is_fast_replay(response_0, self.extensions):
+                with self.metrics.timer('write_response'):
+                    self.respond_from_cache(response_0, keep_alive_requested)
+                self.metrics.client_response(response_0.status_code)
+                self.metrics.observe('total', time.perf_counter() - start)
+                return
+            with self.metrics.timer('transform_response'):
+                response = response_0.transform(self.extensions.transform_response, incoming_request)
             if response != response_0 and self.config.verbose >= 2:
                 response.log('response transformed', self.config.verbose)
-            self.respond_to_client(response)
+            with self.metrics.timer('write_response'):
+                self.respond_to_client(response, keep_alive_requested)
+            self.metrics.client_response(response.status_code)
+            self.metrics.observe('total', time.perf_counter() - start)
 
     def incoming_request(self) -> HttpRequest:
         with wrap_context('building incoming request'):
-            headers_dict = {key: self.headers[key] for key in self.headers.keys()}
+            headers = Headers(self.headers.items())
             method = self.command.upper()
-            content_len = int(get_header(headers_dict, 'Content-Length', '0'))
-            content: bytes = self.rfile.read(content_len) if content_len else b''
+            chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+            content_len = 0 if chunked else int(headers.get('Content-Length', '0'))
+            content: bytes = b''
+            if self.request_streaming_enabled() and (chunked or content_len > self.config.stream_buffer_size):
+                if chunked:
+                    self.request_stream = ChunkedBodyStream(self.rfile, self.config.stream_buffer_size)
+                else:
+                    self.request_stream = BodyStream(self.rfile, content_len, self.config.stream_buffer_size)
+            elif chunked:
+                content = read_chunked_content(self.rfile)
+                set_decoded_body_length(headers, content)
+            elif content_len:
+                content = self.rfile.read(content_len)
             return HttpRequest(requestline=self.requestline, method=method, path=self.path,
-                               headers=headers_dict, content=content,
+                               headers=headers, content=content,
                                client_addr=self.client_address[0], client_port=self.client_address[1],
-                               timestamp=now_seconds())
+                               timestamp=now_seconds(), stream=self.request_stream)
+
+    def request_streaming_enabled(self) -> bool:
+        """Request body can't be streamed if anything needs to look into it before proxying"""
+        return self.config.streaming and not self.config.record and not self.config.replay and \
+            self.extensions.transform_request is None and self.extensions.immediate_responder is None
+
+    def response_streaming_enabled(self) -> bool:
+        return self.config.streaming and self.extensions.transform_response is None
 
     def generate_response(self, request_0: HttpRequest) -> HttpResponse:
         with wrap_context('generating response'):
-            request = request_0.transform(self.extensions.transform_request)
+            with self.metrics.timer('transform_request'):
+                request = request_0.transform(self.extensions.transform_request)
             if request != request_0 and self.config.verbose >= 2:
                 log.debug('request transformed')
 
-            immediate_reponse = self.find_immediate_response(request)
+            limited_response = rate_limited_response(self.rate_limiter, request, self.config.rate_limit_by,
+                                                     self.extensions.rate_limit_key)
+            if limited_response is not None:
+                self.metrics.inc('rate_limited')
+                return limited_response.log('> rate limit exceeded', self.config.verbose)
+
+            with self.metrics.timer('immediate_responder'):
+                immediate_reponse = self.find_immediate_response(request)
             if immediate_reponse:
                 return immediate_reponse.log('> immediate response', self.config.verbose)
 
-            self.cache.clear_old()
-            if self.cache.has_cached_response(request):
-                return self.cache.replay_response(request).log('> Cache: returning cached response',
-                                                               self.config.verbose)
+            with self.metrics.timer('cache_lookup'):
+                self.cache.clear_old()
+                cached_response = self.cache.find_cached_response(request)
+            if cached_response is not None:
+                self.metrics.inc('replayed')
+                return cached_response.log('> Cache: returning cached response', self.config.verbose)
 
             if self.config.replay and self.config.verbose:
                 log.warn('request not found in cache', path=request.path)
-            response: HttpResponse = proxy_request(request, default_url=self.config.dst_url,
-                                                   timeout=self.config.timeout, verbose=self.config.verbose)
+            # streamed request bodies are left out of the fingerprint, so such requests can't share a response
+            if not self.config.coalesce_requests or self.response_streaming_enabled() or request.stream is not None:
+                return self.fetch_response(request)
+
+            response, shared = self.singleflight.do(self.cache.request_fingerprint(request),
+                                                    lambda: self.fetch_response(request),
+                                                    self.config.coalesce_timeout)
+            if shared and self.config.verbose:
+                log.debug('> response shared with identical request in flight', path=request.path)
+            return response.copy()
 
-            if self.cache.saving_enabled(request, response):
-                self.cache.save_response(request, response)
+    def fetch_response(self, request: HttpRequest) -> HttpResponse:
+        """Proxy request to upstream and save the response to cache"""
+        stream_buffer_size = self.config.stream_buffer_size if self.response_streaming_enabled() else 0
+        with self.metrics.timer('proxy'):
+            response: HttpResponse = proxy_request(request, default_url=self.config.dst_url,
+                                                   timeout=self.config.timeout, verbose=self.config.verbose,
+                                                   session_pool=self.session_pool,
+                                                   stream_buffer_size=stream_buffer_size,
+                                                   rate_limiter=self.upstream_rate_limiter,
+                                                   upstreams=self.upstreams)
+        self.metrics.upstream_response(response.status_code, failed=is_proxy_error(response))
 
+        if response.stream is not None:
+            if self.config.record or self.config.replay:
+                response.stream = self.recorded_stream(request, response)
             return response
 
+        if self.cache.saving_enabled(request, response):
+            self.cache.save_response(request, response)
+
+        return response
+
+    def recorded_stream(self, request: HttpRequest, response: HttpResponse) -> Iterable[bytes]:
+        """Relay streamed response to client and save it to cache once it's completely received"""
+        def on_complete(content: Optional[bytes]):
+            if content is None:
+                log.warn('Response too large to be cached, not recorded', path=request.path,
+                         max_size=self.config.stream_spool_size)
+                return
+            full_response = HttpResponse(status_code=response.status_code, headers=response.headers,
+                                         content=content)
+            if self.cache.saving_enabled(request, full_response):
+                self.cache.save_response(request, full_response)
+
+        return tee_stream(response.stream, self.config.stream_spool_size, on_complete)
+
     def find_immediate_response(self, request: HttpRequest) -> Optional[HttpResponse]:
         if self.extensions.immediate_responder is None:
             return None
         return self.extensions.immediate_responder(request)
 
-    def respond_to_client(self, response: HttpResponse):
+    def respond_to_client(self, response: HttpResponse, keep_alive_requested: bool = False):
         with wrap_context('responding to client'):
+            normalize_response_headers(response, self.config.verbose)
+            if self.config.compression:
+                response = compressed_response(response, self.headers.get('Accept-Encoding', ''),
+                                               self.config.compression_min_size)
             self.send_response_only(response.status_code)
-
-            if has_header(response.headers, 'Content-Encoding'):
-                del response.headers['Content-Encoding']
-                if self.config.verbose >= 2:
-                    log.debug('removing Content-Encoding header')
-
-            if not has_header(response.headers, 'Content-Length') and \
-                    not has_header(response.headers, 'Transfer-Encoding') and response.content:
-                response.headers['Content-Length'] = str(len(response.content))
-                log.warn('adding missing Content-Length header')
-
-            if has_header(response.headers, 'Content-Length') and has_header(response.headers, 'Transfer-Encoding'):
-                del response.headers['Content-Length']
-                log.warn('removed Content-Length header conflicting with Transfer-Encoding')
-
-            for name, value in response.headers.items():
-                self.send_header(name, value)
+            keep_alive = self.config.keep_alive and keep_alive_requested and \
+                self.requests_served < self.config.keep_alive_max_requests and \
+                has_message_framing(self.command, response, self.config.allow_chunking) and \
+                (self.request_stream is None or self.request_stream.exhausted)
+            for name, value in response.headers.multi_items():
+                if name.lower() not in CONNECTION_HEADERS:
+                    self.send_header(name, value)
+            if not keep_alive:
+                self.send_header('Connection', 'close')
             self.end_headers()
 
-            if self.config.allow_chunking and response.headers.get('Transfer-Encoding') == 'chunked':
-                send_chunked_response(self.wfile, response.content)
+            chunked = self.config.allow_chunking and response.headers.get('Transfer-Encoding') == 'chunked'
+            with_body = has_message_body(self.command, response)
+            if not with_body:
+                if hasattr(response.stream, 'close'):
+                    response.stream.close()
+            elif isinstance(response.stream, FileBody) and not chunked:
+                response.stream.send_to(self.connection)
+                self.metrics.inc('bytes_out', response.stream.size)
+            elif response.stream is not None:
+                stream = self.metrics.counted_stream(response.stream) if self.metrics.enabled else response.stream
+                if chunked:
+                    send_chunked_stream(self.connection, stream, self.config.chunk_size)
+                else:
+                    for block in stream:
+                        self.wfile.write(block)
+            elif chunked:
+                send_chunked_response(self.connection, response.content, self.config.chunk_size)
             else:
                 self.wfile.write(response.content)
-            self.close_connection = True
+            if response.stream is None and with_body:
+                self.metrics.inc('bytes_out', len(response.content))
+            self.close_connection = not keep_alive
+            if keep_alive:
+                self.connection.settimeout(self.config.keep_alive_timeout)
+            if self.config.verbose >= 2:
+                log.debug('> response sent', client_addr=self.client_address[0], client_port=self.client_address[1])
+
+    def respond_from_cache(self, response: HttpResponse, keep_alive_requested: bool):
+        """Send cached response with its status line & headers serialized once, in a single write"""
+        with wrap_context('responding to client'):
+            encoding = None
+            if self.config.compression:
+                encoding = response_encoding(response, self.headers.get('Accept-Encoding', ''),
+                                             self.config.compression_min_size)
+            head = wire_head(response, encoding, self.config)
+            keep_alive = self.config.keep_alive and keep_alive_requested and \
+                self.requests_served < self.config.keep_alive_max_requests and \
+                (head.framed or self.command == 'HEAD') and \
+                (self.request_stream is None or self.request_stream.exhausted)
+            content = response.content if encoding is None else encoded_content(response, encoding)
+            with_body = has_message_body(self.command, response)
+            send_buffers(self.connection, wire_buffers(head, content, keep_alive, self.config.chunk_size, with_body))
+            if with_body:
+                self.metrics.inc('bytes_out', len(content))
+            self.close_connection = not keep_alive
+            if keep_alive:
+                self.connection.settimeout(self.config.keep_alive_timeout)
             if self.config.verbose >= 2:
                 log.debug('> response sent', client_addr=self.client_address[0], client_port=self.client_address[1])
 
+    def log_error(self, format: str, *args):
+        """Protocol errors, like idle keep-alive connection timing out"""
+        if self.config.verbose:
+            log.debug(format % args, client_addr=self.client_address[0], client_port=self.client_address[1])
+
     def do_GET(self):
         self.handle_request()
 
@@ -114,3 +270,121 @@ class RequestHandler(SimpleHTTPRequestHandler):
 
     def do_HEAD(self):
         self.handle_request()
+
+
+# headers describing a connection with a client, set by xman itself
+CONNECTION_HEADERS = {'connection', 'keep-alive'}
+
+
+class WireHead(object):
+    """Serialized status line & headers of a cached response, without Connection header and the final empty line"""
+    __slots__ = ('data', 'framed', 'chunked')
+
+    def __init__(self, data: bytes, framed: bool, chunked: bool):
+        self.data: bytes = data
+        # whether client can find the end of response without connection being closed
+        self.framed: bool = framed
+        self.chunked: bool = chunked
+
+
+CONNECTION_CLOSE = b'Connection: close\r\n'
+
+
+def is_fast_replay(response: HttpResponse, extensions: Extensions) -> bool:
+    """Cached response can be sent as it is, if nothing is going to transform it"""
+    return response.wire_heads is not None and response.stream is None and extensions.transform_response is None
+
+
+def wire_head(response: HttpResponse, encoding: Optional[str], config: Config) -> WireHead:
+    """Serialize head of cached response once per content encoding, keeping it along with the cache entry"""
+    head = response.wire_heads.get(encoding)
+    if head is None:
+        normalize_response_headers(response, config.verbose)
+        variant = response if encoding is None else encoded_response(response, encoding)
+        lines = [f'HTTP/1.1 {variant.status_code} {responses.get(variant.status_code, "")}']
+        for name, value in variant.headers.multi_items():
+            if name.lower() not in CONNECTION_HEADERS:
+                lines.append(f'{name}: {value}')
+        data = ('\r\n'.join(lines) + '\r\n').encode('latin-1')
+        framed = has_message_framing('GET', variant, config.allow_chunking)
+        chunked = config.allow_chunking and variant.headers.get('Transfer-Encoding') == 'chunked'
+        head = response.wire_heads[encoding] = WireHead(data, framed, chunked)
+    return head
+
+
+def wire_buffers(head: WireHead, content: bytes, keep_alive: bool, chunk_size: int,
+                 with_body: bool = True) -> List[Buffer]:
+    """Whole response to be sent at once: head, connection header and body (sliced into chunks if needed)"""
+    buffers: List[Buffer] = [head.data]
+    if not keep_alive:
+        buffers.append(CONNECTION_CLOSE)
+    buffers.append(CRLF)
+    if not with_body:
+        return buffers
+    if head.chunked:
+        buffers.extend(chunked_buffers(content, chunk_size or adaptive_chunk_size(len(content))))
+        buffers.append(LAST_CHUNK)
+    elif content:
+        buffers.append(content)
+    return buffers
+
+
+def is_proxy_error(response: HttpResponse) -> bool:
+    """Tell whether response was made by xman because upstream couldn't be reached"""
+    return 'X-Man-Error' in response.headers
+
+
+def request_body_size(request: HttpRequest) -> int:
+    if request.stream is not None and hasattr(request.stream, '__len__'):
+        return len(request.stream)
+    return len(request.content)
+
+
+def metrics_response(metrics: Metrics) -> HttpResponse:
+    content = metrics.render().encode()
+    return HttpResponse(status_code=200, headers={
+        'Content-Type': PROMETHEUS_CONTENT_TYPE,
+        'Content-Length': str(len(content)),
+    }, content=content)
+
+
+def has_message_body(method: str, response: HttpResponse) -> bool:
+    """Responses to HEAD and 1xx, 204, 304 responses have headers only, even if they describe a body"""
+    return not (method == 'HEAD' or response.status_code in {204, 304} or 100 <= response.status_code < 200)
+
+
+def has_message_framing(method: str, response: HttpResponse, allow_chunking: bool) -> bool:
+    """Tell whether client can find the end of response without connection being closed"""
+    if not has_message_body(method, response):
+        return True
+    if has_header(response.headers, 'Transfer-Encoding'):
+        return allow_chunking and response.headers.get('Transfer-Encoding') == 'chunked'
+    return has_header(response.headers, 'Content-Length')
+
+
+def set_decoded_body_length(headers: Headers, content: bytes):
+    """Replace framing headers of a chunked request body that has been decoded with its length"""
+    del headers['Transfer-Encoding']
+    headers['Content-Length'] = str(len(content))
+
+
+def normalize_response_headers(response: HttpResponse, verbose: int):
+    """Fix response headers before sending: content is already decoded, framing headers must be consistent"""
+    if not isinstance(response.headers, Headers):
+        response.headers = Headers(response.headers)
+    headers = response.headers
+    if 'Content-Encoding' in headers:
+        del headers['Content-Encoding']
+        if verbose >= 2:
+            log.debug('removing Content-Encoding header')
+        if response.stream is None and response.content and 'Content-Length' in headers:
+            # length of decoded content, not the one sent by upstream
+            headers['Content-Length'] = str(len(response.content))
+
+    if 'Content-Length' not in headers and 'Transfer-Encoding' not in headers and response.content:
+        headers['Content-Length'] = str(len(response.content))
+        log.warn('adding missing Content-Length header')
+
+    if 'Content-Length' in headers and 'Transfer-Encoding' in headers:
+        del headers['Content-Length']
+        log.warn('removed Content-Length header conflicting with Transfer-Encoding')
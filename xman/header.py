@@ -1,14 +1,128 @@
-from typing import Dict
+from collections import abc
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
 
+HeaderValue = Union[str, List[str]]
+# field of serialized request or response with all values of repeated headers
+REPEATED_HEADERS = 'repeated_headers'
 
-def get_header(headers: Dict[str, str], name: str, default_value: str) -> str:
+
+class Headers(abc.MutableMapping):
+    """
+    HTTP headers looked up by case-insensitive name, keeping original names and order.
+    Repeated headers (like Set-Cookie) keep all their values: get_all returns them separately,
+    while indexing returns them joined with a comma.
+    """
+    __slots__ = ('fields',)
+
+    def __init__(self, headers: Union[Mapping[str, HeaderValue], Iterable[Tuple[str, str]], None] = None):
+        # lowercase name -> (original name, values)
+        self.fields: Dict[str, Tuple[str, List[str]]] = {}
+        if headers is None:
+            return
+        if isinstance(headers, Headers):
+            items = headers.multi_items()
+        elif isinstance(headers, abc.Mapping):
+            items = headers.items()
+        else:
+            items = headers
+        for name, value in items:
+            if isinstance(value, list):
+                for item in value:
+                    self.add(name, item)
+            else:
+                self.add(name, value)
+
+    def __getitem__(self, name: str) -> str:
+        values = self.fields[name.lower()][1]
+        return values[0] if len(values) == 1 else ', '.join(values)
+
+    def __setitem__(self, name: str, value: str):
+        """Replace all values of a header, keeping its original name if it's already there"""
+        key = name.lower()
+        field = self.fields.get(key)
+        self.fields[key] = (name if field is None else field[0], [value])
+
+    def __delitem__(self, name: str):
+        del self.fields[name.lower()]
+
+    def __contains__(self, name: object) -> bool:
+        return isinstance(name, str) and name.lower() in self.fields
+
+    def __iter__(self) -> Iterator[str]:
+        return (name for name, _ in list(self.fields.values()))
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+    def __repr__(self) -> str:
+        return repr(self.marshal())
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        field = self.fields.get(name.lower())
+        if field is None:
+            return default
+        values = field[1]
+        return values[0] if len(values) == 1 else ', '.join(values)
+
+    def add(self, name: str, value: str):
+        """Add another value of a header, keeping the existing ones"""
+        field = self.fields.get(name.lower())
+        if field is None:
+            self.fields[name.lower()] = (name, [value])
+        else:
+            field[1].append(value)
+
+    def get_all(self, name: str) -> List[str]:
+        field = self.fields.get(name.lower())
+        return [] if field is None else list(field[1])
+
+    def multi_items(self) -> List[Tuple[str, str]]:
+        """Every header line, with repeated headers listed separately"""
+        return [(name, value) for name, values in self.fields.values() for value in values]
+
+    def copy(self) -> 'Headers':
+        return Headers(self)
+
+    def marshal(self) -> Dict[str, str]:
+        """JSON-compatible dict of strings, values of repeated header joined with a comma"""
+        return {name: values[0] if len(values) == 1 else ', '.join(values) for name, values in self.fields.values()}
+
+    def marshal_repeated(self) -> Dict[str, List[str]]:
+        """Every value of repeated headers"""
+        return {name: list(values) for name, values in self.fields.values() if len(values) > 1}
+
+
+def marshal_headers(data: dict, headers: Mapping[str, str]):
+    """
+    Put headers into serialized request or response. Headers stay a dict of strings, as tape readers expect,
+    values of repeated headers are kept separately in an optional field
+    """
+    data['headers'] = headers.marshal() if isinstance(headers, Headers) else dict(headers)
+    repeated = headers.marshal_repeated() if isinstance(headers, Headers) else {}
+    if repeated:
+        data[REPEATED_HEADERS] = repeated
+
+
+def unmarshal_headers(data: dict) -> dict:
+    """Put all values of repeated headers back to headers of serialized request or response"""
+    repeated: Dict[str, List[str]] = data.pop(REPEATED_HEADERS, None) or {}
+    if repeated:
+        data['headers'] = Headers((name, repeated.get(name, value)) for name, value in data['headers'].items())
+    return data
+
+
+def get_header(headers: Mapping[str, str], name: str, default_value: str) -> str:
+    if isinstance(headers, Headers):
+        return headers.get(name, default_value)
     for header_name, header_value in headers.items():
         if header_name.lower() == name.lower():
             return header_value
     return default_value
 
 
-def has_header(headers: Dict[str, str], name: str) -> bool:
+def has_header(headers: Mapping[str, str], name: str) -> bool:
+    if isinstance(headers, Headers):
+        return name in headers
     for header_name, header_value in headers.items():
         if header_name.lower() == name.lower():
             return True
@@ -1,23 +1,70 @@
 from nuclear import CliBuilder, parameter, argument, flag
 from nuclear.types.boolean import boolean
 
+from .async_engine import ENGINES
+from .balancer import BALANCING_STRATEGIES
+from .bounded_cache import EVICTION_POLICIES
+from .ratelimit import RATE_LIMIT_KEYS
+from .server import SERVER_MODES
 from .setup import setup_proxy
+from .tape_writer import FSYNC_POLICIES
 from .version import __version__
 
 
 def main():
     CliBuilder('xman', run=setup_proxy, help_on_empty=True, version=__version__,
                help='HTTP proxy recording & replaying requests').has(
-        argument('dst_url', help='destination base url', required=False, default='http://127.0.0.1:8000'),
+        argument('dst_url', help='destination base url, several of them separated by commas', required=False,
+                 default='http://127.0.0.1:8000'),
         parameter('listen_port', help='listen port for incoming requests', type=int, default=8080),
         parameter('listen_ssl', help='enable https on listening side', type=boolean, default=True),
         parameter('record', help='enable recording requests & responses', type=boolean, default=False),
         parameter('record_file', help='filename with recorded requests', default='tape.json'),
+        parameter('record_fsync', help='syncing the tape to disk: never, periodically or after every write',
+                  choices=FSYNC_POLICIES, strict_choices=True, default='never'),
+        parameter('tape_background_load', type=boolean, default=False,
+                  help='start serving while the tape is being loaded'),
         parameter('replay', help='return cached results if found', type=boolean, default=False),
         parameter('replay_throttle', type=boolean, default=False,
                   help='throttle response if too many requests are made'),
         parameter('replay_clear_cache', help='enable clearing cache periodically', type=boolean, default=False),
         parameter('replay_clear_cache_seconds', help='clearing cache interval in seconds', type=int, default=60),
+        parameter('server_mode', help='handling connections: one at a time, by a pool of threads or processes',
+                  choices=SERVER_MODES, strict_choices=True, default='single'),
+        parameter('workers', help='number of worker threads or processes', type=int, default=8),
+        parameter('engine', help='proxy engine: blocking handlers or non-blocking asyncio event loop',
+                  choices=ENGINES, strict_choices=True, default='sync'),
+        parameter('keep_alive', help='keep client connections open for subsequent requests', type=boolean,
+                  default=False),
+        parameter('streaming', help='relay request & response bodies in blocks instead of buffering them',
+                  type=boolean, default=False),
+        parameter('cache_max_entries', help='max number of entries kept in memory, 0 for no limit', type=int,
+                  default=0),
+        parameter('cache_max_bytes', help='max total size of entries kept in memory in bytes, 0 for no limit',
+                  type=int, default=0),
+        parameter('cache_eviction', help='entries evicted first when cache is full',
+                  choices=EVICTION_POLICIES, strict_choices=True, default='lru'),
+        parameter('cache_backend', default='',
+                  help='URL of cache shared by xman processes: sqlite:///path/to/cache.db or redis://host:port/db'),
+        parameter('compression', type=boolean, default=True,
+                  help='compress responses with encoding accepted by client (gzip, deflate, br, zstd)'),
+        parameter('coalesce_requests', type=boolean, default=False,
+                  help='identical requests in flight wait for a single upstream call and share its response'),
+        parameter('rate_limit', help='max requests per second accepted from a client, 0 for no limit', type=float,
+                  default=0),
+        parameter('rate_limit_by', help='requests are limited per client address, path prefix or all together',
+                  choices=RATE_LIMIT_KEYS, strict_choices=True, default='client'),
+        parameter('upstream_rate_limit', help='max requests per second sent to upstream, 0 for no limit',
+                  type=float, default=0),
+        parameter('upstream_balancing', help='balancing requests between several destination URLs',
+                  choices=BALANCING_STRATEGIES, strict_choices=True, default='round-robin'),
+        parameter('upstream_health_path', help='path requested periodically to check health of upstreams',
+                  default=''),
+        parameter('mock_dir', help='directory with mock responses served instead of proxying', default=''),
+        parameter('metrics_path', help='path returning metrics in Prometheus format, eg. /__xman/metrics',
+                  default=''),
+        parameter('metrics_port', help='port of a separate HTTP server exposing metrics, 0 to disable it',
+                  type=int, default=0),
         parameter('config', help='load extensions from Python file'),
         flag('verbose', 'v', multiple=True, help='show more details in output'),
     ).run()
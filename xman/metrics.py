@@ -0,0 +1,158 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from nuclear.sublog import log
+
+# upper bounds of latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STAGES = ['read_request', 'transform_request', 'immediate_responder', 'cache_lookup', 'proxy',
+          'transform_response', 'write_response', 'total']
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds: Tuple[float, ...] = bounds
+        self.counts: List[int] = [0] * (len(bounds) + 1)
+        self.sum: float = 0
+        self.count: int = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """
+    Counters and per-stage latency histograms of request processing, rendered in Prometheus text format.
+    Updating a metric takes a single short lock, so it can be left enabled under load.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled: bool = enabled
+        self.lock = threading.Lock()
+        self.stages: Dict[str, Histogram] = {stage: Histogram() for stage in STAGES}
+        self.counters: Dict[str, int] = {
+            'requests': 0,
+            'replayed': 0,
+            'upstream_errors': 0,
+            'rate_limited': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+        }
+        self.upstream_statuses: Dict[int, int] = {}
+        self.response_statuses: Dict[int, int] = {}
+        # providers of values read at the time of rendering, eg. cache stats
+        self.gauge_sources: List[Tuple[str, Callable[[], Dict[str, int]]]] = []
+
+    @contextmanager
+    def timer(self, stage: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage: str, seconds: float):
+        if self.enabled:
+            with self.lock:
+                self.stages[stage].observe(seconds)
+
+    def inc(self, counter: str, value: int = 1):
+        if self.enabled:
+            with self.lock:
+                self.counters[counter] += value
+
+    def upstream_response(self, status_code: int, failed: bool):
+        if self.enabled:
+            with self.lock:
+                if failed:
+                    self.counters['upstream_errors'] += 1
+                else:
+                    self.upstream_statuses[status_code] = self.upstream_statuses.get(status_code, 0) + 1
+
+    def client_response(self, status_code: int):
+        if self.enabled:
+            with self.lock:
+                self.response_statuses[status_code] = self.response_statuses.get(status_code, 0) + 1
+
+    def request_received(self, request_size: int):
+        if self.enabled:
+            with self.lock:
+                self.counters['requests'] += 1
+                self.counters['bytes_in'] += request_size
+
+    def counted_stream(self, stream: Iterable[bytes]) -> Iterator[bytes]:
+        """Pass streamed body blocks through, counting sent bytes"""
+        for block in stream:
+            self.inc('bytes_out', len(block))
+            yield block
+
+    def add_gauge_source(self, prefix: str, source: Callable[[], Dict[str, int]]):
+        self.gauge_sources.append((prefix, source))
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            lines.append('# TYPE xman_stage_duration_seconds histogram')
+            for stage, histogram in self.stages.items():
+                cumulative = 0
+                for bound, count in zip(list(histogram.bounds) + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f'xman_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'xman_stage_duration_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'xman_stage_duration_seconds_count{{stage="{stage}"}} {histogram.count}')
+            for name, value in self.counters.items():
+                lines.append(f'# TYPE xman_{name}_total counter')
+                lines.append(f'xman_{name}_total {value}')
+            lines.append('# TYPE xman_upstream_responses_total counter')
+            for status_code, count in sorted(self.upstream_statuses.items()):
+                lines.append(f'xman_upstream_responses_total{{status="{status_code}"}} {count}')
+            lines.append('# TYPE xman_responses_total counter')
+            for status_code, count in sorted(self.response_statuses.items()):
+                lines.append(f'xman_responses_total{{status="{status_code}"}} {count}')
+        for prefix, source in self.gauge_sources:
+            for name, value in source().items():
+                lines.append(f'# TYPE xman_{prefix}_{name} gauge')
+                lines.append(f'xman_{prefix}_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(object):
+    """Plain HTTP server exposing metrics on a separate port, serving in a background thread"""
+
+    def __init__(self, metrics: Metrics, listen_addr: str, port: int):
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((listen_addr, port), MetricsHandler)
+        self.httpd.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        log.info(f'Metrics exposed on HTTP port {self.httpd.server_address[1]}')
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
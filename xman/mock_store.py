@@ -0,0 +1,184 @@
+import hashlib
+import json
+import mimetypes
+import re
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+from nuclear.sublog import log
+
+from .header import Headers, get_header
+from .request import HttpRequest
+from .response import HttpResponse
+from .routing import RouteTable
+
+META_SUFFIX = '.meta.json'
+TEMPLATE_FIELD = re.compile(rb'\{\{\s*([\w.-]+)\s*\}\}')
+# block size of file body sent without sendfile
+FILE_BLOCK_SIZE = 64 * 1024
+
+
+class FileBody(object):
+    """
+    Response body kept in a file, sent with sendfile where it's possible.
+    Iterating over it reads the file in blocks, so it's handled as any other streamed body.
+    """
+    __slots__ = ('path', 'size')
+
+    def __init__(self, path: str, size: int):
+        self.path: str = path
+        self.size: int = size
+
+    def __iter__(self) -> Iterator[bytes]:
+        with open(self.path, 'rb') as f:
+            while True:
+                block = f.read(FILE_BLOCK_SIZE)
+                if not block:
+                    return
+                yield block
+
+    def send_to(self, sock):
+        """Send whole file to a socket, with sendfile on plain sockets (socket falls back to send on TLS)"""
+        with open(self.path, 'rb') as f:
+            sock.sendfile(f, 0, self.size)
+
+
+class Template(object):
+    """Body compiled once into literal parts and names of fields filled in on every render"""
+    __slots__ = ('parts', 'fields')
+
+    def __init__(self, source: bytes):
+        pieces = TEMPLATE_FIELD.split(source)
+        self.parts: List[bytes] = pieces[0::2]
+        self.fields: List[str] = [name.decode() for name in pieces[1::2]]
+
+    def render(self, request: HttpRequest, params: Dict[str, str]) -> bytes:
+        chunks = [self.parts[0]]
+        for name, part in zip(self.fields, self.parts[1:]):
+            chunks.append(template_value(name, request, params).encode())
+            chunks.append(part)
+        return b''.join(chunks)
+
+
+def template_value(name: str, request: HttpRequest, params: Dict[str, str]) -> str:
+    """Route parameter, method, path, query.<param> or header.<name>, empty if it's missing"""
+    if name in params:
+        return params[name]
+    if name == 'method':
+        return request.method
+    if name == 'path':
+        return request.query_path
+    if name.startswith('query.'):
+        return request.query_params.get(name[6:], '')
+    if name.startswith('header.'):
+        return get_header(request.headers, name[7:], '')
+    return ''
+
+
+class Fixture(object):
+    """Mock response with status, headers and ETag computed at startup"""
+    __slots__ = ('method', 'path', 'status_code', 'headers', 'content', 'file_body', 'template', 'etag', 'encoded')
+
+    def __init__(self, method: str, path: str, status_code: int, headers: Headers,
+                 body: Union[bytes, FileBody, Template], etag: str):
+        self.method: str = method
+        self.path: str = path
+        self.status_code: int = status_code
+        self.headers: Headers = headers
+        self.content: bytes = body if isinstance(body, bytes) else b''
+        self.file_body: Optional[FileBody] = body if isinstance(body, FileBody) else None
+        self.template: Optional[Template] = body if isinstance(body, Template) else None
+        self.etag: str = etag
+        # compressed variants of static content, compressed once on first request
+        self.encoded: Optional[Dict[str, bytes]] = {} if isinstance(body, bytes) else None
+
+    def response(self, request: HttpRequest, params: Dict[str, str]) -> HttpResponse:
+        headers = Headers(self.headers)
+        if self.template is not None:
+            content = self.template.render(request, params)
+            etag = content_etag(content)
+            headers['Content-Length'] = str(len(content))
+        else:
+            content, etag = self.content, self.etag
+        headers['ETag'] = etag
+        if etag_matches(get_header(request.headers, 'If-None-Match', ''), etag):
+            del headers['Content-Length']
+            return HttpResponse(status_code=304, headers=headers)
+        return HttpResponse(status_code=self.status_code, headers=headers, content=content, stream=self.file_body,
+                            encoded=self.encoded)
+
+
+class MockStore(object):
+    """
+    Mock responses loaded from a directory of fixture files, served by route rules.
+    Every file is a response body. Optional sidecar file <name>.meta.json sets the route (method, path),
+    status, headers and whether the body is a template. Without it, file is served on GET /<relative path>.
+    Bodies larger than sendfile_size are left on disk and sent straight from the file.
+    """
+
+    def __init__(self, directory: str, sendfile_size: int = 1024 * 1024):
+        self.directory: str = directory
+        self.sendfile_size: int = sendfile_size
+        self.fixtures: List[Fixture] = []
+
+    def load(self) -> 'MockStore':
+        root = Path(self.directory)
+        if not root.is_dir():
+            raise FileNotFoundError(f'mock directory not found: {self.directory}')
+        for path in sorted(root.rglob('*')):
+            if path.is_file() and not path.name.endswith(META_SUFFIX):
+                self.fixtures.append(self._load_fixture(root, path))
+        log.info('Mock responses loaded', directory=self.directory, fixtures=len(self.fixtures))
+        return self
+
+    def _load_fixture(self, root: Path, path: Path) -> Fixture:
+        meta_path = path.with_name(path.name + META_SUFFIX)
+        meta = json.loads(meta_path.read_text()) if meta_path.is_file() else {}
+        headers = Headers(meta.get('headers', {}))
+        if 'Content-Type' not in headers:
+            headers['Content-Type'] = mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+        size = path.stat().st_size
+        body: Union[bytes, FileBody, Template]
+        if meta.get('template', False):
+            body = Template(path.read_bytes())
+            etag = ''
+        elif size > self.sendfile_size:
+            body = FileBody(str(path), size)
+            etag = f'"{path.stat().st_mtime_ns:x}-{size:x}"'
+            headers['Content-Length'] = str(size)
+        else:
+            body = path.read_bytes()
+            etag = content_etag(body)
+            headers['Content-Length'] = str(size)
+        route_path = meta.get('path') or '/' + path.relative_to(root).as_posix()
+        return Fixture(meta.get('method', 'GET'), route_path, meta.get('status', 200), headers, body, etag)
+
+    def register(self, routes: RouteTable):
+        """Add route returning every fixture as an immediate response"""
+        for fixture in self.fixtures:
+            routes.add(fixture.method, fixture.path, respond=_responder(routes, fixture))
+
+
+def _responder(routes: RouteTable, fixture: Fixture):
+    def respond(request: HttpRequest) -> HttpResponse:
+        found = routes.match(request)
+        return fixture.response(request, found.params if found is not None else {})
+    return respond
+
+
+def content_etag(content: bytes) -> str:
+    return f'"{hashlib.blake2b(content, digest_size=8).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison of entity tags, as If-None-Match requires"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque = _opaque_tag(etag)
+    return any(_opaque_tag(tag.strip()) == opaque for tag in if_none_match.split(','))
+
+
+def _opaque_tag(etag: str) -> str:
+    return etag[2:] if etag.startswith('W/') else etag
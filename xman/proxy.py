@@ -1,28 +1,241 @@
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+from typing import Dict, List, Optional, Iterator
+
 import requests
 import urllib3
 from nuclear.sublog import log, wrap_context, logerr
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
+from .balancer import Upstream, UpstreamPool
+from .header import Headers
+from .ratelimit import RateLimiter, too_many_requests
 from .request import HttpRequest
 from .response import HttpResponse
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# headers describing a single connection, not forwarded to upstream (framing headers are set for the sent body)
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'te', 'trailer',
+                      'upgrade', 'content-length'}
+
+
+class SessionPool(object):
+    """
+    Persistent HTTP sessions kept for each destination URL.
+    Upstream connections are reused (keep-alive) instead of making new TCP connection & TLS handshake every time.
+    """
+
+    def __init__(self, pool_size: int = 10, max_connections_per_host: int = 10, idle_timeout: float = 60):
+        self.pool_size: int = pool_size
+        self.max_connections_per_host: int = max_connections_per_host
+        self.idle_timeout: float = idle_timeout
+        self.sessions: Dict[str, requests.Session] = {}
+        self.last_used: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.session_hits: int = 0
+        self.session_misses: int = 0
+        self._closed_connections: int = 0
+        self._closed_requests: int = 0
+
+    def get_session(self, dst_url: str) -> requests.Session:
+        now = time.monotonic()
+        with self.lock:
+            self._close_idle_sessions(now)
+            self.last_used[dst_url] = now
+            session = self.sessions.get(dst_url)
+            if session is not None:
+                self.session_hits += 1
+                return session
+            self.session_misses += 1
+            session = requests.Session()
+            # cookies must not leak between requests of different clients
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            adapter = CountingHTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.max_connections_per_host)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.sessions[dst_url] = session
+            return session
+
+    def _close_idle_sessions(self, now: float):
+        for dst_url, last_used in list(self.last_used.items()):
+            if now - last_used > self.idle_timeout:
+                self._close_session(dst_url)
+
+    def _close_session(self, dst_url: str):
+        session = self.sessions.pop(dst_url, None)
+        self.last_used.pop(dst_url, None)
+        if session is not None:
+            connections, requests_made = _session_connection_stats(session)
+            self._closed_connections += connections
+            self._closed_requests += requests_made
+            session.close()
+
+    def stats(self) -> Dict[str, int]:
+        """Hit means reusing existing session or connection, miss means creating a new one"""
+        with self.lock:
+            connections, requests_made = self._closed_connections, self._closed_requests
+            for session in self.sessions.values():
+                session_connections, session_requests = _session_connection_stats(session)
+                connections += session_connections
+                requests_made += session_requests
+            return {
+                'sessions': len(self.sessions),
+                'session_hits': self.session_hits,
+                'session_misses': self.session_misses,
+                'connection_hits': requests_made - connections,
+                'connection_misses': connections,
+            }
+
+    def close(self):
+        with self.lock:
+            for dst_url in list(self.sessions.keys()):
+                self._close_session(dst_url)
+
+
+class CountingPoolMixin(object):
+    """
+    Counts TCP connections opened by a urllib3 pool. Its num_connections counts connection objects only,
+    while a connection object closed by the server is opened again on its next request.
+    """
+    opened_connections: int = 0
+
+    def _make_request(self, conn, *args, **kwargs):
+        if conn.sock is None:
+            self.opened_connections += 1
+        return super()._make_request(conn, *args, **kwargs)
+
+
+class CountingHTTPConnectionPool(CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """Adapter of connection pools counting TCP connections they open"""
 
-def proxy_request(request: HttpRequest, default_url: str, timeout: int, verbose: int) -> HttpResponse:
-    dst_url = request.dst_url if request.dst_url else default_url
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+
+def _session_connection_stats(session: requests.Session):
+    """Count TCP connections opened and requests made by the underlying urllib3 connection pools"""
+    connections = 0
+    requests_made = 0
+    adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += getattr(pool, 'opened_connections', pool.num_connections)
+                requests_made += pool.num_requests
+    return connections, requests_made
+
+
+default_session_pool = SessionPool()
+
+
+def proxy_request(request: HttpRequest, default_url: str, timeout: int, verbose: int,
+                  session_pool: Optional[SessionPool] = None, stream_buffer_size: int = 0,
+                  rate_limiter: Optional[RateLimiter] = None,
+                  upstreams: Optional[UpstreamPool] = None) -> HttpResponse:
+    """
+    :param stream_buffer_size: if positive, response body is not read into memory,
+    but relayed in blocks of that size from the response stream
+    :param rate_limiter: limits requests made to each destination URL, request waits for its turn up to timeout
+    :param upstreams: pool of destination URLs the request is balanced between (unless it has its own dst_url),
+    retrying the failed ones
+    """
+    if request.dst_url or upstreams is None:
+        return _proxy_to(request, request.dst_url or default_url, timeout, verbose, session_pool,
+                         stream_buffer_size, rate_limiter)
+    upstreams.budget.record_request()
+    tried: List[Upstream] = []
+    while True:
+        upstream = upstreams.choose(request, tried)
+        tried.append(upstream)
+        upstreams.begin(upstream)
+        response = _proxy_to(request, upstream.url, timeout, verbose, session_pool, stream_buffer_size, rate_limiter)
+        if not upstreams.end(upstream, response) or not upstreams.should_retry(request, len(tried)):
+            return response
+        if hasattr(response.stream, 'close'):
+            response.stream.close()  # release connection of the discarded streamed response
+        log.warn('Retrying request on another upstream', dst_url=upstream.url, status=response.status_code)
+
+
+def _proxy_to(request: HttpRequest, dst_url: str, timeout: int, verbose: int, session_pool: Optional[SessionPool],
+              stream_buffer_size: int, rate_limiter: Optional[RateLimiter]) -> HttpResponse:
+    if rate_limiter is not None:
+        granted, delay = rate_limiter.acquire(dst_url, max_delay=timeout)
+        if not granted:
+            log.warn('Upstream rate limit exceeded', dst_url=dst_url, retry_after=delay)
+            return too_many_requests(delay)
+        if delay > 0:
+            time.sleep(delay)
+    session = (session_pool or default_session_pool).get_session(dst_url)
     with logerr():
         with wrap_context('proxying to URL', dst_url=dst_url, path=request.path, content=request.content):
             url = f'{dst_url}{request.path}'
             if verbose:
                 log.debug(f'>> proxying to', url=url)
-            response = requests.request(request.method, url, verify=False, allow_redirects=False, stream=False,
-                                        timeout=timeout, headers=request.headers, data=request.content)
+            data = request.stream if request.stream is not None else request.content
+            response = session.request(request.method, url, verify=False, allow_redirects=False,
+                                       stream=stream_buffer_size > 0, timeout=timeout,
+                                       headers=forwarded_headers(request.headers), data=data)
+            if stream_buffer_size > 0:
+                return _streamed_response(response, stream_buffer_size).log('<< received', verbose)
             content: bytes = response.content
-            http_response = HttpResponse(status_code=response.status_code, headers=dict(response.headers),
+            http_response = HttpResponse(status_code=response.status_code, headers=response_headers(response),
                                          content=content)
             return http_response.log('<< received', verbose)
 
-    # Bad Gateway response
+    return bad_gateway_response(dst_url)
+
+
+def _streamed_response(response: requests.Response, buffer_size: int) -> HttpResponse:
+    headers = response_headers(response)
+    if 'Content-Encoding' in headers:
+        # body is decoded on the fly, so its final length is unknown
+        headers.pop('Content-Length', None)
+        headers['Transfer-Encoding'] = 'chunked'
+    return HttpResponse(status_code=response.status_code, headers=headers,
+                        stream=_iter_response_content(response, buffer_size))
+
+
+def _iter_response_content(response: requests.Response, buffer_size: int) -> Iterator[bytes]:
+    try:
+        for block in response.iter_content(buffer_size):
+            if block:
+                yield block
+    finally:
+        response.close()
+
+
+def response_headers(response: requests.Response) -> Headers:
+    """Headers as received from upstream, with all values of repeated headers (merged by requests)"""
+    raw_headers = getattr(response.raw, 'headers', None)
+    if raw_headers is not None and hasattr(raw_headers, 'iteritems'):
+        return Headers(raw_headers.iteritems())
+    return Headers(response.headers)
+
+
+def forwarded_headers(headers: Headers) -> Headers:
+    """Request headers sent upstream, without the ones describing client's connection"""
+    return Headers((name, value) for name, value in Headers(headers).multi_items()
+                   if name.lower() not in HOP_BY_HOP_HEADERS)
+
+
+def bad_gateway_response(dst_url: str) -> HttpResponse:
     error_msg = f'Proxying failed: {dst_url}'
     return HttpResponse(status_code=502, headers={
         'X-Man-Error': 'proxying failed',
@@ -0,0 +1,115 @@
+import math
+import threading
+import time
+from typing import Dict, Tuple, Optional, Callable
+
+from .config import Config
+from .request import HttpRequest
+from .response import HttpResponse
+
+RATE_LIMIT_KEYS = ['client', 'path', 'global']
+
+
+class TokenBucket(object):
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens: float = tokens
+        self.updated: float = updated
+
+
+class RateLimiter(object):
+    """
+    Token buckets refilled with `rate` tokens per second, holding up to `burst` tokens, one bucket per key.
+    Every request takes one token. Tokens may be reserved in advance, then the caller has to wait before proceeding.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 10000):
+        self.rate: float = rate
+        self.burst: float = max(burst, 1)
+        self.max_keys: int = max_keys
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.lock = threading.Lock()
+        self.rejected: int = 0
+
+    def acquire(self, key: str, max_delay: float = 0) -> Tuple[bool, float]:
+        """
+        Take a token if it's available now or within max_delay seconds.
+        :return: whether token was granted, and the delay: time to wait before proceeding if it was granted,
+        time after which it's worth trying again otherwise
+        """
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_keys:
+                    self._drop_full_buckets(now)
+                bucket = self.buckets[key] = TokenBucket(self.burst, now)
+            else:
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+                bucket.updated = now
+            delay = self._delay(1 - bucket.tokens)
+            if delay > max_delay:
+                self.rejected += 1
+                return False, delay
+            bucket.tokens -= 1
+            return True, delay
+
+    def _delay(self, missing_tokens: float) -> float:
+        if missing_tokens <= 0:
+            return 0
+        if self.rate <= 0:
+            return math.inf
+        return missing_tokens / self.rate
+
+    def _drop_full_buckets(self, now: float):
+        """Forget keys not seen for a while, their buckets would be full anyway"""
+        for key, bucket in list(self.buckets.items()):
+            if bucket.tokens + (now - bucket.updated) * self.rate >= self.burst:
+                del self.buckets[key]
+
+
+def client_rate_limiter(config: Config) -> Optional[RateLimiter]:
+    """Limiter of incoming requests. With replay_throttle enabled, only cached responses are limited by the cache"""
+    if config.rate_limit <= 0 or config.replay_throttle:
+        return None
+    return RateLimiter(config.rate_limit, config.rate_limit_burst)
+
+
+def upstream_rate_limiter(config: Config) -> Optional[RateLimiter]:
+    if config.upstream_rate_limit <= 0:
+        return None
+    return RateLimiter(config.upstream_rate_limit, config.upstream_rate_limit_burst)
+
+
+def rate_limit_key(request: HttpRequest, limit_by: str,
+                   key_hook: Optional[Callable[[HttpRequest], Optional[str]]]) -> Optional[str]:
+    """Key of a bucket the request takes token from, None if request is not limited"""
+    if key_hook is not None:
+        return key_hook(request)
+    if limit_by == 'client':
+        return request.client_addr
+    if limit_by == 'path':
+        return '/' + request.query_path.lstrip('/').split('/', 1)[0]
+    return ''
+
+
+def rate_limited_response(rate_limiter: Optional[RateLimiter], request: HttpRequest, limit_by: str,
+                          key_hook: Optional[Callable[[HttpRequest], Optional[str]]]) -> Optional[HttpResponse]:
+    """Return 429 response if request exceeds the limit, None if it can be processed"""
+    if rate_limiter is None:
+        return None
+    key = rate_limit_key(request, limit_by, key_hook)
+    if key is None:
+        return None
+    granted, retry_after = rate_limiter.acquire(key)
+    if granted:
+        return None
+    return too_many_requests(retry_after)
+
+
+def too_many_requests(retry_after: float) -> HttpResponse:
+    headers = {'Content-Length': '0'}
+    if not math.isinf(retry_after):
+        headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return HttpResponse(status_code=429, headers=headers, content=b'')
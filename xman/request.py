@@ -1,18 +1,21 @@
 import json
-from typing import Dict, Callable, Any, Optional
+from typing import Dict, Callable, Any, Optional, Iterable
 from urllib import parse
 
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, fields
 from dataclasses import field
 from nuclear.sublog import log
 
+from .header import Headers, marshal_headers, unmarshal_headers
+
 
 @dataclass
 class HttpRequest(object):
     requestline: str
     method: str
     path: str
-    headers: Dict[str, str]
+    """Headers, given as a dict they're converted to case-insensitive Headers"""
+    headers: Headers
     content: bytes
     client_addr: str
     client_port: int
@@ -21,14 +24,21 @@ class HttpRequest(object):
     dst_url: Optional[str] = None
     """Custom additional labels marked while processing request"""
     metadata: Dict[str, str] = field(default_factory=lambda: dict())
+    """Body relayed straight to upstream in blocks, instead of being read into content"""
+    stream: Optional[Iterable[bytes]] = field(default=None, compare=False, repr=False)
+
+    def __post_init__(self):
+        if not isinstance(self.headers, Headers):
+            self.headers = Headers(self.headers)
 
     @staticmethod
     def from_json(data: dict) -> 'HttpRequest':
         data['content'] = data.get('content').encode('utf-8')
-        return HttpRequest(**data)
+        return HttpRequest(**unmarshal_headers(data))
 
     def marshal(self) -> dict:
-        d = asdict(self)
+        d = {f.name: getattr(self, f.name) for f in fields(self) if f.name != 'stream'}
+        marshal_headers(d, self.headers)
         if not self.dst_url:
             del d['dst_url']
         if not self.metadata:
@@ -57,6 +67,7 @@ class HttpRequest(object):
             timestamp=self.timestamp,
             dst_url=self.dst_url,
             metadata=self.metadata,
+            stream=self.stream,
         )
         return transformer(cloned)
 
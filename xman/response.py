@@ -1,19 +1,30 @@
 import json
 from http.client import responses
-from typing import Dict, Callable, Any, Optional
+from typing import Dict, Callable, Any, Optional, Iterable
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from nuclear.sublog import log
 
-from xman.header import has_header
+from xman.header import has_header, Headers, marshal_headers, unmarshal_headers
 from .request import HttpRequest
 
 
 @dataclass
 class HttpResponse(object):
     status_code: int
-    headers: Dict[str, str]
+    """Headers, given as a dict they're converted to case-insensitive Headers"""
+    headers: Headers
     content: bytes = b''
+    """Body relayed straight to client in blocks, instead of being read into content"""
+    stream: Optional[Iterable[bytes]] = field(default=None, compare=False, repr=False)
+    """Compressed variants of content by encoding, shared with the cache entry the response comes from"""
+    encoded: Optional[Dict[str, bytes]] = field(default=None, compare=False, repr=False)
+    """Serialized status line & headers by content encoding, shared with the cache entry the response comes from"""
+    wire_heads: Optional[Dict[Optional[str], Any]] = field(default=None, compare=False, repr=False)
+
+    def __post_init__(self):
+        if not isinstance(self.headers, Headers):
+            self.headers = Headers(self.headers)
 
     def log(self, prefix: str, verbose: int) -> 'HttpResponse':
         if verbose:
@@ -27,7 +38,7 @@ class HttpResponse(object):
     @staticmethod
     def from_json(data: dict) -> 'HttpResponse':
         data['content'] = data.get('content').encode()
-        return HttpResponse(**data)
+        return HttpResponse(**unmarshal_headers(data))
 
     def transform(self, transformer: Optional[Callable[[HttpRequest, 'HttpResponse'], 'HttpResponse']],
                   request: HttpRequest) -> 'HttpResponse':
@@ -37,9 +48,24 @@ class HttpResponse(object):
             status_code=self.status_code,
             headers=self.headers,
             content=self.content,
+            stream=self.stream,
         )
         return transformer(request, cloned)
 
+    def copy(self) -> 'HttpResponse':
+        """Clone response, so that its headers can be changed independently"""
+        return HttpResponse(
+            status_code=self.status_code,
+            headers=Headers(self.headers),
+            content=self.content,
+        )
+
+    def marshal(self) -> dict:
+        d = {'status_code': self.status_code}
+        marshal_headers(d, self.headers)
+        d['content'] = self.content
+        return d
+
     def set_content(self, content: str) -> 'HttpResponse':
         self.content = content.encode()
         self.headers['Content-Length'] = str(len(self.content))
@@ -0,0 +1,253 @@
+import re
+from typing import Callable, Dict, List, Optional, Pattern, Tuple, Union
+
+from .request import HttpRequest
+from .response import HttpResponse
+
+Responder = Union[HttpResponse, Callable[[HttpRequest], Optional[HttpResponse]]]
+Cacheable = Union[bool, Callable[[HttpRequest, HttpResponse], bool]]
+ANY_METHOD = '*'
+# matches remembered by method & path, the memo is cleared when it grows above this size
+MAX_MEMO_SIZE = 10000
+
+
+class Route(object):
+    """Rule applied to requests matching method and path pattern. Hooks that are not set are left to global ones"""
+    __slots__ = ('method', 'pattern', 'respond', 'transform_request', 'transform_response', 'cacheable', 'dst_url')
+
+    def __init__(self, method: str, pattern: str, respond: Optional[Responder] = None,
+                 transform_request: Optional[Callable[[HttpRequest], HttpRequest]] = None,
+                 transform_response: Optional[Callable[[HttpRequest, HttpResponse], HttpResponse]] = None,
+                 cacheable: Optional[Cacheable] = None, dst_url: Optional[str] = None):
+        self.method: str = method.upper()
+        self.pattern: str = pattern
+        self.respond: Optional[Responder] = respond
+        self.transform_request: Optional[Callable[[HttpRequest], HttpRequest]] = transform_request
+        self.transform_response: Optional[Callable[[HttpRequest, HttpResponse], HttpResponse]] = transform_response
+        self.cacheable: Optional[Cacheable] = cacheable
+        self.dst_url: Optional[str] = dst_url
+
+    def __repr__(self) -> str:
+        return f'Route({self.method} {self.pattern})'
+
+
+class RouteMatch(object):
+    __slots__ = ('route', 'params')
+
+    def __init__(self, route: Route, params: Dict[str, str]):
+        self.route: Route = route
+        self.params: Dict[str, str] = params
+
+
+class TrieNode(object):
+    """Path segment: literal children, a parameter child ({name}), routes ending here or covering the rest (*)"""
+    __slots__ = ('children', 'param_name', 'param_child', 'routes', 'wildcard_routes')
+
+    def __init__(self):
+        self.children: Dict[str, TrieNode] = {}
+        self.param_name: Optional[str] = None
+        self.param_child: Optional[TrieNode] = None
+        self.routes: Dict[str, Route] = {}
+        self.wildcard_routes: Dict[str, Route] = {}
+
+
+class RouteTable(object):
+    """
+    Declarative routes dispatched by method and path (without query string), instead of chains of checks in hooks.
+    Path patterns are matched by a trie of segments: literal (/api/users), parameter (/users/{id})
+    and the rest of a path (/static/*), literal segments taking precedence over parameters, parameters over the rest.
+    Regex routes (added with regex=True) are matched after them, all at once by a combined regular expression,
+    the one added first wins. Regex patterns are matched from the start of a path and can't use backreferences.
+    """
+
+    def __init__(self):
+        self.routes: List[Route] = []
+        self.root: TrieNode = TrieNode()
+        self.regex_routes: List[Tuple[Route, Pattern]] = []
+        # combined regex with routes it dispatches to, by method
+        self.combined: Dict[str, Tuple[Optional[Pattern], List[Tuple[Route, Pattern]]]] = {}
+        self.memo: Dict[Tuple[str, str], Optional[RouteMatch]] = {}
+
+    def add(self, method: str, pattern: str, respond: Optional[Responder] = None,
+            transform_request: Optional[Callable[[HttpRequest], HttpRequest]] = None,
+            transform_response: Optional[Callable[[HttpRequest, HttpResponse], HttpResponse]] = None,
+            cacheable: Optional[Cacheable] = None, dst_url: Optional[str] = None, regex: bool = False) -> Route:
+        """
+        Register route for method ('*' for any) and path pattern.
+        :param respond: immediate response (or function returning it) sent instead of proxying the request
+        :param cacheable: whether responses can be cached, or function deciding it like can_be_cached hook
+        :param dst_url: destination base URL the request is proxied to
+        """
+        route = Route(method, pattern, respond=respond, transform_request=transform_request,
+                      transform_response=transform_response, cacheable=cacheable, dst_url=dst_url)
+        if regex:
+            self.regex_routes.append((route, re.compile(pattern)))
+        else:
+            self._insert(route)
+        self.routes.append(route)
+        self.combined.clear()
+        self.memo.clear()
+        return route
+
+    def route(self, method: str, pattern: str, regex: bool = False) -> Callable:
+        """Decorator registering immediate responder function for a route"""
+        def decorator(responder: Callable[[HttpRequest], Optional[HttpResponse]]):
+            self.add(method, pattern, respond=responder, regex=regex)
+            return responder
+        return decorator
+
+    def _insert(self, route: Route):
+        segments = _split_path(route.pattern)
+        node = self.root
+        for index, segment in enumerate(segments):
+            if segment == '*' and index == len(segments) - 1:
+                node.wildcard_routes.setdefault(route.method, route)
+                return
+            if segment.startswith('{') and segment.endswith('}'):
+                name = segment[1:-1]
+                if node.param_child is None:
+                    node.param_child = TrieNode()
+                    node.param_name = name
+                elif node.param_name != name:
+                    raise ValueError(f'conflicting parameter names in route {route.pattern}: '
+                                     f'{{{node.param_name}}} and {segment}')
+                node = node.param_child
+            else:
+                node = node.children.setdefault(segment, TrieNode())
+        node.routes.setdefault(route.method, route)
+
+    def match(self, request: HttpRequest) -> Optional[RouteMatch]:
+        return self.match_path(request.method, request.path)
+
+    def match_path(self, method: str, path: str) -> Optional[RouteMatch]:
+        path = path.split('?', 1)[0]
+        key = (method, path)
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+        found = self._match_trie(self.root, _split_path(path), 0, method, {})
+        if found is None:
+            found = self._match_regex(method, path)
+        if len(self.memo) >= MAX_MEMO_SIZE:
+            self.memo.clear()
+        self.memo[key] = found
+        return found
+
+    def _match_trie(self, node: TrieNode, segments: List[str], index: int, method: str,
+                    params: Dict[str, str]) -> Optional[RouteMatch]:
+        if index == len(segments):
+            route = _route_for(node.routes, method)
+            if route is not None:
+                return RouteMatch(route, dict(params))
+        else:
+            child = node.children.get(segments[index])
+            if child is not None:
+                found = self._match_trie(child, segments, index + 1, method, params)
+                if found is not None:
+                    return found
+            if node.param_child is not None and segments[index]:
+                params[node.param_name] = segments[index]
+                found = self._match_trie(node.param_child, segments, index + 1, method, params)
+                del params[node.param_name]
+                if found is not None:
+                    return found
+        route = _route_for(node.wildcard_routes, method)
+        if route is not None:
+            return RouteMatch(route, dict(params))
+        return None
+
+    def _match_regex(self, method: str, path: str) -> Optional[RouteMatch]:
+        if not self.regex_routes:
+            return None
+        combined = self.combined.get(method)
+        if combined is None:
+            combined = self.combined[method] = _combine_regex_routes(self.regex_routes, method)
+        regex, routes = combined
+        if regex is None:
+            return None
+        match = regex.match(path)
+        if match is None:
+            return None
+        route, pattern = routes[int(match.lastgroup[2:])]
+        return RouteMatch(route, pattern.match(path).groupdict())
+
+    def has_hook(self, name: str) -> bool:
+        return any(getattr(route, name) is not None for route in self.routes)
+
+    def request_hook(self, fallback: Optional[Callable[[HttpRequest], HttpRequest]]
+                     ) -> Callable[[HttpRequest], HttpRequest]:
+        """transform_request hook applying global hook, then route's transformation and destination URL"""
+        def transform_request(request: HttpRequest) -> HttpRequest:
+            if fallback is not None:
+                request = fallback(request)
+            found = self.match(request)
+            if found is None:
+                return request
+            route = found.route
+            if route.transform_request is not None:
+                request = route.transform_request(request)
+            if route.dst_url and not request.dst_url:
+                request.dst_url = route.dst_url
+            return request
+        return transform_request
+
+    def responder_hook(self, fallback: Optional[Callable[[HttpRequest], Optional[HttpResponse]]]
+                       ) -> Callable[[HttpRequest], Optional[HttpResponse]]:
+        """immediate_responder hook returning route's response, or the one from global hook"""
+        def immediate_responder(request: HttpRequest) -> Optional[HttpResponse]:
+            found = self.match(request)
+            if found is not None and found.route.respond is not None:
+                respond = found.route.respond
+                response = respond.copy() if isinstance(respond, HttpResponse) else respond(request)
+                if response is not None:
+                    return response
+            return None if fallback is None else fallback(request)
+        return immediate_responder
+
+    def response_hook(self, fallback: Optional[Callable[[HttpRequest, HttpResponse], HttpResponse]]
+                      ) -> Callable[[HttpRequest, HttpResponse], HttpResponse]:
+        """transform_response hook applying route's transformation, then the global hook"""
+        def transform_response(request: HttpRequest, response: HttpResponse) -> HttpResponse:
+            found = self.match(request)
+            if found is not None and found.route.transform_response is not None:
+                response = found.route.transform_response(request, response)
+            return response if fallback is None else fallback(request, response)
+        return transform_response
+
+    def cacheable_hook(self, fallback: Optional[Callable[[HttpRequest, HttpResponse], bool]]
+                       ) -> Callable[[HttpRequest, HttpResponse], bool]:
+        """can_be_cached hook deciding by route's cacheability if it's set, by the global hook otherwise"""
+        def can_be_cached(request: HttpRequest, response: HttpResponse) -> bool:
+            found = self.match(request)
+            if found is not None and found.route.cacheable is not None:
+                cacheable = found.route.cacheable
+                return cacheable if isinstance(cacheable, bool) else cacheable(request, response)
+            return True if fallback is None else fallback(request, response)
+        return can_be_cached
+
+
+def _split_path(path: str) -> List[str]:
+    return path.strip('/').split('/')
+
+
+def _route_for(routes: Dict[str, Route], method: str) -> Optional[Route]:
+    if not routes:
+        return None
+    route = routes.get(method)
+    return route if route is not None else routes.get(ANY_METHOD)
+
+
+def _combine_regex_routes(regex_routes: List[Tuple[Route, Pattern]], method: str
+                          ) -> Tuple[Optional[Pattern], List[Tuple[Route, Pattern]]]:
+    """
+    Single regex matching any of the routes for a method. Every alternative ends with an empty marker group,
+    the last group closed in a match, so that lastgroup tells which route matched.
+    Named groups are made plain, as names may repeat among routes. Route's own pattern extracts parameters later.
+    """
+    routes = [(route, pattern) for route, pattern in regex_routes if route.method in (method, ANY_METHOD)]
+    if not routes:
+        return None, routes
+    alternatives = [f'(?:{re.sub(r"[(][?]P<[^>]+>", "(", pattern.pattern)})(?P<_r{index}>)'
+                    for index, (_, pattern) in enumerate(routes)]
+    return re.compile('|'.join(alternatives)), routes
@@ -0,0 +1,139 @@
+import os
+import signal
+import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import TCPServer
+from typing import List, Optional, Type
+
+from nuclear.sublog import log
+
+from .config import Config
+
+SERVER_MODES = ['single', 'threaded', 'multiprocess']
+
+
+class ProxyTCPServer(TCPServer):
+    """TCP server handling one connection at a time. TLS handshake is made after accepting a connection"""
+    allow_reuse_address = True
+
+    def __init__(self, config: Config, handler_class: Type):
+        self.config: Config = config
+        self.ssl_context: Optional[ssl.SSLContext] = None
+        if config.listen_ssl:
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.ssl_context.load_cert_chain(certfile='./dev-cert.pem')
+        super().__init__((config.listen_addr, config.listen_port), handler_class)
+
+    def finish_request(self, request, client_address):
+        if self.ssl_context is None:
+            return super().finish_request(request, client_address)
+        request.settimeout(self.config.timeout)
+        try:
+            ssl_request = self.ssl_context.wrap_socket(request, server_side=True)
+        except (ssl.SSLError, OSError) as e:
+            log.warn('TLS handshake failed', client_addr=client_address[0], error=str(e))
+            return
+        try:
+            super().finish_request(ssl_request, client_address)
+        finally:
+            self.shutdown_request(ssl_request)
+
+
+class ThreadPoolTCPServer(ProxyTCPServer):
+    """
+    TCP server handling connections concurrently by a bounded pool of worker threads.
+    Accepting waits while there are accept_queue_size connections waiting for a worker already.
+    """
+
+    def __init__(self, config: Config, handler_class: Type):
+        super().__init__(config, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=config.workers)
+        # connections being handled or waiting for a worker
+        self.slots = threading.BoundedSemaphore(config.workers + max(config.accept_queue_size, 0))
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        try:
+            self.executor.submit(self.process_request_thread, request, client_address)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+class PreforkTCPServer(ProxyTCPServer):
+    """Listening socket is shared by pre-forked worker processes, each of them accepting connections on its own"""
+
+    def __init__(self, config: Config, handler_class: Type):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('multiprocess server mode is not supported on this platform')
+        super().__init__(config, handler_class)
+        self.worker_pids: List[int] = []
+
+    def serve_forever(self, poll_interval: float = 0.5):
+        for _ in range(self.config.workers):
+            self._spawn_worker(poll_interval)
+        log.info('Worker processes started', workers=len(self.worker_pids))
+        try:
+            while self.worker_pids:
+                pid, status = os.wait()
+                if pid in self.worker_pids:
+                    self.worker_pids.remove(pid)
+                    log.warn('Worker process exited', pid=pid, status=status)
+        finally:
+            self._stop_workers()
+
+    def _spawn_worker(self, poll_interval: float):
+        pid = os.fork()
+        if pid != 0:
+            self.worker_pids.append(pid)
+            return
+        exit_code = 0
+        try:
+            super().serve_forever(poll_interval)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except BaseException as e:
+            log.error('Worker process failed', error=str(e))
+            exit_code = 1
+        finally:
+            cache = getattr(self.RequestHandlerClass, 'cache', None)
+            if cache is not None:
+                cache.flush()
+            os._exit(exit_code)
+
+    def _stop_workers(self):
+        for pid in self.worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self.worker_pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.worker_pids = []
+
+
+def create_server(config: Config, handler_class: Type) -> ProxyTCPServer:
+    if config.server_mode == 'threaded':
+        return ThreadPoolTCPServer(config, handler_class)
+    if config.server_mode == 'multiprocess':
+        return PreforkTCPServer(config, handler_class)
+    if config.server_mode == 'single':
+        return ProxyTCPServer(config, handler_class)
+    raise ValueError(f'unknown server mode: {config.server_mode}, expected one of {SERVER_MODES}')
@@ -1,18 +1,32 @@
-import ssl
-from socketserver import TCPServer
+import signal
+import sys
 
 from dataclasses import asdict
 from nuclear.sublog import logerr, wrap_context, log
 
+from .async_engine import AsyncProxyServer
+from .balancer import upstream_pool
 from .cache import RequestCache
 from .config import Config
-from .extension import load_extensions
+from .extension import load_extensions, apply_routes
 from .handler import RequestHandler
+from .metrics import Metrics, MetricsServer
+from .mock_store import MockStore
+from .proxy import SessionPool
+from .ratelimit import client_rate_limiter, upstream_rate_limiter
+from .routing import RouteTable
+from .server import create_server
+from .singleflight import SingleFlight
 
 
-def setup_proxy(listen_port: int, listen_ssl: bool, dst_url: str, record: bool, record_file: str, replay: bool,
-                replay_throttle: bool, replay_clear_cache: bool, replay_clear_cache_seconds: int,
-                config: str, verbose: int):
+def setup_proxy(listen_port: int, listen_ssl: bool, dst_url: str, record: bool, record_file: str,
+                record_fsync: str, tape_background_load: bool, replay: bool, replay_throttle: bool,
+                replay_clear_cache: bool, replay_clear_cache_seconds: int,
+                server_mode: str, workers: int, engine: str, keep_alive: bool, streaming: bool,
+                cache_max_entries: int, cache_max_bytes: int, cache_eviction: str, cache_backend: str,
+                compression: bool, coalesce_requests: bool, rate_limit: float, rate_limit_by: str,
+                upstream_rate_limit: float, upstream_balancing: str, upstream_health_path: str, mock_dir: str,
+                metrics_path: str, metrics_port: int, config: str, verbose: int):
     with logerr():
         with wrap_context('initialization'):
             extensions = load_extensions(config)
@@ -22,26 +36,97 @@ def setup_proxy(listen_port: int, listen_ssl: bool, dst_url: str, record: bool,
                 dst_url=dst_url,
                 record=record,
                 record_file=record_file,
+                record_fsync=record_fsync,
+                tape_background_load=tape_background_load,
                 replay=replay,
                 replay_throttle=replay_throttle,
                 replay_clear_cache=replay_clear_cache,
                 replay_clear_cache_seconds=replay_clear_cache_seconds,
+                server_mode=server_mode,
+                workers=workers,
+                engine=engine,
+                keep_alive=keep_alive,
+                streaming=streaming,
+                cache_max_entries=cache_max_entries,
+                cache_max_bytes=cache_max_bytes,
+                cache_eviction=cache_eviction,
+                cache_backend=cache_backend,
+                compression=compression,
+                coalesce_requests=coalesce_requests,
+                rate_limit=rate_limit,
+                rate_limit_by=rate_limit_by,
+                upstream_rate_limit=upstream_rate_limit,
+                upstream_balancing=upstream_balancing,
+                upstream_health_path=upstream_health_path,
+                mock_dir=mock_dir,
+                metrics_path=metrics_path,
+                metrics_port=metrics_port,
                 verbose=verbose,
             )
             if extensions.override_config:
                 extensions.override_config(_config)
             log.info('Configuration set', **asdict(_config))
+            if _config.metrics_port and _config.server_mode == 'multiprocess':
+                # server started before forking would expose metrics of the parent process only
+                raise ValueError('metrics port is not supported in multiprocess mode, '
+                                 'use metrics path served by every worker instead')
+            if _config.mock_dir:
+                if extensions.routes is None:
+                    extensions.routes = RouteTable()
+                MockStore(_config.mock_dir, _config.mock_sendfile_size).load().register(extensions.routes)
+            extensions = apply_routes(extensions)
 
             RequestHandler.extensions = extensions
             RequestHandler.config = _config
-            RequestHandler.cache = RequestCache(extensions, _config)
+            cache = RequestCache(extensions, _config)
+            RequestHandler.cache = cache
+            session_pool = SessionPool(pool_size=_config.upstream_pool_size,
+                                       max_connections_per_host=_config.upstream_max_connections,
+                                       idle_timeout=_config.upstream_idle_timeout)
+            RequestHandler.session_pool = session_pool
+            RequestHandler.singleflight = SingleFlight()
+            RequestHandler.rate_limiter = client_rate_limiter(_config)
+            RequestHandler.upstream_rate_limiter = upstream_rate_limiter(_config)
+            RequestHandler.upstreams = upstream_pool(_config, cache.request_fingerprint)
+            metrics = Metrics(enabled=_config.metrics_enabled)
+            metrics.add_gauge_source('cache', cache.stats)
+            if cache.writer is not None:
+                metrics.add_gauge_source('tape_writer', cache.writer.stats)
+            if cache.backend_writer is not None:
+                metrics.add_gauge_source('cache_backend', cache.backend_writer.stats)
+            RequestHandler.metrics = metrics
 
-            TCPServer.allow_reuse_address = True
-            httpd = TCPServer((_config.listen_addr, _config.listen_port), RequestHandler)
-            if _config.listen_ssl:
-                httpd.socket = ssl.wrap_socket(httpd.socket, certfile='./dev-cert.pem', server_side=True)
-            log.info(f'Listening on {_config.listen_scheme} port {_config.listen_port}...')
+            signal.signal(signal.SIGTERM, _terminate)
+            if _config.engine == 'asyncio':
+                httpd = AsyncProxyServer(_config, extensions, cache, metrics)
+                metrics.add_gauge_source('upstream', httpd.pool.stats)
+            else:
+                httpd = create_server(_config, RequestHandler)
+                metrics.add_gauge_source('upstream', session_pool.stats)
+            upstreams = httpd.upstreams if _config.engine == 'asyncio' else RequestHandler.upstreams
+            if upstreams is not None:
+                metrics.add_gauge_source('upstreams', upstreams.stats)
+            metrics_server = None
+            if _config.metrics_port:
+                metrics_server = MetricsServer(metrics, _config.listen_addr, _config.metrics_port)
+                metrics_server.start()
+            log.info(f'Listening on {_config.listen_scheme} port {_config.listen_port}...',
+                     engine=_config.engine, server_mode=_config.server_mode)
             try:
                 httpd.serve_forever()
             finally:
+                if metrics_server is not None:
+                    metrics_server.close()
                 httpd.server_close()
+                log.info('Cache stats', **cache.stats())
+                cache.close()
+                if _config.engine == 'sync':
+                    log.info('Upstream connection pool stats', **session_pool.stats())
+                session_pool.close()
+                if RequestHandler.upstreams is not None:
+                    RequestHandler.upstreams.close()
+
+
+def _terminate(signum, frame):
+    """Exit gracefully on SIGTERM, so that the cleanup (like writing pending entries to the tape) is done"""
+    sys.exit(0)
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.failed: bool = False
+
+
+class SingleFlight(object):
+    """
+    Concurrent calls with the same key are coalesced: the first one runs the function,
+    the others wait for it (up to a timeout) and share its result.
+    If waiting times out or the first call fails, the function is run again by the waiting caller.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: Dict[Any, _Call] = {}
+        self.coalesced: int = 0
+
+    def do(self, key: Any, func: Callable[[], T], timeout: float) -> Tuple[T, bool]:
+        """Return result of the function and flag whether it was shared with another caller"""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            if call.done.wait(timeout) and not call.failed:
+                with self.lock:
+                    self.coalesced += 1
+                return call.result, True
+            return func(), False
+        try:
+            call.result = func()
+            return call.result, False
+        except BaseException:
+            call.failed = True
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+
+_FAILED = object()
+
+
+class AsyncSingleFlight(object):
+    """SingleFlight for coroutines running on a single event loop"""
+
+    def __init__(self):
+        self.calls: Dict[Any, asyncio.Future] = {}
+        self.coalesced: int = 0
+
+    async def do(self, key: Any, func: Callable[[], Awaitable[T]], timeout: float) -> Tuple[T, bool]:
+        future: Optional[asyncio.Future] = self.calls.get(key)
+        if future is not None:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                result = _FAILED
+            if result is not _FAILED:
+                self.coalesced += 1
+                return result, True
+            return await func(), False
+
+        future = asyncio.get_event_loop().create_future()
+        self.calls[key] = future
+        result = _FAILED
+        try:
+            result = await func()
+            return result, False
+        finally:
+            del self.calls[key]
+            future.set_result(result)
@@ -0,0 +1,72 @@
+from typing import Iterable, Iterator, Callable, List, Optional
+
+
+class BodyStream(object):
+    """Request body of known length, relayed from client to upstream in fixed-size blocks"""
+
+    def __init__(self, rfile, length: int, buffer_size: int):
+        self.rfile = rfile
+        self.remaining: int = length
+        self.length: int = length
+        self.buffer_size: int = buffer_size
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[bytes]:
+        while self.remaining > 0:
+            block = self.rfile.read(min(self.buffer_size, self.remaining))
+            if not block:
+                raise ConnectionError('client closed connection while sending request body')
+            self.remaining -= len(block)
+            yield block
+
+    @property
+    def exhausted(self) -> bool:
+        return self.remaining == 0
+
+
+class ChunkedBodyStream(object):
+    """Request body sent by client with chunked Transfer-Encoding, relayed to upstream chunk by chunk"""
+
+    def __init__(self, rfile, buffer_size: int):
+        self.rfile = rfile
+        self.buffer_size: int = buffer_size
+        self.exhausted: bool = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        while not self.exhausted:
+            size = int(self.rfile.readline().split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                while self.rfile.readline() not in (b'\r\n', b'\n', b''):  # skip trailers
+                    pass
+                self.exhausted = True
+                return
+            while size > 0:
+                block = self.rfile.read(min(self.buffer_size, size))
+                if not block:
+                    raise ConnectionError('client closed connection while sending request body')
+                size -= len(block)
+                yield block
+            self.rfile.readline()
+
+
+def tee_stream(stream: Iterable[bytes], max_size: int,
+               on_complete: Callable[[Optional[bytes]], None]) -> Iterator[bytes]:
+    """
+    Pass blocks through while keeping a copy of them, up to max_size bytes.
+    When stream is fully consumed, whole content is given to on_complete callback, None if it was larger,
+    so a huge body is never held in memory as a whole.
+    """
+    blocks: List[bytes] = []
+    size = 0
+    for block in stream:
+        if size <= max_size:
+            size += len(block)
+            if size <= max_size:
+                blocks.append(block)
+            else:
+                blocks = []
+        yield block
+    on_complete(b''.join(blocks) if size <= max_size else None)
+
@@ -0,0 +1,211 @@
+import json
+import mmap
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Callable, Iterable, Any, Tuple, Optional, Union
+
+from nuclear.sublog import log
+
+from .entry import CacheEntry, serialize_cache_entry
+from .request import HttpRequest
+from .tape_index import TapeIndex, LazyJsonEntry, index_lines
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+class JournalTape(object):
+    """
+    Tape file in JSON Lines format - one request-response entry per line.
+    New entries are appended to the end without rewriting the ones recorded before.
+    Legacy tapes (single JSON array of entries) are still readable.
+    With key_tag given, entries are loaded lazily by a sidecar index of their keys & positions,
+    entry_key should be a module-level function then, so that the index can be built by several processes.
+    """
+
+    def __init__(self, path: str, entry_key: Callable[[HttpRequest], Any], key_tag: Optional[str] = None):
+        self.path: str = path
+        self.entry_key: Callable[[HttpRequest], Any] = entry_key
+        self.torn_lines: int = 0
+        self._append_ready: bool = False
+        self.index: Optional[TapeIndex] = TapeIndex(path, key_tag) if key_tag else None
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def is_legacy(self) -> bool:
+        """Legacy tape is a single JSON array containing all entries"""
+        if not self.exists():
+            return False
+        with open(self.path, 'rb') as f:
+            for line in f:
+                stripped = line.lstrip()
+                if stripped:
+                    return stripped.startswith(b'[')
+        return False
+
+    def load(self) -> List[Tuple[Any, Union[CacheEntry, LazyJsonEntry]]]:
+        """Read all entries along with their keys, in order of recording"""
+        if self.index is not None and self.exists() and not self.is_legacy():
+            return self._load_indexed()
+        entries = [CacheEntry.from_json(entry) for entry in self.read_entries()]
+        return [(self.entry_key(entry.request), entry) for entry in entries]
+
+    def _load_indexed(self) -> List[Tuple[Any, LazyJsonEntry]]:
+        """Read keys & positions from the index (building it if it's stale), leaving entries in the mapped file"""
+        positions = self.index.read()
+        if positions is None:
+            positions, self.torn_lines = self.index.build(self.entry_key)
+            # tape with duplicated or torn entries is indexed once it's compacted
+            if not self.torn_lines and len({key for key, _, _ in positions}) == len(positions):
+                self.index.write(positions)
+        if not positions:
+            return []
+        with open(self.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return [(key, LazyJsonEntry(mm, offset, length)) for key, offset, length in positions]
+
+    def entries_from(self, offset: int) -> Tuple[List[Tuple[Any, LazyJsonEntry]], int]:
+        """
+        Lazy entries of lines starting from given offset (0 for all lines), along with the offset they end at,
+        so that the next call reads only the lines appended since then. Line being written is left for later.
+        """
+        if not self.exists() or os.path.getsize(self.path) == 0 or self.is_legacy():
+            return [], offset
+        with open(self.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        positions = self.index.read() if offset == 0 and self.index is not None else None
+        if positions is not None:
+            end = len(mm)
+        else:
+            end = mm.rfind(b'\n') + 1
+            if end <= offset:
+                return [], offset
+            positions, _ = index_lines(self.path, offset, end, self.entry_key)
+        return [(key, LazyJsonEntry(mm, line_offset, length)) for key, line_offset, length in positions], end
+
+    def prepare_recording(self):
+        if self.is_legacy():
+            self.convert_legacy()
+
+    def read_entries(self) -> List[dict]:
+        if not self.exists():
+            return []
+        if self.is_legacy():
+            txt = Path(self.path).read_text()
+            return json.loads(txt) if txt.strip() else []
+        return [json.loads(line) for line in self.read_lines()]
+
+    def read_lines(self) -> Iterable[str]:
+        """Yield serialized entries from JSON Lines tape, skipping torn (incomplete) lines"""
+        self.torn_lines = 0
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for lineno, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                if not line.endswith('\n'):
+                    try:
+                        json.loads(line)
+                    except ValueError:
+                        log.warn('Tape: skipping incomplete entry', record_file=self.path, line=lineno)
+                        self.torn_lines += 1
+                        continue
+                yield line.rstrip('\n')
+
+    def append(self, entries: List[Tuple[Any, CacheEntry]]):
+        """Append entries to the end of the tape"""
+        if not entries:
+            return
+        txt = ''.join(f'{serialize_cache_entry(entry)}\n' for _, entry in entries)
+        if not self._append_ready:
+            if self.is_legacy():
+                self.convert_legacy()
+            if not self._ends_with_newline():
+                txt = '\n' + txt
+            self._append_ready = True
+        with open(self.path, 'ab', buffering=0) as f:
+            with locked_file(f):
+                f.write(txt.encode('utf-8'))
+
+    def _ends_with_newline(self) -> bool:
+        if not self.exists() or os.path.getsize(self.path) == 0:
+            return True
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def rewrite(self, lines: Iterable[str]):
+        """Atomically replace whole tape with given serialized entries"""
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8', newline='\n') as f:
+            for line in lines:
+                f.write(f'{line}\n')
+        os.replace(tmp_path, self.path)
+
+    def convert_legacy(self):
+        entries = self.read_entries()
+        self.rewrite(serialize_entry(entry) for entry in entries)
+        log.info('Tape: converted legacy tape to JSON Lines format', record_file=self.path, entries=len(entries))
+
+    def compact(self) -> int:
+        """
+        Rewrite tape in JSON Lines format, keeping only the first entry for every key.
+        :return: number of dropped entries
+        """
+        if not self.exists():
+            return 0
+        if self.is_legacy():
+            self.convert_legacy()
+        if self.index is not None and self.index.is_valid():
+            return 0
+        seen = set()
+        kept = []
+        kept_keys = []
+        dropped = 0
+        for line in self.read_lines():
+            key = self._line_key(line)
+            if key in seen:
+                dropped += 1
+                continue
+            seen.add(key)
+            kept.append(line)
+            kept_keys.append(key)
+        if dropped or self.torn_lines or self.index is not None:
+            self.rewrite(kept)
+        if self.index is not None:
+            self.index.write(line_positions(kept, kept_keys))
+        return dropped
+
+    def _line_key(self, line: str) -> Any:
+        return self.entry_key(HttpRequest.from_json(json.loads(line).get('request')))
+
+
+@contextmanager
+def locked_file(f):
+    """Exclusive lock on a file, preventing interleaved appends from several processes"""
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def line_positions(lines: List[str], keys: List[Any]) -> List[Tuple[Any, int, int]]:
+    """Positions of lines written one after another, each ended with a newline"""
+    positions = []
+    offset = 0
+    for line, key in zip(lines, keys):
+        length = len(line.encode('utf-8'))
+        positions.append((key, offset, length))
+        offset += length + 1
+    return positions
+
+
+def serialize_entry(entry: dict) -> str:
+    return json.dumps(entry, sort_keys=True)
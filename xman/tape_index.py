@@ -0,0 +1,166 @@
+import json
+import mmap
+import os
+import pickle
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from nuclear.sublog import log
+
+from .request import HttpRequest
+from .response import HttpResponse
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'XMANIDX1'
+INDEX_VERSION = 1
+# magic, version, key tag, tape size, tape modification time (ns), entries count
+INDEX_HEADER = struct.Struct('<8sH16sQqQ')
+# entry key, line offset, line length (without newline)
+INDEX_ENTRY = struct.Struct('<16sQQ')
+# tape is indexed by several processes if every one of them gets at least this many bytes
+PARALLEL_MIN_BYTES = 8 * 1024 * 1024
+
+Position = Tuple[bytes, int, int]
+
+
+class TapeIndex(object):
+    """
+    Sidecar file of JSON Lines tape with keys and positions of its entries, so loading doesn't parse every entry.
+    It's tagged with the way keys are computed (see traits_tag), and tape's size & modification time -
+    index of a changed tape is stale and it's built again, by several processes for large tapes.
+    """
+
+    def __init__(self, tape_path: str, key_tag: str):
+        self.tape_path: str = tape_path
+        self.path: str = tape_path + INDEX_SUFFIX
+        self.key_tag: bytes = key_tag.encode()[:16]
+
+    def read(self) -> Optional[List[Position]]:
+        """Indexed positions, None if index is missing or stale"""
+        if not self.is_valid():
+            return None
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        count = INDEX_HEADER.unpack_from(data)[5]
+        if len(data) != INDEX_HEADER.size + count * INDEX_ENTRY.size:
+            return None
+        return list(INDEX_ENTRY.iter_unpack(memoryview(data)[INDEX_HEADER.size:]))
+
+    def is_valid(self) -> bool:
+        if not os.path.isfile(self.path) or not os.path.isfile(self.tape_path):
+            return False
+        with open(self.path, 'rb') as f:
+            header = f.read(INDEX_HEADER.size)
+        if len(header) < INDEX_HEADER.size:
+            return False
+        magic, version, key_tag, tape_size, tape_mtime, _ = INDEX_HEADER.unpack(header)
+        stat = os.stat(self.tape_path)
+        return magic == INDEX_MAGIC and version == INDEX_VERSION and key_tag.rstrip(b'\0') == self.key_tag \
+            and tape_size == stat.st_size and tape_mtime == stat.st_mtime_ns
+
+    def write(self, positions: List[Position]):
+        """Save index of current tape content, atomically replacing the previous one"""
+        stat = os.stat(self.tape_path)
+        tmp_path = f'{self.path}.tmp.{os.getpid()}'
+        with open(tmp_path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.key_tag, stat.st_size, stat.st_mtime_ns,
+                                      len(positions)))
+            f.write(b''.join(INDEX_ENTRY.pack(*position) for position in positions))
+        os.replace(tmp_path, self.path)
+
+    def build(self, entry_key: Callable[[HttpRequest], Any]) -> Tuple[List[Position], int]:
+        """
+        Scan the tape for positions & keys of entries, splitting it between processes if it's large.
+        :return: positions and number of skipped torn (incomplete) lines
+        """
+        workers = parallel_workers(os.path.getsize(self.tape_path)) if is_picklable(entry_key) else 1
+        ranges = line_ranges(self.tape_path, workers)
+        if not ranges:
+            return [], 0
+        if len(ranges) == 1:
+            results = [index_lines(self.tape_path, ranges[0][0], ranges[0][1], entry_key)]
+        else:
+            with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+                results = list(executor.map(index_lines, [self.tape_path] * len(ranges),
+                                            [start for start, _ in ranges], [end for _, end in ranges],
+                                            [entry_key] * len(ranges)))
+        positions = [position for result, _ in results for position in result]
+        torn = sum(torn for _, torn in results)
+        log.info('Tape: index built', record_file=self.tape_path, entries=len(positions), processes=len(ranges))
+        return positions, torn
+
+
+def is_picklable(entry_key: Callable) -> bool:
+    """Key function can be sent to other processes if it's defined at module level"""
+    try:
+        pickle.dumps(entry_key)
+    except Exception:
+        return False
+    return True
+
+
+def parallel_workers(size: int) -> int:
+    return max(min(os.cpu_count() or 1, size // PARALLEL_MIN_BYTES), 1)
+
+
+def line_ranges(path: str, parts: int) -> List[Tuple[int, int]]:
+    """Split file into byte ranges of roughly equal size, each of them ending at the end of a line"""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for part in range(1, parts):
+            f.seek(max(size * part // parts, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def index_lines(path: str, start: int, end: int, entry_key: Callable[[HttpRequest], Any]) -> Tuple[List[Position], int]:
+    """Keys and positions of entries in lines from start to end offset, skipping torn lines"""
+    positions = []
+    torn = 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        while offset < end:
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    if line.endswith(b'\n'):
+                        raise
+                    log.warn('Tape: skipping incomplete entry', record_file=path, offset=offset)
+                    torn += 1
+                else:
+                    key = entry_key(HttpRequest.from_json(data['request']))
+                    positions.append((key, offset, len(line.rstrip(b'\r\n'))))
+            offset += len(line)
+    return positions, torn
+
+
+class LazyJsonEntry(object):
+    """Request-response entry stored as a line of mapped JSON Lines tape, parsed on every access"""
+    __slots__ = ('mm', 'offset', 'length', 'encoded', 'wire_heads')
+
+    def __init__(self, mm: mmap.mmap, offset: int, length: int):
+        self.mm: mmap.mmap = mm
+        self.offset: int = offset
+        self.length: int = length
+        self.encoded: Dict[str, bytes] = {}
+        self.wire_heads: Dict[Optional[str], Any] = {}
+
+    @property
+    def request(self) -> HttpRequest:
+        return HttpRequest.from_json(self._read()['request'])
+
+    @property
+    def response(self) -> HttpResponse:
+        return HttpResponse.from_json(self._read()['response'])
+
+    def _read(self) -> Dict[str, dict]:
+        return json.loads(self.mm[self.offset:self.offset + self.length])
@@ -0,0 +1,145 @@
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from nuclear.sublog import log
+
+from .entry import CacheEntry
+
+FSYNC_POLICIES = ['never', 'interval', 'batch']
+
+# queued instead of an entry to stop the writer thread
+_STOP = None
+
+
+class TapeWriter(object):
+    """
+    Writes recorded entries to the tape in a background thread, so responses don't wait for the disk.
+    Queued entries are written in batches, to a tape or any other store with append method (like cache backend).
+    Once max_pending entries are waiting, adding new ones blocks until the writer catches up,
+    so a slow disk can't make the queue grow endlessly.
+    :param fsync: never (leave it to the OS), interval (at most every fsync_interval seconds)
+        or batch (after every write)
+    """
+
+    def __init__(self, tape, batch_size: int = 100, max_pending: int = 10000, fsync: str = 'never',
+                 fsync_interval: float = 1.0, name: str = 'tape-writer'):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'unknown fsync policy: {fsync}, expected one of: {", ".join(FSYNC_POLICIES)}')
+        self.tape = tape
+        self.batch_size: int = max(batch_size, 1)
+        self.max_pending: int = max_pending
+        self.fsync: str = fsync
+        self.fsync_interval: float = fsync_interval
+        self.name: str = name
+        self.queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.thread: Optional[threading.Thread] = None
+        self.pid: int = 0
+        self.start_lock = threading.Lock()
+        self.written: int = 0
+        self.batches: int = 0
+        self.fsyncs: int = 0
+        self.blocked: int = 0
+        self.unsynced: bool = False
+        self.last_sync: float = time.monotonic()
+
+    def append(self, entries: List[Tuple[Any, CacheEntry]]):
+        """Queue entries to be written, waiting for free space if too many of them are pending"""
+        self._ensure_started()
+        for entry in entries:
+            try:
+                self.queue.put_nowait(entry)
+            except queue.Full:
+                self.blocked += 1
+                self.queue.put(entry)
+
+    def flush(self):
+        """Wait until all queued entries are written"""
+        if self.thread is not None and self.pid == os.getpid():
+            self.queue.join()
+
+    def close(self):
+        """Write pending entries, sync them to disk (unless fsync is disabled) and stop the writer thread"""
+        if self.thread is None or self.pid != os.getpid():
+            return
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.thread = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'pending': self.queue.qsize(),
+            'written': self.written,
+            'batches': self.batches,
+            'fsyncs': self.fsyncs,
+            'blocked': self.blocked,
+        }
+
+    def _ensure_started(self):
+        """Start writer thread in current process, thread started before fork doesn't run in a worker process"""
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(maxsize=self.max_pending)
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                first = self.queue.get(timeout=self._wait_timeout())
+            except queue.Empty:
+                self._sync()
+                continue
+            batch = [first]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write([entry for entry in batch if entry is not _STOP])
+            for _ in batch:
+                self.queue.task_done()
+            if _STOP in batch:
+                if self.fsync != 'never':
+                    self._sync()
+                return
+
+    def _wait_timeout(self) -> Optional[float]:
+        """Wake up to sync written entries when their interval passes, otherwise wait for new ones"""
+        if self.fsync == 'interval' and self.unsynced:
+            return max(self.last_sync + self.fsync_interval - time.monotonic(), 0)
+        return None
+
+    def _write(self, entries: List[Tuple[Any, CacheEntry]]):
+        if not entries:
+            return
+        try:
+            self.tape.append(entries)
+        except Exception as e:
+            log.error('Tape writer: failed to write entries', entries=len(entries), error=str(e))
+            return
+        self.written += len(entries)
+        self.batches += 1
+        self.unsynced = True
+        if self.fsync == 'batch' or \
+                (self.fsync == 'interval' and time.monotonic() - self.last_sync >= self.fsync_interval):
+            self._sync()
+
+    def _sync(self):
+        if not self.unsynced:
+            return
+        try:
+            with open(self.tape.path, 'ab') as f:
+                os.fsync(f.fileno())
+            self.fsyncs += 1
+        except OSError as e:
+            log.error('Tape writer: failed to sync tape', record_file=self.tape.path, error=str(e))
+        self.unsynced = False
+        self.last_sync = time.monotonic()